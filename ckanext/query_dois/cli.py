@@ -6,7 +6,22 @@
 import click
 from ckan import model
 
-from .model import query_doi_stat_table, query_doi_table
+from .lib.doi import (
+    backfill_authors,
+    fill_doi_pool,
+    get_pool_size,
+    queue_registration,
+)
+from .lib.stats import get_stat_spool, rebuild_usage
+from .model import (
+    PENDING_STATUS,
+    QueryDOI,
+    query_doi_identifier_alias_table,
+    query_doi_pool_table,
+    query_doi_stat_table,
+    query_doi_table,
+    query_doi_usage_table,
+)
 
 
 def get_commands():
@@ -24,10 +39,17 @@ def query_dois():
 @query_dois.command(name='initdb')
 def init_db():
     """
-    Creates the `query_doi` and `query_doi_stat` tables used by this extension.
+    Creates the tables used by this extension.
     """
-    # create the 2 tables if they don't already exist
-    for table in (query_doi_table, query_doi_stat_table):
+    # create the tables if they don't already exist
+    tables = (
+        query_doi_table,
+        query_doi_stat_table,
+        query_doi_pool_table,
+        query_doi_usage_table,
+        query_doi_identifier_alias_table,
+    )
+    for table in tables:
         if not table.exists(model.meta.engine):
             table.create(model.meta.engine)
             click.secho('Created "{}" table'.format(table), fg='green')
@@ -35,3 +57,71 @@ def init_db():
             click.secho(
                 'Table "{}" already exists, skipping...'.format(table), fg='green'
             )
+
+
+@query_dois.command(name='register-pending')
+def register_pending():
+    """
+    Queues background jobs to register any DOIs which are still pending registration
+    with DataCite.
+    """
+    pending = model.Session.query(QueryDOI).filter(QueryDOI.status == PENDING_STATUS)
+    count = 0
+    for query_doi in pending:
+        queue_registration(query_doi)
+        count += 1
+    click.secho(f'Queued registration of {count} pending DOIs', fg='green')
+
+
+@query_dois.command(name='fill-pool')
+@click.option(
+    '--size',
+    type=int,
+    default=None,
+    help='The number of DOIs the pool should hold, defaults to the '
+    'ckanext.query_dois.pool_size config value',
+)
+def fill_pool(size):
+    """
+    Fills the pool of DOIs that have already been checked for uniqueness.
+    """
+    size = get_pool_size() if size is None else size
+    added = fill_doi_pool(size)
+    click.secho(f'Added {added} DOIs to the pool', fg='green')
+    if get_pool_size() <= 0:
+        click.secho(
+            'The pool is disabled, set ckanext.query_dois.pool_size to claim DOIs '
+            'from it when minting',
+            fg='yellow',
+        )
+
+
+@query_dois.command(name='rebuild-usage')
+def rebuild_usage_totals():
+    """
+    Rebuilds the per DOI usage totals from the recorded stats.
+    """
+    count = rebuild_usage()
+    click.secho(f'Rebuilt usage totals for {count} DOIs', fg='green')
+
+
+@query_dois.command(name='flush-stats')
+def flush_stats():
+    """
+    Writes any stats waiting in the local stat spool to the database.
+    """
+    spool = get_stat_spool()
+    if spool is None:
+        click.secho('The stat spool is not enabled', fg='yellow')
+        return
+    count = spool.flush()
+    click.secho(f'Wrote {count} spooled stats', fg='green')
+
+
+@query_dois.command(name='backfill-authors')
+def backfill_doi_authors():
+    """
+    Stores the authors of DOIs minted before authors were stored on DOIs.
+    """
+    count = backfill_authors()
+    click.secho(f'Stored the authors of {count} DOIs', fg='green')
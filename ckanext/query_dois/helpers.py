@@ -4,15 +4,21 @@
 # This file is part of ckanext-query-dois
 # Created by the Natural History Museum in London, UK
 import json
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 from ckan import model
 from ckan.lib.helpers import link_to
 from ckan.plugins import toolkit
-from sqlalchemy import or_
+from sqlalchemy import func
 from sqlalchemy.orm import Query
 
+from ckanext.query_dois.lib.summaries import (
+    get_doi_summary_cache,
+    get_package_resource_ids,
+    get_visible_package_id,
+)
 from ckanext.query_dois.model import QueryDOI
 
 
@@ -31,23 +37,90 @@ def render_filter_value(field, filter_value):
         return filter_value
 
 
+@dataclass
+class DOISummary:
+    """
+    The number of DOIs created against the resources of a package, along with the most
+    recent of them.
+    """
+
+    count: int
+    query_dois: List[QueryDOI]
+
+
 def _make_all_resource_query(package_id: str) -> Optional[Query]:
     """
     Creates an SQL Alchemy query that can get all the QueryDOI entities associated with
     the resources of the given package.
 
-    :param package_id:
-    :returns: None if the package doesn't exist or if the package has no resources,
-        otherwise, returns an SQL Alchemy Query object
+    :param package_id: the package's ID or name
+    :returns: None if the package doesn't exist, if the current user can't see it or if
+        the package has no resources, otherwise, returns an SQL Alchemy Query object
     """
-    try:
-        package = toolkit.get_action('package_show')({}, {'id': package_id})
-    except toolkit.ObjectNotFound:
+    package_id = get_visible_package_id(package_id)
+    if package_id is None:
         return None
-    ors = [QueryDOI.on_resource(resource['id']) for resource in package['resources']]
-    if not ors:
+    return _make_package_query(package_id)
+
+
+def _make_package_query(package_id: str) -> Optional[Query]:
+    """
+    Creates an SQL Alchemy query that can get all the QueryDOI entities associated with
+    the resources of the given package, without checking the package can be seen.
+
+    :param package_id: the package's ID
+    :returns: None if the package has no resources, otherwise, returns an SQL Alchemy
+        Query object
+    """
+    resource_ids = get_package_resource_ids(package_id)
+    if not resource_ids:
         return None
-    return model.Session.query(QueryDOI).filter(or_(*ors))
+    return model.Session.query(QueryDOI).filter(QueryDOI.on_any_resource(resource_ids))
+
+
+def get_doi_summary(package_id: str, number: int) -> DOISummary:
+    """
+    Retrieve the total count of DOIs created against the resources within the given
+    package and the most recent of them, using one query. The summaries are cached and
+    are removed from the cache when a DOI is created against one of the package's
+    resources.
+
+    The current user's access to the package is checked before the cache is used, so a
+    summary is never shown for a package the user can't see.
+
+    :param package_id: the package's ID or name
+    :param number: the number of recent DOIs to return
+    :returns: a DOISummary object
+    """
+    package_id = get_visible_package_id(package_id)
+    if package_id is None:
+        return DOISummary(0, [])
+
+    cache = get_doi_summary_cache()
+    # always key by ID as the cached summaries are removed by package ID
+    key = (package_id, number)
+    summary = cache.get(key)
+    if summary is None:
+        summary = DOISummary(0, [])
+        query = _make_package_query(package_id)
+        if query is not None:
+            # the window function gets the count of all the matching rows alongside
+            # each row we retrieve
+            rows = (
+                query.add_columns(func.count().over())
+                .order_by(QueryDOI.id.desc())
+                .limit(max(number, 1))
+                .all()
+            )
+            if rows:
+                summary.count = rows[0][1]
+                summary.query_dois = [query_doi for query_doi, _count in rows[:number]]
+                # detach the DOIs from the session so that the cached copies aren't
+                # expired or refreshed by anything that happens in later requests
+                for query_doi, _count in rows:
+                    model.Session.expunge(query_doi)
+        cache.set(key, summary)
+    return summary
 
 
 def get_most_recent_dois(package_id, number):
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-query-dois
+# Created by the Natural History Museum in London, UK
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from ckan.plugins import toolkit
+
+# sentinel used to differentiate between a missing key and a stored None value
+_missing = object()
+
+
+class LRUCache:
+    """
+    A simple, thread safe, in-process cache with a bounded size. When the cache is
+    full, the least recently used entry is evicted to make room for the new one.
+    Optionally, entries can also be expired after a given number of seconds.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        """
+        :param max_size: the maximum number of entries to hold, if this is less than 1
+            then nothing is ever cached
+        :param ttl: the number of seconds an entry is valid for after it is set, if
+            None (the default) then entries never expire
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expiry, value) tuples
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _is_expired(self, expiry: Optional[float]) -> bool:
+        return expiry is not None and expiry <= time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Retrieve the value stored under the given key, or the default if there isn't
+        one. Retrieving a value marks it as recently used.
+
+        :param key: the key
+        :param default: the value to return if the key isn't in the cache
+        :returns: the cached value or the default
+        """
+        with self._lock:
+            entry = self._entries.get(key, _missing)
+            if entry is _missing:
+                return default
+            expiry, value = entry
+            if self._is_expired(expiry):
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Store the given value under the given key, evicting the least recently used
+        entries if the cache is full.
+
+        :param key: the key
+        :param value: the value
+        """
+        if self.max_size < 1:
+            return
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Remove the entry with the given key from the cache and return its value, or the
+        default if there isn't one.
+
+        :param key: the key
+        :param default: the value to return if the key isn't in the cache
+        :returns: the cached value or the default
+        """
+        with self._lock:
+            entry = self._entries.pop(key, _missing)
+            if entry is _missing or self._is_expired(entry[0]):
+                return default
+            return entry[1]
+
+    def pop_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        Remove all the entries with keys that match the given predicate from the cache.
+
+        :param predicate: a function which is passed each key and returns True if the
+            entry should be removed
+        :returns: the number of entries removed
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        """
+        :param key: the key
+        :returns: True if the key is in the cache and hasn't expired, False if not
+        """
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self) -> int:
+        """
+        :returns: the number of entries in the cache, including any which have expired
+            but haven't been removed yet
+        """
+        with self._lock:
+            return len(self._entries)
+
+
+def get_cache_size(name: str, default: int) -> int:
+    """
+    Retrieves the size of a cache from the config. The config option read is
+    ckanext.query_dois.<name>_cache_size.
+
+    :param name: the name of the cache
+    :param default: the default size to use if no config value is set
+    :returns: the size as an integer
+    """
+    return toolkit.asint(
+        toolkit.config.get(f'ckanext.query_dois.{name}_cache_size', default)
+    )
+
+
+def get_cache_ttl(name: str, default: float) -> float:
+    """
+    Retrieves the number of seconds entries in a cache should live for from the config.
+    The config option read is ckanext.query_dois.<name>_cache_ttl.
+
+    :param name: the name of the cache
+    :param default: the default TTL to use if no config value is set
+    :returns: the TTL in seconds as a float
+    """
+    return float(toolkit.config.get(f'ckanext.query_dois.{name}_cache_ttl', default))
+
+
+def configured_cache(
+    name: str, default_size: int, default_ttl: Optional[float] = None
+) -> Callable[[], LRUCache]:
+    """
+    Creates a function which returns the named cache, creating it from the config on
+    the first call (the config isn't available when modules are imported). The size is
+    read from ckanext.query_dois.<name>_cache_size and, if the cache expires entries,
+    the TTL from ckanext.query_dois.<name>_cache_ttl.
+
+    :param name: the name of the cache
+    :param default_size: the default size of the cache
+    :param default_ttl: the default TTL of the cache, if None then entries never
+        expire and the TTL config option is not read
+    :returns: a function which returns the LRUCache
+    """
+    cache = None
+    lock = threading.Lock()
+
+    def get_cache() -> LRUCache:
+        nonlocal cache
+        with lock:
+            if cache is None:
+                ttl = None
+                if default_ttl is not None:
+                    ttl = get_cache_ttl(name, default_ttl)
+                cache = LRUCache(get_cache_size(name, default_size), ttl)
+            return cache
+
+    return get_cache
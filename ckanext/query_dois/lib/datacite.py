@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-query-dois
+# Created by the Natural History Museum in London, UK
+
+import logging
+import ssl
+import threading
+import time
+from typing import Optional
+
+import requests
+from datacite import DataCiteMDSClient
+from datacite.errors import HttpError
+from datacite.request import DataCiteRequest
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests.exceptions import RequestException
+
+log = logging.getLogger(__name__)
+
+
+class DataCiteUnavailableError(HttpError):
+    """
+    Raised instead of making a request when the circuit breaker is open.
+    """
+
+    pass
+
+
+class CircuitBreaker:
+    """
+    A simple, thread safe circuit breaker.
+
+    After a given number of consecutive failures the breaker opens and no requests are
+    allowed until the reset timeout has passed. After that, requests are allowed again
+    and the first success closes the breaker.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        """
+        :param threshold: the number of consecutive failures which opens the breaker
+        :param reset_timeout: the number of seconds the breaker stays open for
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """
+        :returns: True if the breaker is open and requests shouldn't be made, False if
+            not
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            return time.monotonic() - self.opened_at < self.reset_timeout
+
+    def record_success(self):
+        """
+        Records a successful request, closing the breaker.
+        """
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        """
+        Records a failed request, opening the breaker if the threshold has been reached.
+        """
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    log.warning(
+                        f'DataCite circuit breaker opened after {self.failures} '
+                        f'consecutive failures'
+                    )
+                self.opened_at = time.monotonic()
+
+
+class PooledDataCiteRequest(DataCiteRequest):
+    """
+    A DataCiteRequest which sends its requests using a shared requests Session (and
+    therefore a pool of keep-alive connections) and retries failed requests with an
+    exponential backoff.
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        breaker: CircuitBreaker,
+        retries: int,
+        backoff: float,
+        **kwargs,
+    ):
+        """
+        :param session: the Session to send requests with
+        :param breaker: the CircuitBreaker to check and update
+        :param retries: the number of times to retry a failed request
+        :param backoff: the number of seconds to wait before the first retry, doubled
+            after each subsequent failure
+        :param kwargs: the DataCiteRequest parameters
+        """
+        super().__init__(**kwargs)
+        self.session = session
+        self.breaker = breaker
+        self.retries = retries
+        self.backoff = backoff
+
+    def request(self, url, method='GET', body=None, params=None, headers=None):
+        """
+        Makes a request to DataCite, retrying connection errors, 5xx responses and 429
+        responses.
+
+        :param url: the URL to request, relative to the base URL if one is set
+        :param method: the HTTP method (default: GET)
+        :param body: the request body (default: None)
+        :param params: the query parameters (default: None)
+        :param headers: the request headers (default: None)
+        :returns: the response
+        """
+        if self.breaker.is_open:
+            raise DataCiteUnavailableError(
+                'DataCite requests are suspended after repeated failures'
+            )
+
+        params = dict(params or {})
+        params.update(self.default_params)
+        if self.base_url:
+            url = self.base_url + url
+        if body and isinstance(body, str):
+            body = body.encode('utf-8')
+
+        kwargs = dict(
+            auth=HTTPBasicAuth(self.username, self.password),
+            params=params,
+            headers=headers or {},
+            timeout=self.timeout,
+        )
+        if method in ('POST', 'PUT'):
+            kwargs['data'] = body
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (RequestException, ssl.SSLError) as e:
+                error = HttpError(e)
+                continue
+            if response.status_code >= 500 or response.status_code == 429:
+                # the client methods turn these responses into errors, but we only
+                # return the response if we've run out of retries
+                error = None
+                continue
+            self.breaker.record_success()
+            return response
+
+        self.breaker.record_failure()
+        if error is not None:
+            raise error
+        return response
+
+
+class PooledDataCiteMDSClient(DataCiteMDSClient):
+    """
+    A DataCiteMDSClient which reuses a pool of keep-alive HTTP connections, applies
+    timeouts and retries to every request, and fails fast using a circuit breaker when
+    DataCite is repeatedly failing.
+    """
+
+    def __init__(
+        self,
+        *args,
+        pool_size: int = 10,
+        retries: int = 2,
+        backoff: float = 0.5,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 60,
+        session: Optional[requests.Session] = None,
+        **kwargs,
+    ):
+        """
+        :param args: the DataCiteMDSClient parameters
+        :param pool_size: the maximum number of connections to keep open
+        :param retries: the number of times to retry a failed request
+        :param backoff: the number of seconds to wait before the first retry, doubled
+            after each subsequent failure
+        :param breaker_threshold: the number of consecutive failed requests which opens
+            the circuit breaker
+        :param breaker_reset: the number of seconds the circuit breaker stays open for
+        :param session: the requests Session to use, if None a new one is created
+        :param kwargs: the DataCiteMDSClient parameters
+        """
+        super().__init__(*args, **kwargs)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+
+    def _create_request(self):
+        return PooledDataCiteRequest(
+            self.session,
+            self.breaker,
+            self.retries,
+            self.backoff,
+            base_url=self.api_url,
+            username=self.username,
+            password=self.password,
+            timeout=self.timeout,
+        )
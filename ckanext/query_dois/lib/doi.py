@@ -4,20 +4,38 @@
 # This file is part of ckanext-query-dois
 # Created by the Natural History Museum in London, UK
 
+import hashlib
 import logging
 import random
 import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from ckan import model
 from ckan.common import asbool
 from ckan.plugins import toolkit
 from datacite import DataCiteMDSClient, schema41
-from datacite.errors import DataCiteError, DataCiteNotFoundError
-
-from ckanext.query_dois.lib.query import Query
-from ckanext.query_dois.model import QueryDOI
+from datacite.errors import DataCiteError, DataCiteNotFoundError, HttpError
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from ckanext.query_dois.lib.datacite import PooledDataCiteMDSClient
+from ckanext.query_dois.lib.jobs import enqueue, retry
+from ckanext.query_dois.lib.landing_pages import invalidate_landing_page
+from ckanext.query_dois.lib.query import Query, find_authors
+from ckanext.query_dois.lib.summaries import invalidate_doi_summaries
+from ckanext.query_dois.model import (
+    PENDING_STATUS,
+    REGISTERED_STATUS,
+    QueryDOI,
+    query_doi_pool_table,
+)
 
 log = logging.getLogger(__name__)
 
@@ -34,6 +52,28 @@ def is_test_mode():
     return asbool(toolkit.config.get('ckanext.query_dois.test_mode', True))
 
 
+def is_async_minting():
+    """
+    Checks whether DOIs should be registered with DataCite in a background job rather
+    than while the user waits.
+
+    :returns: True if they should, False if not. Defaults to False.
+    """
+    return asbool(toolkit.config.get('ckanext.query_dois.async_minting', False))
+
+
+def is_datacite_check_skipped():
+    """
+    Checks whether newly generated DOIs should only be checked for uniqueness against
+    our database, rather than against DataCite too. This is only safe if no one else
+    mints DOIs with our prefix.
+
+    :returns: True if the DataCite check should be skipped, False if not. Defaults to
+        False.
+    """
+    return asbool(toolkit.config.get('ckanext.query_dois.skip_datacite_check', False))
+
+
 def get_prefix():
     """
     Gets the prefix to use for the DOIs we mint.
@@ -54,33 +94,76 @@ def get_prefix():
     return prefix
 
 
-def get_client():
+# the DataCite client used by this process, see get_client
+_client = None
+_client_lock = threading.Lock()
+
+
+def create_client() -> PooledDataCiteMDSClient:
     """
-    Get a datacite MDS API client, configured for use.
+    Create a datacite MDS API client, configured for use.
 
     :returns: a DataCite client object
     """
+    config = toolkit.config
     kwargs = dict(
-        username=toolkit.config.get('ckanext.query_dois.datacite_username'),
-        password=toolkit.config.get('ckanext.query_dois.datacite_password'),
+        username=config.get('ckanext.query_dois.datacite_username'),
+        password=config.get('ckanext.query_dois.datacite_password'),
         prefix=get_prefix(),
         test_mode=is_test_mode(),
+        timeout=(
+            float(config.get('ckanext.query_dois.datacite_connect_timeout', 5)),
+            float(config.get('ckanext.query_dois.datacite_read_timeout', 30)),
+        ),
+        pool_size=toolkit.asint(
+            config.get('ckanext.query_dois.datacite_pool_size', 10)
+        ),
+        retries=toolkit.asint(config.get('ckanext.query_dois.datacite_retries', 2)),
+        backoff=float(config.get('ckanext.query_dois.datacite_retry_backoff', 0.5)),
+        breaker_threshold=toolkit.asint(
+            config.get('ckanext.query_dois.datacite_breaker_threshold', 5)
+        ),
+        breaker_reset=float(
+            config.get('ckanext.query_dois.datacite_breaker_reset', 60)
+        ),
     )
     # datacite 1.0.1 isn't updated for the test prefix deprecation yet so this is a temp fix
     if is_test_mode():
         kwargs.update({'url': 'https://mds.test.datacite.org'})
-    return DataCiteMDSClient(**kwargs)
+    return PooledDataCiteMDSClient(**kwargs)
 
 
-def generate_doi(client):
+def get_client() -> PooledDataCiteMDSClient:
+    """
+    Get the datacite MDS API client for this process, creating it on first use. The
+    client is long-lived so that its pooled connections and circuit breaker are shared
+    by every mint in the process.
+
+    :returns: a DataCite client object
+    """
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = create_client()
+        return _client
+
+
+def generate_doi(client=None):
     """
     Generate a new DOI which isn't currently in use. The database is checked for
-    previous usage, as is Datacite itself. Use whatever value is retuned from this
-    function quickly to avoid double use as this function uses no locking.
+    previous usage, as is Datacite itself unless the
+    ckanext.query_dois.skip_datacite_check option is set. Use whatever value is retuned
+    from this function quickly to avoid double use as this function uses no locking.
 
-    :param client: an instance of the DataCiteMDSClient class
+    :param client: an instance of the DataCiteMDSClient class, or None to use the shared
+        client (default: None)
     :returns: the full, unique DOI
     """
+    check_datacite = not is_datacite_check_skipped()
+    if check_datacite and client is None:
+        client = get_client()
+
     # the list of valid characters is larger than just lowercase and the digits but we don't need
     # that many options and URLs with just alphanumeric characters in them are nicer. We just use
     # lowercase characters to avoid any issues with case being ignored
@@ -95,9 +178,14 @@ def generate_doi(client):
         # form the doi using the prefix
         doi = f'{get_prefix()}/{identifier}'
 
-        # check this doi doesn't exist in the table
+        # check this doi doesn't exist in the table or the pool
         if model.Session.query(QueryDOI).filter(QueryDOI.doi == doi).count():
             continue
+        if is_pooled(doi):
+            continue
+
+        if not check_datacite:
+            return doi
 
         # check against the datacite service
         try:
@@ -120,6 +208,138 @@ def generate_doi(client):
         raise Exception('Failed to generate a DOI')
 
 
+def get_pool_size() -> int:
+    """
+    Gets the number of DOIs the pool should be refilled to when it runs low. If this is
+    0 the pool is disabled and DOIs are never claimed from it.
+
+    :returns: the pool size
+    """
+    return toolkit.asint(toolkit.config.get('ckanext.query_dois.pool_size', 0))
+
+
+def get_pool_count() -> int:
+    """
+    :returns: the number of DOIs currently in the pool
+    """
+    return model.Session.execute(
+        select([func.count()]).select_from(query_doi_pool_table)
+    ).scalar()
+
+
+def is_pooled(doi: str) -> bool:
+    """
+    :param doi: the doi (full, prefix and suffix)
+    :returns: True if the DOI is in the pool, False if not
+    """
+    row = model.Session.execute(
+        select([query_doi_pool_table.c.id]).where(query_doi_pool_table.c.doi == doi)
+    ).first()
+    return row is not None
+
+
+def fill_doi_pool(size: int, batch_size: int = 100) -> int:
+    """
+    Adds DOIs to the pool until it contains the given number of DOIs. Each DOI added is
+    checked for uniqueness against the database and DataCite (see generate_doi). The
+    DOIs are inserted and committed in batches.
+
+    :param size: the number of DOIs the pool should contain
+    :param batch_size: the number of DOIs to insert at a time (default: 100)
+    :returns: the number of DOIs added
+    """
+    needed = size - get_pool_count()
+    if needed <= 0:
+        return 0
+
+    client = get_client()
+    added = 0
+    while needed > 0:
+        timestamp = datetime.now()
+        # use a set as generate_doi can't know about the DOIs in this batch
+        dois = set()
+        while len(dois) < min(needed, batch_size):
+            dois.add(generate_doi(client))
+        statement = (
+            insert(query_doi_pool_table)
+            .values([dict(doi=doi, timestamp=timestamp) for doi in dois])
+            .on_conflict_do_nothing()
+        )
+        added += model.Session.execute(statement).rowcount
+        model.Session.commit()
+        needed -= len(dois)
+    return added
+
+
+# the time.monotonic() value when this process last queued a pool refill
+_last_refill_queued = None
+
+
+def queue_pool_refill():
+    """
+    Adds a background job to refill the pool if it's running low.
+
+    Refill jobs are queued at most once a minute per process.
+    """
+    global _last_refill_queued
+
+    size = get_pool_size()
+    if size <= 0:
+        return
+    if _last_refill_queued is not None and time.monotonic() - _last_refill_queued < 60:
+        return
+    threshold = toolkit.asint(
+        toolkit.config.get('ckanext.query_dois.pool_refill_threshold', size // 2)
+    )
+    if get_pool_count() < threshold:
+        _last_refill_queued = time.monotonic()
+        enqueue(fill_doi_pool, [size], title='Refill DOI pool')
+
+
+def claim_pooled_doi() -> Optional[str]:
+    """
+    Claims a DOI from the pool, removing it so that it can't be claimed again. The claim
+    happens in its own transaction and skips any rows locked by concurrent claims, so no
+    two callers can ever get the same DOI.
+
+    :returns: the full DOI or None if the pool is empty
+    """
+    table = query_doi_pool_table
+    with model.meta.engine.begin() as connection:
+        row = connection.execute(
+            select([table.c.id, table.c.doi])
+            # ignore any DOIs created with a different prefix
+            .where(table.c.doi.startswith(f'{get_prefix()}/'))
+            .order_by(table.c.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).first()
+        if row is None:
+            return None
+        connection.execute(table.delete().where(table.c.id == row.id))
+    return row.doi
+
+
+def reserve_doi(client=None) -> str:
+    """
+    Reserves a new, unused DOI. If the pool is enabled, DOIs are claimed from it where
+    possible, avoiding the need to check their uniqueness now. If the pool is disabled
+    or empty, a new DOI is generated using generate_doi.
+
+    :param client: an instance of the DataCiteMDSClient class, or None to use the shared
+        client if a DOI needs to be generated (default: None)
+    :returns: the full, unique DOI
+    """
+    doi = None
+    # don't make a round trip to the pool table if the pool is disabled
+    if get_pool_size() > 0:
+        doi = claim_pooled_doi()
+        queue_pool_refill()
+    if doi is None:
+        doi = generate_doi(client)
+    return doi
+
+
 def find_existing_doi(query: Query) -> Optional[QueryDOI]:
     """
     Returns a QueryDOI object representing the query, or returns None if one doesn't
@@ -133,22 +353,23 @@ def find_existing_doi(query: Query) -> Optional[QueryDOI]:
         .filter(
             QueryDOI.query_hash == query.query_hash,
             QueryDOI.query_version == query.query_version,
+            QueryDOI.fingerprint == query.fingerprint,
+            # guard against fingerprint collisions, this is only checked against the
+            # row found using the index
             QueryDOI.resources_and_versions == query.resources_and_versions,
         )
         .first()
     )
 
 
-def create_doi_on_datacite(
-    client: DataCiteMDSClient, doi: str, timestamp: datetime, query: Query
-):
+def create_datacite_metadata(doi: str, timestamp: datetime, query: Query) -> str:
     """
-    Mints the given DOI on datacite using the client.
+    Creates the DataCite metadata XML for the given DOI.
 
-    :param client: the MDS datacite client
     :param doi: the doi (full, prefix and suffix)
     :param timestamp: the datetime when the DOI was created
     :param query: a Query object
+    :returns: the metadata XML string
     """
     # create the data for datacite
     data = {
@@ -172,11 +393,16 @@ def create_doi_on_datacite(
     # use an assert here because the data should be valid every time, otherwise it's something the
     # developer is going to have to fix
     assert schema41.validate(data)
+    return schema41.tostring(data)
 
-    # create the metadata on datacite
-    client.metadata_post(schema41.tostring(data))
 
-    # create the URL the DOI will point to, i.e. the landing page
+def get_doi_url(doi: str) -> str:
+    """
+    Creates the URL the DOI should point to, i.e. its landing page.
+
+    :param doi: the doi (full, prefix and suffix)
+    :returns: the full landing page URL
+    """
     data_centre, identifier = doi.split('/')
     landing_page_url = toolkit.url_for(
         'query_doi.landing_page', data_centre=data_centre, identifier=identifier
@@ -184,14 +410,45 @@ def create_doi_on_datacite(
     site = toolkit.config.get('ckan.site_url')
     if site[-1] == '/':
         site = site[:-1]
-    # mint the DOI
-    client.doi_post(doi, site + landing_page_url)
+    return site + landing_page_url
+
+
+def post_to_datacite(client: DataCiteMDSClient, doi: str, metadata: str, url: str):
+    """
+    Creates the metadata for the DOI on datacite and then mints the DOI. This only makes
+    the HTTP requests and doesn't need any CKAN context, so it can be called from other
+    threads.
+
+    :param client: the MDS datacite client
+    :param doi: the doi (full, prefix and suffix)
+    :param metadata: the metadata XML string
+    :param url: the URL the DOI should point to
+    """
+    client.metadata_post(metadata)
+    client.doi_post(doi, url)
+
+
+def create_doi_on_datacite(
+    client: DataCiteMDSClient, doi: str, timestamp: datetime, query: Query
+):
+    """
+    Mints the given DOI on datacite using the client.
+
+    :param client: the MDS datacite client
+    :param doi: the doi (full, prefix and suffix)
+    :param timestamp: the datetime when the DOI was created
+    :param query: a Query object
+    """
+    post_to_datacite(
+        client, doi, create_datacite_metadata(doi, timestamp, query), get_doi_url(doi)
+    )
 
 
 def create_database_entry(
     doi: str,
     query: Query,
     timestamp: datetime,
+    status: str = REGISTERED_STATUS,
 ):
     """
     Inserts the database row for the query DOI.
@@ -199,6 +456,7 @@ def create_database_entry(
     :param doi: the doi (full, prefix and suffix)
     :param query: the query
     :param timestamp: the datetime the DOI was created
+    :param status: the status of the DOI (default: registered)
     :returns: the QueryDOI object
     """
     query_doi = QueryDOI(
@@ -209,13 +467,230 @@ def create_database_entry(
         query=query.query,
         query_version=query.query_version,
         query_hash=query.query_hash,
+        fingerprint=query.fingerprint,
         count=query.count,
         resource_counts=query.counts,
+        authors=query.authors,
+        status=status,
     )
     query_doi.save()
+    invalidate_doi_summaries(query_doi.get_resource_ids())
     return query_doi
 
 
+def backfill_authors(batch_size: int = 1000) -> int:
+    """
+    Stores the authors of every DOI which was minted before authors were stored on DOIs.
+    The authors are taken from the packages the DOI's resources are currently in.
+
+    :param batch_size: the number of DOIs to update in each transaction
+    :returns: the number of DOIs updated
+    """
+    count = 0
+    while True:
+        query_dois = (
+            model.Session.query(QueryDOI)
+            .filter(QueryDOI.authors.is_(None))
+            .order_by(QueryDOI.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not query_dois:
+            return count
+        for query_doi in query_dois:
+            query_doi.authors = find_authors(sorted(query_doi.get_resource_ids()))
+            invalidate_landing_page(query_doi.doi)
+        model.Session.commit()
+        count += len(query_dois)
+
+
+def register_doi(doi: str):
+    """
+    Registers a pending DOI with DataCite and marks it as registered. This is run as a
+    background job when async minting is enabled and retries with an exponential backoff
+    if DataCite fails to respond. If all the attempts fail the DOI is left pending and
+    can be registered later using the register-pending CLI command.
+
+    The DOI's uniqueness isn't checked again, it was checked when the DOI was reserved.
+
+    :param doi: the doi (full, prefix and suffix)
+    """
+    query_doi = model.Session.query(QueryDOI).filter(QueryDOI.doi == doi).first()
+    if query_doi is None or query_doi.is_registered:
+        return
+
+    attempts = toolkit.asint(
+        toolkit.config.get('ckanext.query_dois.registration_attempts', 5)
+    )
+    backoff = float(toolkit.config.get('ckanext.query_dois.registration_backoff', 10))
+
+    query = Query.from_query_doi(query_doi)
+    client = get_client()
+    retry(
+        lambda: create_doi_on_datacite(client, doi, query_doi.timestamp, query),
+        (DataCiteError, HttpError),
+        attempts,
+        backoff,
+        f'register DOI {doi}',
+    )
+    mark_registered(query_doi)
+
+
+def mark_registered(query_doi: QueryDOI):
+    """
+    Marks the given pending DOI as registered with DataCite.
+
+    :param query_doi: the QueryDOI object
+    """
+    query_doi.status = REGISTERED_STATUS
+    query_doi.save()
+    invalidate_landing_page(query_doi.doi)
+
+
+def queue_registration(query_doi: QueryDOI):
+    """
+    Adds a background job to register the given pending DOI with DataCite.
+
+    :param query_doi: the QueryDOI object
+    """
+    enqueue(register_doi, [query_doi.doi], title=f'Register DOI {query_doi.doi}')
+
+
+def get_lock_key(query: Query) -> int:
+    """
+    Creates the key of the postgres advisory lock which is held while minting a DOI for
+    the query. The key is the same for all queries which would produce identical data.
+
+    :param query: the query
+    :returns: a signed 64-bit integer
+    """
+    key = '|'.join(map(str, get_query_key(query)))
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+class MintLockTimeoutError(Exception):
+    """
+    Raised when the advisory lock for a query can't be taken within the configured
+    timeout because another process is taking too long to mint a DOI for an identical
+    query.
+    """
+
+    pass
+
+
+def get_mint_lock_timeout() -> float:
+    """
+    Gets the number of seconds to wait for another process minting a DOI for an
+    identical query before giving up.
+
+    :returns: the number of seconds
+    """
+    return float(toolkit.config.get('ckanext.query_dois.mint_lock_timeout', 30))
+
+
+@contextmanager
+def mint_lock(query: Query, poll_interval: float = 0.1):
+    """
+    Context manager which holds a postgres advisory lock for the query while minting a
+    DOI for it, waiting until any other process minting a DOI for an identical query
+    has finished. The lock is taken on its own connection so that it is held across the
+    commits made while minting.
+
+    The lock is polled for rather than waited on in postgres so that the wait is
+    bounded, if the lock can't be taken within the mint lock timeout a
+    MintLockTimeoutError is raised. The connection is returned to the pool between
+    attempts.
+
+    :param query: the query
+    :param poll_interval: the number of seconds to wait between attempts to take the
+        lock
+    """
+    key = get_lock_key(query)
+    deadline = time.monotonic() + get_mint_lock_timeout()
+    while True:
+        connection = model.meta.engine.connect()
+        try:
+            locked = connection.execute(
+                select([func.pg_try_advisory_lock(key)])
+            ).scalar()
+        except Exception:
+            connection.close()
+            raise
+        if locked:
+            break
+        # return the connection to the pool while we wait so that waiting requests
+        # don't hold on to connections
+        connection.close()
+        if time.monotonic() >= deadline:
+            raise MintLockTimeoutError(
+                f'Timed out waiting to mint a DOI for query {query.query_hash}'
+            )
+        time.sleep(poll_interval)
+
+    try:
+        yield
+    finally:
+        try:
+            connection.execute(select([func.pg_advisory_unlock(key)]))
+        finally:
+            connection.close()
+
+
+def insert_or_get(
+    doi: str,
+    query: Query,
+    timestamp: datetime,
+    status: str = REGISTERED_STATUS,
+) -> Tuple[bool, QueryDOI]:
+    """
+    Inserts the database row for the query DOI, unless a DOI for an identical query has
+    been inserted since we last checked, in which case that DOI is returned instead.
+
+    :param doi: the doi (full, prefix and suffix)
+    :param query: the query
+    :param timestamp: the datetime the DOI was created
+    :param status: the status of the DOI (default: registered)
+    :returns: a boolean indicating whether the row was inserted and the QueryDOI object
+    """
+    try:
+        return True, create_database_entry(doi, query, timestamp, status)
+    except IntegrityError:
+        model.Session.rollback()
+        existing_doi = find_existing_doi(query)
+        if existing_doi is None:
+            raise
+        log.warning(f'DOI {doi} was minted for a query which already has a DOI')
+        return False, existing_doi
+
+
+def needs_registration(query_doi: QueryDOI) -> bool:
+    """
+    Checks whether the given existing DOI should be registered with DataCite before it
+    is returned to the user. This is the case for pending DOIs when async minting isn't
+    enabled, as they are only left pending if registering them failed. When async
+    minting is enabled, pending DOIs are registered by a background job instead.
+
+    :param query_doi: the QueryDOI object
+    :returns: True if the DOI should be registered now, False if not
+    """
+    return not query_doi.is_registered and not is_async_minting()
+
+
+def create_registration(query_doi: QueryDOI) -> Tuple[str, str]:
+    """
+    Creates the DataCite metadata and URL needed to register the given existing DOI.
+
+    :param query_doi: the QueryDOI object
+    :returns: the metadata XML string and the URL the DOI should point to
+    """
+    query = Query.from_query_doi(query_doi)
+    return (
+        create_datacite_metadata(query_doi.doi, query_doi.timestamp, query),
+        get_doi_url(query_doi.doi),
+    )
+
+
 def mint_multisearch_doi(query: Query) -> Tuple[bool, QueryDOI]:
     """
     Mint a DOI on datacite using their API and create a new QueryDOI object, saving it
@@ -223,6 +698,21 @@ def mint_multisearch_doi(query: Query) -> Tuple[bool, QueryDOI]:
     the one passed then we return the existing QueryDOI object and don't mint or insert
     anything.
 
+    If async minting is enabled, the QueryDOI is saved with a pending status and the
+    DataCite registration is handed off to a background job.
+
+    The row is inserted with a pending status before the DOI is registered and is only
+    marked as registered once DataCite has accepted it. If the registration fails, the
+    error is raised and the DOI is left pending. The registration is then attempted
+    again the next time the query is minted, so a pending DOI is never returned unless
+    async minting is enabled.
+
+    Concurrent calls for identical queries are coalesced using an advisory lock (see
+    mint_lock), the first call mints the DOI and the others wait for it and then return
+    it. If the wait times out, any DOI minted (and, unless async minting is enabled,
+    registered) for the query in the meantime is returned, otherwise a
+    MintLockTimeoutError is raised.
+
     This function handles DOIs created for the versioned datastore's multisearch action.
 
     :param query: the query
@@ -231,13 +721,186 @@ def mint_multisearch_doi(query: Query) -> Tuple[bool, QueryDOI]:
     """
     # check if there are any dois already for this query
     existing_doi = find_existing_doi(query)
-    if existing_doi is not None:
+    if existing_doi is not None and not needs_registration(existing_doi):
         return False, existing_doi
 
-    # generate a new DOI to store this query against
-    timestamp = datetime.now()
-    client = get_client()
-    doi = generate_doi(client)
-    create_doi_on_datacite(client, doi, timestamp, query)
-    query_doi = create_database_entry(doi, query, timestamp)
-    return True, query_doi
+    try:
+        with mint_lock(query):
+            # check again in case the DOI was minted while we were waiting for the lock
+            existing_doi = find_existing_doi(query)
+            if existing_doi is not None:
+                if needs_registration(existing_doi):
+                    # an earlier attempt to register the DOI failed, try again
+                    post_to_datacite(
+                        get_client(),
+                        existing_doi.doi,
+                        *create_registration(existing_doi),
+                    )
+                    mark_registered(existing_doi)
+                return False, existing_doi
+
+            # the row is inserted as pending before the DOI is registered, so that every
+            # DOI registered with DataCite has a row
+            doi = reserve_doi()
+            timestamp = datetime.now()
+            created, query_doi = insert_or_get(doi, query, timestamp, PENDING_STATUS)
+            if created:
+                if is_async_minting():
+                    queue_registration(query_doi)
+                else:
+                    create_doi_on_datacite(get_client(), doi, timestamp, query)
+                    mark_registered(query_doi)
+    except MintLockTimeoutError:
+        # the other process may have finished minting the DOI by now
+        existing_doi = find_existing_doi(query)
+        if existing_doi is None or needs_registration(existing_doi):
+            raise
+        return False, existing_doi
+    return created, query_doi
+
+
+@dataclass
+class MintResult:
+    """
+    The result of minting a DOI for one of the queries passed to mint_multisearch_dois.
+    """
+
+    # whether a new DOI was minted
+    created: bool = False
+    # the QueryDOI representing the query's DOI, if there is one
+    query_doi: Optional[QueryDOI] = None
+    # a description of the error, if the DOI couldn't be minted
+    error: Optional[str] = None
+
+
+def get_bulk_workers() -> int:
+    """
+    Gets the number of threads to use when registering DOIs with DataCite in bulk.
+
+    :returns: the number of threads
+    """
+    return max(
+        toolkit.asint(toolkit.config.get('ckanext.query_dois.bulk_mint_workers', 8)), 1
+    )
+
+
+def get_query_key(query: Query) -> tuple:
+    """
+    Creates a key for the query which is the same for all queries which would produce
+    identical data.
+
+    :param query: the query
+    :returns: a tuple
+    """
+    return query.query_hash, query.query_version, query.fingerprint
+
+
+def mint_multisearch_dois(queries: List[Query]) -> List[MintResult]:
+    """
+    Mints DOIs for many queries at once. This works in the same way as
+    mint_multisearch_doi, except that identical queries are only minted once and, if
+    async minting isn't enabled, the DataCite registrations are made in parallel using
+    the shared DataCite client.
+
+    No advisory locks are taken, if an identical query is minted elsewhere at the same
+    time the DOI inserted first is returned (see insert_or_get). The rows are inserted
+    with a pending status before the DOIs are registered and are only marked as
+    registered once DataCite has accepted them. If a registration fails, the DOI is left
+    pending and an error is returned for the query. Unless async minting is enabled,
+    the registration is attempted again the next time the query is minted.
+
+    Errors are captured for each query, so a failure doesn't stop the other queries
+    from being minted.
+
+    :param queries: the queries
+    :returns: a list of MintResult objects, one for each query in the same order. If a
+        query is repeated, only its first MintResult has created set to True
+    """
+    # keys -> MintResult objects, where the key identifies queries which would produce
+    # identical data (as in find_existing_doi)
+    results: Dict[tuple, MintResult] = {}
+    # keys -> (metadata, url) tuples
+    registrations = {}
+    async_minting = is_async_minting()
+
+    keys = []
+    # keys -> the first query with the key
+    unique_queries = {}
+    for index, query in enumerate(queries):
+        # creating the key uses the versioned datastore, so it can fail too
+        try:
+            key = get_query_key(query)
+            unique_queries.setdefault(key, query)
+        except Exception as e:
+            log.exception(f'Failed to mint a DOI for query {index}')
+            model.Session.rollback()
+            # a key which can't clash with the real keys
+            key = ('error', index)
+            results[key] = MintResult(error=f'Failed to mint DOI: {e}')
+        keys.append(key)
+
+    for key, query in unique_queries.items():
+        # an error minting one query shouldn't stop the others from being minted
+        try:
+            existing_doi = find_existing_doi(query)
+            if existing_doi is not None:
+                results[key] = MintResult(False, existing_doi)
+                if needs_registration(existing_doi):
+                    # an earlier attempt to register the DOI failed, try again
+                    registrations[key] = create_registration(existing_doi)
+                continue
+
+            # the row is always inserted as pending before the DOI is registered, so
+            # that every DOI registered with DataCite has a row, even if an identical
+            # query has been minted elsewhere in the meantime
+            doi = reserve_doi()
+            timestamp = datetime.now()
+            created, query_doi = insert_or_get(doi, query, timestamp, PENDING_STATUS)
+            results[key] = MintResult(created, query_doi)
+            if not created:
+                continue
+            if async_minting:
+                queue_registration(query_doi)
+            else:
+                # the metadata and URL need the CKAN context so they're created here,
+                # only the requests are made in the worker threads
+                registrations[key] = (
+                    create_datacite_metadata(doi, timestamp, query),
+                    get_doi_url(doi),
+                )
+        except Exception as e:
+            log.exception(f'Failed to mint a DOI for query {query.query_hash}')
+            model.Session.rollback()
+            results[key] = MintResult(error=f'Failed to mint DOI: {e}')
+
+    if registrations:
+        client = get_client()
+        with ThreadPoolExecutor(max_workers=get_bulk_workers()) as executor:
+            futures = {
+                key: executor.submit(
+                    post_to_datacite, client, results[key].query_doi.doi, metadata, url
+                )
+                for key, (metadata, url) in registrations.items()
+            }
+        for key, future in futures.items():
+            query_doi = results[key].query_doi
+            try:
+                future.result()
+                mark_registered(query_doi)
+            except Exception as e:
+                log.warning(
+                    f'Failed to register DOI {query_doi.doi} with DataCite, it has '
+                    f'been left pending: {e}'
+                )
+                model.Session.rollback()
+                results[key] = MintResult(error=f'Failed to register DOI: {e}')
+
+    minted = []
+    seen = set()
+    for key in keys:
+        result = results[key]
+        if key in seen and result.created:
+            result = MintResult(False, result.query_doi)
+        seen.add(key)
+        minted.append(result)
+    return minted
@@ -1,6 +1,13 @@
-import socket
+import logging
+import smtplib
+from typing import List
 
 from ckan.lib import mailer
+from ckan.plugins import toolkit
+
+from ckanext.query_dois.lib.jobs import enqueue, retry
+
+log = logging.getLogger(__name__)
 
 # TODO: put this in the config/interface so that it can be overridden
 # TODO: add html version of the body
@@ -17,17 +24,146 @@ Best wishes,
 The NHM Data Portal Bot
 """.strip()
 
+default_bulk_save_body = """
+Hello,
+
+As requested, DOIs have successfully been created for your searches.
+They will become available at the following links, though this can sometimes take a
+few hours:
+
+{}
+
+Please ensure that you cite these DOIs whenever you use this data! Follow the DOI links
+for more details.
+
+Best wishes,
+The NHM Data Portal Bot
+""".strip()
+
+
+def get_saved_search_body(dois: List[str]) -> str:
+    """
+    Creates the body of the email sent to a user when they save one or more searches.
+
+    :param dois: the dois (full, prefix and suffix)
+    :returns: the email body
+    """
+    if len(dois) == 1:
+        return default_save_body.format(dois[0])
+    return default_bulk_save_body.format(
+        '\n'.join(f'https://doi.org/{doi}' for doi in dois)
+    )
+
+
+def is_async_email() -> bool:
+    """
+    Checks whether saved search emails should be sent by a background job.
+
+    :returns: True if the emails should be sent by a background job, False if not
+    """
+    return toolkit.asbool(toolkit.config.get('ckanext.query_dois.async_emails', False))
+
+
+class TransientEmailError(Exception):
+    """
+    Raised when an email couldn't be sent because of an error which may not happen again
+    if the email is retried, such as the mail server being unavailable.
+    """
 
-def send_saved_search_email(email_address, doi):
-    # send the DOI to the user in an email
+    pass
+
+
+def is_transient_email_error(error: Exception) -> bool:
+    """
+    Checks whether the given error, raised when sending an email, is likely to be
+    temporary. Connection errors and 4xx SMTP replies are temporary, 5xx SMTP replies
+    (including recipients being refused with 5xx replies) and anything else aren't.
+
+    CKAN's mailer raises MailerExceptions in place of the underlying errors, so the
+    error they were raised from is checked instead.
+
+    :param error: the error
+    :returns: True if the email should be retried, False if not
+    """
+    if isinstance(error, mailer.MailerException):
+        error = error.__cause__ or error.__context__ or error
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _message in error.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, OSError))
+
+
+def mail_saved_search(email_address: str, dois: List[str]):
+    """
+    Sends the saved search email to the user using CKAN's mailer. Errors which are
+    likely to be temporary are raised as TransientEmailErrors (see
+    is_transient_email_error).
+
+    :param email_address: the user's email address
+    :param dois: the dois (full, prefix and suffix) to include in the email
+    """
     try:
         mailer.mail_recipient(
             recipient_email=email_address,
             recipient_name='DOI Requester',
-            subject='Query DOI created',
-            body=default_save_body.format(doi.doi),
+            subject='Query DOI created' if len(dois) == 1 else 'Query DOIs created',
+            body=get_saved_search_body(dois),
         )
+    except (mailer.MailerException, OSError) as e:
+        if is_transient_email_error(e):
+            raise TransientEmailError(str(e)) from e
+        raise
+
+
+def send_saved_search_email(email_address: str, *query_dois) -> bool:
+    """
+    Sends the saved search email listing the given DOIs to the user.
+
+    :param email_address: the user's email address
+    :param query_dois: the QueryDOI objects to include in the email
+    :returns: True if the email was sent, False if not
+    """
+    try:
+        mail_saved_search(email_address, [query_doi.doi for query_doi in query_dois])
         return True
-    except (mailer.MailerException, socket.error):
+    except (TransientEmailError, mailer.MailerException, OSError):
         # the error will be logged automatically by CKAN's mailing functions
         return False
+
+
+def deliver_saved_search_email(email_address: str, *dois: str):
+    """
+    Sends the saved search email to the user. This is run as a background job and
+    retries with an exponential backoff if the email can't be sent because of a
+    temporary error. Permanent errors, such as the recipient being refused, aren't
+    retried.
+
+    :param email_address: the user's email address
+    :param dois: the dois (full, prefix and suffix) to include in the email
+    """
+    attempts = toolkit.asint(toolkit.config.get('ckanext.query_dois.email_attempts', 5))
+    backoff = float(toolkit.config.get('ckanext.query_dois.email_backoff', 10))
+    retry(
+        lambda: mail_saved_search(email_address, list(dois)),
+        (TransientEmailError,),
+        attempts,
+        backoff,
+        f'send the saved search email for DOIs {", ".join(dois)}',
+    )
+
+
+def queue_saved_search_email(email_address: str, *query_dois):
+    """
+    Adds a background job to send the saved search email to the user.
+
+    :param email_address: the user's email address
+    :param query_dois: the QueryDOI objects to include in the email
+    """
+    dois = [query_doi.doi for query_doi in query_dois]
+    enqueue(
+        deliver_saved_search_email,
+        [email_address, *dois],
+        title=f'Send saved search email for {len(dois)} DOI(s)',
+    )
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-query-dois
+# Created by the Natural History Museum in London, UK
+
+import logging
+import time
+from typing import Callable, Tuple, Type
+
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+
+def get_queue() -> str:
+    """
+    Gets the name of the CKAN job queue to add this extension's background jobs to.
+
+    :returns: the queue name
+    """
+    return toolkit.config.get('ckanext.query_dois.queue', 'default')
+
+
+def enqueue(func: Callable, args: list, title: str):
+    """
+    Adds a job to CKAN's background job queue.
+
+    :param func: the function to run
+    :param args: the arguments to pass to the function
+    :param title: the title of the job
+    :returns: the job object
+    """
+    return toolkit.enqueue_job(func, args, title=title, queue=get_queue())
+
+
+def retry(
+    func: Callable,
+    errors: Tuple[Type[Exception], ...],
+    attempts: int,
+    backoff: float,
+    description: str,
+):
+    """
+    Calls the given function, retrying with an exponential backoff if it raises one of
+    the given errors. If the final attempt fails, its error is raised.
+
+    :param func: the function to call, it is passed no arguments
+    :param errors: the exception types which should cause a retry
+    :param attempts: the maximum number of times to call the function
+    :param backoff: the number of seconds to wait before the first retry, this doubles
+        after each subsequent failure
+    :param description: a description of what the function does, used when logging
+    :returns: the function's return value
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except errors as e:
+            if attempt >= attempts:
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            log.warning(
+                f'Failed to {description} (attempt {attempt}/{attempts}), retrying in '
+                f'{delay}s. Error: {e}'
+            )
+            time.sleep(delay)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-query-dois
+# Created by the Natural History Museum in London, UK
+
+from ckanext.query_dois.lib.cache import configured_cache
+
+# cache of (DOI, user name, language) tuples -> (template name, template context) tuples
+get_landing_page_cache = configured_cache('landing_page', 1000, 60)
+
+
+def invalidate_landing_page(doi: str):
+    """
+    Removes the cached landing pages for the given DOI, for all users. This should be
+    called whenever the DOI's usage stats or status change.
+
+    :param doi: the doi (full, prefix and suffix)
+    """
+    get_landing_page_cache().pop_where(lambda key: key[0] == doi)
+
+
+def invalidate_landing_pages():
+    """
+    Removes all the cached landing pages.
+
+    This should be called whenever a resource or package changes as any number of DOIs
+    could reference it.
+    """
+    get_landing_page_cache().clear()
@@ -4,23 +4,63 @@
 # This file is part of ckanext-query-dois
 # Created by the Natural History Museum in London, UK
 
-import itertools
+import hashlib
+import json
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from functools import cached_property, partial
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional, Set
 
 from ckan import model
 from ckan.plugins import toolkit
 from sqlalchemy import false
 
+from ckanext.query_dois.lib.cache import configured_cache
+from ckanext.query_dois.lib.utils import split_authors
+from ckanext.query_dois.lib.versions import round_versions
+
+# cache of resource IDs which have been confirmed as datastore resources
+get_datastore_resource_cache = configured_cache('datastore_resource', 10000, 300)
+
+
+def find_datastore_resources(resource_ids: Iterable[str]) -> Set[str]:
+    """
+    Given some resource IDs, return the set of resource IDs which are versioned
+    datastore resources. Each resource is checked with vds_resource_check, unless it has
+    recently been confirmed to be a versioned datastore resource. Only positive results
+    are remembered, so a resource which is added to the versioned datastore is
+    recognised straight away.
+
+    :param resource_ids: the resource IDs
+    :returns: a set of resource IDs
+    """
+    cache = get_datastore_resource_cache()
+    datastore_resource_ids = set()
+    unknown_resource_ids = []
+    for resource_id in resource_ids:
+        if resource_id in cache:
+            datastore_resource_ids.add(resource_id)
+        else:
+            unknown_resource_ids.append(resource_id)
+
+    if unknown_resource_ids:
+        # cache this action (with context) so that we don't have to retrieve it over
+        # and over again
+        is_datastore_resource = partial(toolkit.get_action('vds_resource_check'), {})
+        for resource_id in sorted(unknown_resource_ids):
+            if is_datastore_resource(dict(resource_id=resource_id)):
+                datastore_resource_ids.add(resource_id)
+                cache.set(resource_id, True)
+
+    return datastore_resource_ids
+
 
 def find_invalid_resources(resource_ids: List[str]) -> List[str]:
     """
     Given a list of resource IDs, return a list of resource IDs which are invalid.
     Resources are invalid if they are any of the following:
 
-        - not datastore active resources (checked with vds_resource_check)
+        - not datastore active resources (see find_datastore_resources)
         - not active
         - not in an active package
         - not in a public package
@@ -28,11 +68,7 @@ def find_invalid_resources(resource_ids: List[str]) -> List[str]:
     :param resource_ids: the resource IDs to check
     :returns: a list of resource IDs which failed the tests
     """
-    invalid_resource_ids = set()
-
-    # cache this action (with context) so that we don't have to retrieve it over and
-    # over again
-    is_datastore_resource = partial(toolkit.get_action('vds_resource_check'), {})
+    resource_ids = set(resource_ids)
 
     # retrieve all resource ids passed to this function that are also active, in an
     # active package and in a public package
@@ -45,12 +81,50 @@ def find_invalid_resources(resource_ids: List[str]) -> List[str]:
         .filter(model.Package.private == false())
         .with_entities(model.Resource.id)
     )
-    # go through each resource ID we found and check if they are datastore resources
-    for row in query:
-        if not is_datastore_resource(dict(resource_id=row.id)):
-            invalid_resource_ids.add(row.id)
+    resources = {row.id for row in query}
+
+    return sorted(resource_ids - find_datastore_resources(resources))
 
-    return sorted(invalid_resource_ids)
+
+def find_authors(resource_ids: List[str]) -> List[str]:
+    """
+    Given some resource ids, return a list of unique authors from the packages
+    associated with them. The package author values are split using split_authors, in
+    the order of the resource IDs.
+
+    :param resource_ids: the resource IDs
+    :returns: a list of authors
+    """
+    query = (
+        model.Session.query(model.Resource)
+        .join(model.Package)
+        .filter(model.Resource.id.in_(list(resource_ids)))
+        .with_entities(model.Resource.id, model.Package.author)
+    )
+    package_authors = {row.id: row.author for row in query}
+    return split_authors(
+        package_authors.get(resource_id) for resource_id in resource_ids
+    )
+
+
+def make_fingerprint(resources_and_versions: Dict[str, int]) -> str:
+    """
+    Creates a hash of the given resources and rounded versions which is the same for any
+    ordering of the resources. This is stored with each DOI so that existing DOIs can be
+    found using an index rather than by comparing the JSONB values.
+
+    The hash is the MD5 hex digest of "resource_id:version" pairs sorted by resource ID
+    and joined with commas, with the versions encoded as JSON. This must match the SQL
+    used to backfill the fingerprints in the database migration.
+
+    :param resources_and_versions: a dict of resource IDs to rounded versions
+    :returns: the hash
+    """
+    canonical = ','.join(
+        f'{resource_id}:{json.dumps(version)}'
+        for resource_id, version in sorted(resources_and_versions.items())
+    )
+    return hashlib.md5(canonical.encode('utf-8')).hexdigest()
 
 
 @dataclass(frozen=True)
@@ -63,6 +137,12 @@ class Query:
     version: int
     query: dict
     query_version: str
+    # the resource counts for this query, if they are already known
+    known_counts: Optional[Dict[str, int]] = field(
+        default=None, compare=False, repr=False
+    )
+    # the authors for this query, if they are already known
+    known_authors: Optional[List[str]] = field(default=None, compare=False, repr=False)
 
     @cached_property
     def query_hash(self) -> str:
@@ -76,43 +156,42 @@ class Query:
     @cached_property
     def authors(self) -> List[str]:
         """
-        Given some resource ids, return a list of unique authors from the packages
-        associated with them.
-
-        :returns: a list of authors
+        :returns: a list of the unique authors of the packages the resources are in
         """
-        query = (
-            model.Session.query(model.Resource)
-            .join(model.Package)
-            .filter(model.Resource.id.in_(self.resource_ids))
-            .with_entities(model.Package.author)
-        )
-        return list(set(itertools.chain.from_iterable(query)))
+        if self.known_authors is not None:
+            return list(self.known_authors)
+        return find_authors(self.resource_ids)
 
     @cached_property
     def resources_and_versions(self) -> Dict[str, int]:
         """
         Returns a dict containing the resource IDs as keys and their rounded versions as
-        values. The rounded versions are acquired via the vds_version_round action.
+        values. The rounded versions are calculated using each resource's (cached)
+        version list, see the versions module for details.
 
         :returns: a dict of resource IDs to rounded versions
         """
-        action = toolkit.get_action('vds_version_round')
-        return {
-            resource_id: action(
-                {}, {'resource_id': resource_id, 'version': self.version}
-            )
-            for resource_id in sorted(self.resource_ids)
-        }
+        return round_versions(self.resource_ids, self.version)
+
+    @cached_property
+    def fingerprint(self) -> str:
+        """
+        :returns: a hash of the resources and their rounded versions
+        """
+        return make_fingerprint(self.resources_and_versions)
 
     @cached_property
     def counts(self) -> Dict[str, int]:
         """
         Returns a dict containing the resource IDs as keys and the number of records
-        which match this query in the resource as the values.
+        which match this query in the resource as the values. If the counts are already
+        known they are used, otherwise they are retrieved via the vds_multi_count
+        action.
 
         :returns: a dict of resource ids to counts
         """
+        if self.known_counts is not None:
+            return dict(self.known_counts)
         data_dict = {
             'query': self.query,
             'query_version': self.query_version,
@@ -137,6 +216,7 @@ class Query:
         version: Optional[int] = None,
         query: Optional[dict] = None,
         query_version: Optional[str] = None,
+        check_resources: bool = True,
     ) -> 'Query':
         """
         Creates a Query object using the given parameters. The resource_ids are the only
@@ -148,15 +228,19 @@ class Query:
         :param query: the query to run (if missing, defaults to any empty query)
         :param query_version: the version of the query (if missing, defaults to the
             latest query schema version)
+        :param check_resources: whether to check the resources are valid, this can be
+            turned off if they have already been checked (default: True)
         :returns: a Query object
         """
-        invalid_resource_ids = find_invalid_resources(resource_ids)
+        invalid_resource_ids = (
+            find_invalid_resources(resource_ids) if check_resources else None
+        )
         if invalid_resource_ids:
             # not all of them were public/active
             raise toolkit.ValidationError(
                 f'Some of the resources requested are private or not active, DOIs can '
                 f'only be created using public, active resources. Invalid resources: '
-                f'{", ".format(invalid_resource_ids)}'
+                f'{", ".join(invalid_resource_ids)}'
             )
 
         # sort them to ensure comparisons work consistently
@@ -182,3 +266,21 @@ class Query:
             download_request.core_record.query,
             download_request.core_record.query_version,
         )
+
+    @classmethod
+    def from_query_doi(cls, query_doi) -> 'Query':
+        """
+        Recreates the Query that a QueryDOI was minted from. No validation is performed
+        on the resources and the saved resource counts and authors are used.
+
+        :param query_doi: a QueryDOI object
+        :returns: a Query object
+        """
+        return cls(
+            sorted(query_doi.get_resource_ids()),
+            query_doi.requested_version,
+            query_doi.query,
+            query_doi.query_version,
+            known_counts=query_doi.resource_counts,
+            known_authors=query_doi.authors,
+        )
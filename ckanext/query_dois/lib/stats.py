@@ -4,31 +4,59 @@
 # This file is part of ckanext-query-dois
 # Created by the Natural History Museum in London, UK
 
+import atexit
 import base64
+import fcntl
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
 import uuid
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 
 import bcrypt
+from ckan import model
+from ckan.plugins import toolkit
+from flask import has_request_context
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert
 
-from ckanext.query_dois.model import QueryDOIStat
+from ckanext.query_dois.lib.landing_pages import invalidate_landing_page
+from ckanext.query_dois.model import (
+    QueryDOIStat,
+    query_doi_identifier_alias_table,
+    query_doi_stat_table,
+    query_doi_table,
+    query_doi_usage_table,
+)
+
+log = logging.getLogger(__name__)
 
 # action types
 DOWNLOAD_ACTION = 'download'
 SAVE_ACTION = 'save'
 
+# anonymizer names
+BCRYPT_ANONYMIZER = 'bcrypt'
+HMAC_ANONYMIZER = 'hmac'
 
-def anonymize_email(email_address):
+# the fields stats can be grouped by when aggregating
+AGGREGATE_FIELDS = ('doi', 'action', 'domain', 'resource_id')
+# the date_trunc units stats can be bucketed by when aggregating
+AGGREGATE_BUCKETS = ('day', 'week', 'month')
+
+
+def split_email(email_address: str) -> Tuple[str, str]:
     """
-    Split the email address into it's identity and domain parts, then return the secure
-    hash of the identity and the domain. Bcrypt is used to securely hash the identity,
-    using the domain as the salt.
+    Lowercases the email address and splits the domain from it.
 
     :param email_address: the email address
-    :returns: a 2-tuple of the email address and the domain
+    :returns: a 2-tuple of the lowercased email address and the domain
     """
-    if email_address is None:
-        return None, None
-
     email_address = email_address.lower()
     # figure out the domain from the email address
     try:
@@ -36,19 +64,638 @@ def anonymize_email(email_address):
     except ValueError:
         # no @ found, just use the whole string
         domain = email_address
+    return email_address, domain
 
+
+def bcrypt_identifier(email_address: str, domain: str) -> str:
+    """
+    Creates an identifier from the email address by hashing it with bcrypt, using the
+    domain as the salt. This is slow by design (around 250ms of CPU).
+
+    The hash used to be stored as bytes which, as the identifier column is text,
+    postgres stored in its hex bytea format (a backslash and an x followed by the hex
+    digits of the hash). The identifier is returned in that format so that it still
+    matches the identifiers of existing stats.
+
+    :param email_address: the lowercased email address
+    :param domain: the email address's domain
+    :returns: the identifier
+    """
     # create a custom salt by base64 encoding the domain and then trimming the whole thing to 22
     # characters (which is bcrypt's required salt length). Note that we fill the right side of the
     # domain with dots to ensure it's at least 18 characters in length. This is necessary as we need
     # to ensure that the base64 encode result is at least 22 characters long and 18 is the minimum
     # input length necessary to create a base64 encoding result of at least 22 characters.
     salt = b'$2b$12$' + base64.b64encode(domain.zfill(18).encode('utf-8'))[:22]
-    return bcrypt.hashpw(email_address.encode('utf-8'), salt), domain
+    return '\\x' + bcrypt.hashpw(email_address.encode('utf-8'), salt).hex()
+
+
+def hmac_identifier(email_address: str, domain: str) -> str:
+    """
+    Creates an identifier from the email address using a keyed HMAC-SHA256 hash. The key
+    is read from the ckanext.query_dois.anonymizer_secret config option.
+
+    :param email_address: the lowercased email address
+    :param domain: the email address's domain (unused, the secret acts as the salt)
+    :returns: the identifier
+    """
+    secret = toolkit.config.get('ckanext.query_dois.anonymizer_secret')
+    return hmac.new(
+        secret.encode('utf-8'), email_address.encode('utf-8'), hashlib.sha256
+    ).hexdigest()
+
+
+# anonymizer names -> functions which create an identifier from an email address
+anonymizers = {
+    BCRYPT_ANONYMIZER: bcrypt_identifier,
+    HMAC_ANONYMIZER: hmac_identifier,
+}
+
+
+def get_anonymizer() -> str:
+    """
+    Retrieves the name of the anonymizer to use from the ckanext.query_dois.anonymizer
+    config option, checking that it's valid.
+
+    :returns: the name of the anonymizer
+    :raises ValueError: if the anonymizer isn't recognised or needs a secret which
+        hasn't been set
+    """
+    name = toolkit.config.get('ckanext.query_dois.anonymizer', BCRYPT_ANONYMIZER)
+    if name not in anonymizers:
+        raise ValueError(f'Unknown anonymizer: {name}')
+    if name == HMAC_ANONYMIZER and not toolkit.config.get(
+        'ckanext.query_dois.anonymizer_secret'
+    ):
+        raise ValueError(
+            'ckanext.query_dois.anonymizer_secret must be set to use the hmac '
+            'anonymizer'
+        )
+    return name
+
+
+def resolve_legacy_identifier(identifier: str, email_address: str, domain: str) -> str:
+    """
+    Finds the identifier to store for an email address anonymized with the hmac
+    anonymizer. If stats have been recorded for the email address by the legacy bcrypt
+    anonymizer then its bcrypt identifier is returned so that all the user's stats can
+    still be grouped together, otherwise the hmac identifier is returned.
+
+    Whether an email address has a legacy identifier is recorded in the
+    query_doi_identifier_alias table the first time it's seen, so the slow bcrypt hash
+    is only ever computed once for each email address. This can be turned off by setting
+    ckanext.query_dois.anonymizer_legacy_aliases to false.
+
+    :param identifier: the hmac identifier
+    :param email_address: the lowercased email address
+    :param domain: the email address's domain
+    :returns: the identifier to store
+    """
+    if not toolkit.asbool(
+        toolkit.config.get('ckanext.query_dois.anonymizer_legacy_aliases', True)
+    ):
+        return identifier
+
+    aliases = query_doi_identifier_alias_table
+    row = model.Session.execute(
+        select([aliases.c.legacy_identifier]).where(aliases.c.identifier == identifier)
+    ).first()
+    if row is None:
+        legacy_identifier = bcrypt_identifier(email_address, domain)
+        has_legacy_stats = model.Session.execute(
+            select([query_doi_stat_table.c.id])
+            .where(query_doi_stat_table.c.identifier == legacy_identifier)
+            .limit(1)
+        ).first()
+        if has_legacy_stats is None:
+            legacy_identifier = None
+        # insert the alias in its own transaction so that it's committed even if the
+        # stat isn't written to the database straight away
+        with model.meta.engine.begin() as connection:
+            connection.execute(
+                insert(aliases)
+                .values(identifier=identifier, legacy_identifier=legacy_identifier)
+                .on_conflict_do_nothing()
+            )
+    else:
+        legacy_identifier = row.legacy_identifier
+    return legacy_identifier or identifier
+
+
+def anonymize_email(email_address):
+    """
+    Split the email address into it's identity and domain parts, then return an
+    anonymous identifier created from the email address and the domain. The identifier
+    is created by the anonymizer set in the ckanext.query_dois.anonymizer config option,
+    either "bcrypt" (the default) or "hmac".
+
+    :param email_address: the email address
+    :returns: a 2-tuple of the identifier and the domain
+    """
+    if email_address is None:
+        return None, None
+
+    email_address, domain = split_email(email_address)
+    name = get_anonymizer()
+    identifier = anonymizers[name](email_address, domain)
+    if name == HMAC_ANONYMIZER:
+        identifier = resolve_legacy_identifier(identifier, email_address, domain)
+    return identifier, domain
+
+
+def upsert_usage(usages: List[dict]):
+    """
+    Creates a statement which adds the given counts to the DOIs' usage totals, creating
+    the totals if necessary. Each DOI can only appear once in the usages.
+
+    :param usages: dicts of doi, download_count, save_count and last_download_at values
+    :returns: an insert statement
+    """
+    table = query_doi_usage_table
+    statement = insert(table).values(usages)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.doi],
+        set_={
+            'download_count': table.c.download_count
+            + statement.excluded.download_count,
+            'save_count': table.c.save_count + statement.excluded.save_count,
+            # greatest ignores nulls
+            'last_download_at': func.greatest(
+                table.c.last_download_at, statement.excluded.last_download_at
+            ),
+        },
+    )
+
+
+def update_usage(
+    doi: str, downloads: int, saves: int, last_download_at: Optional[datetime]
+):
+    """
+    Adds the given counts to the DOI's usage totals, creating the totals if necessary.
+    This is executed on the current session and isn't committed, allowing it to be
+    committed in the same transaction as the stats it reflects.
+
+    :param doi: the doi (full, prefix and suffix)
+    :param downloads: the number of downloads to add
+    :param saves: the number of saves to add
+    :param last_download_at: the timestamp of the latest download being added, or None
+        if no downloads are being added
+    """
+    usage = dict(
+        doi=doi,
+        download_count=downloads,
+        save_count=saves,
+        last_download_at=last_download_at,
+    )
+    model.Session.execute(upsert_usage([usage]))
+
+
+def write_stats(stats: List[dict]):
+    """
+    Inserts the given stats into the database in a single statement and updates the
+    usage totals of their DOIs, all in one transaction. This uses its own connection
+    rather than the current session so that it can be called from any thread.
+
+    :param stats: dicts of doi, action, domain, identifier and timestamp values
+    """
+    # doi -> usage dict, postgres won't update the same row twice in one upsert so the
+    # totals for each doi have to be combined first
+    usages = {}
+    for stat in stats:
+        usage = usages.setdefault(
+            stat['doi'],
+            dict(
+                doi=stat['doi'],
+                download_count=0,
+                save_count=0,
+                last_download_at=None,
+            ),
+        )
+        if stat['action'] == DOWNLOAD_ACTION:
+            usage['download_count'] += 1
+            if (
+                usage['last_download_at'] is None
+                or usage['last_download_at'] < stat['timestamp']
+            ):
+                usage['last_download_at'] = stat['timestamp']
+        elif stat['action'] == SAVE_ACTION:
+            usage['save_count'] += 1
+
+    with model.meta.engine.begin() as connection:
+        connection.execute(insert(query_doi_stat_table).values(stats))
+        connection.execute(upsert_usage(list(usages.values())))
+
+
+class StatWriter:
+    """
+    Buffers stats in memory and writes them to the database in batches, rather than
+    committing each one as it is recorded.
+
+    The buffer is flushed when it reaches the maximum size, when the oldest stat in it
+    has been waiting for the flush interval and when the process exits. If a flush
+    fails, the stats are kept and retried after the interval, up to the buffer limit.
+    """
+
+    def __init__(self, max_size: int, interval: float, limit: int):
+        """
+        :param max_size: the number of stats to buffer before flushing
+        :param interval: the maximum number of seconds a stat is buffered for
+        :param limit: the maximum number of stats to keep while flushes are failing,
+            the oldest stats are dropped to stay under it
+        """
+        self.max_size = max_size
+        self.interval = interval
+        self.limit = max(limit, max_size)
+        self._stats = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _start_timer(self):
+        # must be called with the lock held
+        if self._timer is None:
+            self._timer = threading.Timer(self.interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def add(self, stat: dict):
+        """
+        Adds the stat to the buffer, flushing the buffer if it is now full.
+
+        :param stat: a dict of doi, action, domain, identifier and timestamp values
+        """
+        with self._lock:
+            self._stats.append(stat)
+            is_full = len(self._stats) >= self.max_size
+            if not is_full:
+                self._start_timer()
+        if is_full:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Writes all the buffered stats to the database and removes any cached landing
+        pages for their DOIs. If the write fails, the stats are put back in the buffer
+        to be retried after the flush interval. If this takes the buffer over its limit,
+        the oldest stats are dropped.
+
+        :returns: the number of stats written
+        """
+        with self._lock:
+            stats, self._stats = self._stats, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not stats:
+            return 0
+
+        try:
+            write_stats(stats)
+        except Exception:
+            log.exception(f'Failed to write {len(stats)} stats, will retry')
+            with self._lock:
+                self._stats[:0] = stats
+                dropped = len(self._stats) - self.limit
+                if dropped > 0:
+                    log.error(
+                        f'Stat buffer is full, dropped the {dropped} oldest stats'
+                    )
+                    del self._stats[:dropped]
+                self._start_timer()
+            return 0
+
+        for doi in {stat['doi'] for stat in stats}:
+            invalidate_landing_page(doi)
+        return len(stats)
+
+    def __len__(self) -> int:
+        """
+        :returns: the number of stats in the buffer
+        """
+        with self._lock:
+            return len(self._stats)
+
+
+class StatSpool:
+    """
+    Buffers stats in a file on the local disk and writes them to the database in
+    batches. This is used by processes which can't hold stats in memory until the next
+    batch is written, such as rq's work horses, which each run a single job (and so
+    only record one or two stats) before exiting without running any atexit handlers.
+
+    The spool can be shared by any number of processes on the same host, access to it
+    is serialised using a file lock. When a stat is added, the spool is flushed if it
+    has reached the maximum size or the oldest stat in it has been waiting for the
+    flush interval. It can also be flushed using the flush-stats CLI command. If a
+    flush fails, the stats are kept in the spool to be retried, up to the limit.
+    """
+
+    def __init__(self, directory: str, max_size: int, interval: float, limit: int):
+        """
+        :param directory: the directory to keep the spool in, created if needed
+        :param max_size: the number of stats to spool before flushing
+        :param interval: the number of seconds after which a stat is flushed by the
+            next stat added
+        :param limit: the maximum number of stats to keep while flushes are failing,
+            the oldest stats are dropped to stay under it
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'stats.ndjson')
+        self.lock_path = os.path.join(directory, 'stats.lock')
+        self.max_size = max_size
+        self.interval = interval
+        self.limit = max(limit, max_size)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self) -> List[dict]:
+        # must be called with the lock held
+        stats = []
+        try:
+            with open(self.path) as spool:
+                for line in spool:
+                    try:
+                        stat = json.loads(line)
+                    except ValueError:
+                        # a process died while writing this line, it can't be recovered
+                        log.warning('Skipping a partially written spooled stat')
+                        continue
+                    stat['timestamp'] = datetime.fromisoformat(stat['timestamp'])
+                    stats.append(stat)
+        except FileNotFoundError:
+            pass
+        return stats
+
+    @staticmethod
+    def _encode(stat: dict) -> str:
+        return json.dumps({**stat, 'timestamp': stat['timestamp'].isoformat()}) + '\n'
+
+    def _write(self, stats: List[dict]):
+        # must be called with the lock held
+        with open(self.path, 'w') as spool:
+            spool.writelines(map(self._encode, stats))
+
+    def add(self, stat: dict):
+        """
+        Adds the stat to the spool, flushing the spool if it is now full or its oldest
+        stat has been waiting for the flush interval.
+
+        :param stat: a dict of doi, action, domain, identifier and timestamp values
+        """
+        with self._locked():
+            with open(self.path, 'a') as spool:
+                spool.write(self._encode(stat))
+            stats = self._read()
+            age = (datetime.now() - stats[0]['timestamp']).total_seconds()
+            if len(stats) >= self.max_size or age >= self.interval:
+                self._flush(stats)
+
+    def flush(self) -> int:
+        """
+        Writes all the spooled stats to the database and removes any cached landing
+        pages for their DOIs. If the write fails, the stats are left in the spool to be
+        retried by the next flush. If this takes the spool over its limit, the oldest
+        stats are dropped.
+
+        :returns: the number of stats written
+        """
+        with self._locked():
+            return self._flush(self._read())
+
+    def _flush(self, stats: List[dict]) -> int:
+        # must be called with the lock held, the lock is held while the stats are
+        # written so that they can't be written twice by concurrent flushes
+        if not stats:
+            return 0
+        try:
+            write_stats(stats)
+        except Exception:
+            log.exception(f'Failed to write {len(stats)} spooled stats, will retry')
+            dropped = len(stats) - self.limit
+            if dropped > 0:
+                log.error(f'Stat spool is full, dropped the {dropped} oldest stats')
+                self._write(stats[dropped:])
+            return 0
+        os.remove(self.path)
+
+        for doi in {stat['doi'] for stat in stats}:
+            invalidate_landing_page(doi)
+        return len(stats)
+
+    def __len__(self) -> int:
+        """
+        :returns: the number of stats in the spool
+        """
+        with self._locked():
+            return len(self._read())
+
+
+def get_buffer_config() -> Tuple[int, float, int]:
+    """
+    Gets the stat buffer size, flush interval and limit from the config. These are
+    shared by the StatWriter and the StatSpool.
+
+    :returns: the size (0 if buffering is disabled), interval and limit
+    """
+    size = toolkit.asint(toolkit.config.get('ckanext.query_dois.stat_buffer_size', 0))
+    interval = float(toolkit.config.get('ckanext.query_dois.stat_flush_interval', 5))
+    limit = toolkit.asint(
+        toolkit.config.get('ckanext.query_dois.stat_buffer_limit', size * 10)
+    )
+    return size, interval, limit
+
+
+_stat_writer = None
+_stat_writer_lock = threading.Lock()
+
+
+def get_stat_writer() -> Optional[StatWriter]:
+    """
+    Returns the StatWriter stats should be buffered in, creating it from the config on
+    the first call. Buffering is enabled by setting ckanext.query_dois.stat_buffer_size
+    to more than 0, the flush interval is set by ckanext.query_dois.stat_flush_interval
+    (defaults to 5 seconds) and the number of stats kept while flushes are failing by
+    ckanext.query_dois.stat_buffer_limit (defaults to 10 times the buffer size).
+
+    Stats are only buffered in memory while handling a web request, see record_stat.
+
+    :returns: the StatWriter or None if stats shouldn't be buffered
+    """
+    global _stat_writer
+    with _stat_writer_lock:
+        if _stat_writer is None:
+            size, interval, limit = get_buffer_config()
+            if size < 1:
+                return None
+            _stat_writer = StatWriter(size, interval, limit)
+            # make sure nothing is left in the buffer when the process stops
+            atexit.register(_stat_writer.flush)
+        return _stat_writer
+
+
+_stat_spool = None
+_stat_spool_lock = threading.Lock()
+
+
+def get_stat_spool() -> Optional[StatSpool]:
+    """
+    Returns the StatSpool stats recorded outside of web requests should be buffered in,
+    creating it from the config on the first call. Spooling is enabled by setting
+    ckanext.query_dois.stat_spool_dir as well as ckanext.query_dois.stat_buffer_size,
+    the spool uses the same size, flush interval and limit as the in memory buffer (see
+    get_stat_writer).
+
+    :returns: the StatSpool or None if stats shouldn't be spooled
+    """
+    global _stat_spool
+    with _stat_spool_lock:
+        if _stat_spool is None:
+            directory = toolkit.config.get('ckanext.query_dois.stat_spool_dir')
+            size, interval, limit = get_buffer_config()
+            if not directory or size < 1:
+                return None
+            _stat_spool = StatSpool(directory, size, interval, limit)
+        return _stat_spool
+
+
+def rebuild_usage() -> int:
+    """
+    Rebuilds the usage totals of every DOI from the recorded stats.
+
+    :returns: the number of DOIs with usage totals
+    """
+    stats = query_doi_stat_table
+    is_download = stats.c.action == DOWNLOAD_ACTION
+    is_save = stats.c.action == SAVE_ACTION
+    totals = (
+        select(
+            [
+                stats.c.doi,
+                func.count(stats.c.id).filter(is_download),
+                func.count(stats.c.id).filter(is_save),
+                func.max(stats.c.timestamp).filter(is_download),
+            ]
+        )
+        .where(stats.c.action.in_([DOWNLOAD_ACTION, SAVE_ACTION]))
+        .group_by(stats.c.doi)
+    )
+    usage = query_doi_usage_table
+    model.Session.execute(usage.delete())
+    result = model.Session.execute(
+        usage.insert().from_select(
+            [
+                usage.c.doi,
+                usage.c.download_count,
+                usage.c.save_count,
+                usage.c.last_download_at,
+            ],
+            totals,
+        )
+    )
+    model.Session.commit()
+    return result.rowcount
+
+
+def aggregate_stats(
+    group_by: List[str],
+    bucket: Optional[str] = None,
+    filters: Optional[Dict[str, str]] = None,
+    resource_id: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> List[dict]:
+    """
+    Counts the stats matching the given filters, grouped by the given fields and,
+    optionally, by the time period they were recorded in. The counting is all done in
+    the database.
+
+    When grouping by resource_id, each stat is counted once for each resource its DOI
+    covers.
+
+    :param group_by: the fields to group by, each must be one of AGGREGATE_FIELDS
+    :param bucket: the time period to group by, one of AGGREGATE_BUCKETS, or None to not
+        group by time
+    :param filters: a dict of stat column names -> values the stats must match
+    :param resource_id: only count stats for DOIs which include this resource
+    :param start: only count stats recorded at or after this time
+    :param end: only count stats recorded before this time
+    :returns: a list of dicts, one per group, containing the group_by field values, the
+        start of the time period under "period" (if a bucket was given) and the number
+        of stats under "count"
+    :raises ValueError: if a group_by field or the bucket isn't valid
+    """
+    invalid = [name for name in group_by if name not in AGGREGATE_FIELDS]
+    if invalid:
+        raise ValueError(f'Invalid group_by fields: {", ".join(invalid)}')
+    if bucket is not None and bucket not in AGGREGATE_BUCKETS:
+        raise ValueError(f'Invalid bucket: {bucket}')
+
+    stats = query_doi_stat_table
+    dois = query_doi_table
+
+    columns = [stats.c.doi, stats.c.action, stats.c.domain, stats.c.timestamp]
+    source = stats
+    if resource_id or 'resource_id' in group_by:
+        source = stats.join(dois, dois.c.doi == stats.c.doi)
+    if 'resource_id' in group_by:
+        # this expands each stat into a row per resource on its DOI
+        columns.append(
+            func.jsonb_object_keys(dois.c.resources_and_versions).label('resource_id')
+        )
+
+    statement = select(columns).select_from(source)
+    for name, value in (filters or {}).items():
+        statement = statement.where(stats.c[name] == value)
+    if resource_id:
+        statement = statement.where(dois.c.resources_and_versions.has_key(resource_id))
+    if start is not None:
+        statement = statement.where(stats.c.timestamp >= start)
+    if end is not None:
+        statement = statement.where(stats.c.timestamp < end)
+    matched = statement.alias('matched')
+
+    groups = [matched.c[name] for name in group_by]
+    if bucket:
+        # the unit is inlined, rather than bound, so that Postgres can see the selected
+        # expression is the same as the grouped one
+        groups.insert(
+            0,
+            func.date_trunc(literal_column(f"'{bucket}'"), matched.c.timestamp).label(
+                'period'
+            ),
+        )
+    query = select(groups + [func.count().label('count')]).group_by(*groups)
+    query = query.order_by(*groups)
+
+    results = []
+    for row in model.Session.execute(query):
+        result = {name: row[name] for name in group_by}
+        if bucket:
+            result['period'] = row['period'].isoformat()
+        result['count'] = row['count']
+        results.append(result)
+    return results
 
 
 def record_stat(query_doi, action, email_address=None, domain=None, identifier=None):
     """
-    Creates a new QueryDOIStat object and saves it to the database.
+    Creates a new QueryDOIStat object and saves it to the database, updating the DOI's
+    usage totals at the same time. Any cached landing pages for the DOI are removed as
+    their usage stats are now out of date.
+
+    If stat buffering is enabled (see get_stat_writer) and the stat is being recorded
+    while handling a web request, the stat is added to the buffer instead and the
+    returned QueryDOIStat object is not saved. Stats recorded outside of web requests,
+    such as in background jobs, can't be buffered in memory as those processes can exit
+    without flushing the buffer (rq's work horses exit with os._exit, skipping any
+    atexit handlers), so they are added to the local spool instead if it is enabled
+    (see get_stat_spool), otherwise they are written straight away.
 
     :param query_doi: the QueryDOI object against which the stat should be stored
     :param action: the action that occurred to trigger this stat (for example:
@@ -64,12 +711,29 @@ def record_stat(query_doi, action, email_address=None, domain=None, identifier=N
         # just a random uuid if nothing else is specified, so we don't end up grouping
         # many unrelated users together under the identifier of "None"
         identifier = uuid.uuid4().hex
-    stat = QueryDOIStat(
+    values = dict(
         doi=query_doi.doi,
         action=action,
         domain=domain,
         identifier=identifier,
         timestamp=datetime.now(),
     )
-    stat.save()
+
+    stat_writer = get_stat_writer() if has_request_context() else get_stat_spool()
+    if stat_writer is not None:
+        stat_writer.add(values)
+        return QueryDOIStat(**values)
+
+    stat = QueryDOIStat(**values)
+    model.Session.add(stat)
+    # update the usage totals in the same transaction as the stat is added in
+    is_download = action == DOWNLOAD_ACTION
+    update_usage(
+        query_doi.doi,
+        int(is_download),
+        int(action == SAVE_ACTION),
+        stat.timestamp if is_download else None,
+    )
+    model.Session.commit()
+    invalidate_landing_page(query_doi.doi)
     return stat
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-query-dois
+# Created by the Natural History Museum in London, UK
+
+from typing import Iterable, List, Optional
+
+from ckan import model
+from sqlalchemy import or_
+
+from ckanext.query_dois.lib.cache import configured_cache
+from ckanext.query_dois.lib.utils import can_show_package
+
+# cache of (package ID, number of DOIs) tuples -> DOISummary objects
+get_doi_summary_cache = configured_cache('doi_summary', 1000, 60)
+
+
+def get_visible_package_id(package_id: str) -> Optional[str]:
+    """
+    Finds the given package and checks that the current user is allowed to see it.
+    Public, active packages can be seen by everyone, so package_show access is only
+    checked for the other packages.
+
+    :param package_id: the package's ID or name
+    :returns: the package's ID, or None if it doesn't exist or the user can't see it
+    """
+    row = (
+        model.Session.query(
+            model.Package.id, model.Package.state, model.Package.private
+        )
+        .filter(or_(model.Package.id == package_id, model.Package.name == package_id))
+        .first()
+    )
+    if row is None:
+        return None
+    if (row.state == 'active' and not row.private) or can_show_package(row.id):
+        return row.id
+    return None
+
+
+def get_package_resource_ids(package_id: str) -> List[str]:
+    """
+    Retrieves the IDs of the active resources in the given package. No access checks are
+    made, see get_visible_package_id.
+
+    :param package_id: the package's ID
+    :returns: a list of resource IDs, empty if the package doesn't exist
+    """
+    rows = model.Session.query(model.Resource.id).filter(
+        model.Resource.package_id == package_id, model.Resource.state == 'active'
+    )
+    return [resource_id for (resource_id,) in rows]
+
+
+def invalidate_doi_summaries(resource_ids: Iterable[str]):
+    """
+    Removes the cached DOI summaries of the packages containing the given resources.
+    This should be called whenever a DOI is created on the resources.
+
+    :param resource_ids: the resource IDs
+    """
+    rows = (
+        model.Session.query(model.Resource.package_id)
+        .filter(model.Resource.id.in_(list(resource_ids)))
+        .distinct()
+    )
+    package_ids = {package_id for (package_id,) in rows}
+    if package_ids:
+        get_doi_summary_cache().pop_where(lambda key: key[0] in package_ids)
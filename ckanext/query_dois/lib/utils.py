@@ -4,6 +4,8 @@
 # This file is part of ckanext-query-dois
 # Created by the Natural History Museum in London, UK
 
+from typing import Iterable, List, Optional
+
 from ckan.plugins import toolkit
 
 
@@ -17,3 +19,42 @@ def get_resource_and_package(resource_id):
     resource = toolkit.get_action('resource_show')({}, {'id': resource_id})
     package = toolkit.get_action('package_show')({}, {'id': resource['package_id']})
     return resource, package
+
+
+def can_show_package(package_id):
+    """
+    Checks whether the current user is allowed to see the given package.
+
+    :param package_id: the package id
+    :returns: True if the user can see the package, False if not
+    """
+    try:
+        toolkit.check_access(
+            'package_show', {'user': toolkit.c.user}, {'id': package_id}
+        )
+        return True
+    except (toolkit.ObjectNotFound, toolkit.NotAuthorized):
+        return False
+
+
+def split_authors(author_values: Iterable[Optional[str]]) -> List[str]:
+    """
+    Splits the given package author values into a list of unique authors, in the order
+    they first appear. Author values which contain many authors must separate them with
+    a ;, commas aren't treated as separators because they appear in single authors
+    (e.g. "Smith, John" or "Natural History Museum, London"). Empty values and
+    whitespace around the authors are removed.
+
+    :param author_values: package author values, which may be None
+    :returns: a list of authors
+    """
+    # use a dict in the absence of an ordered set
+    authors = {}
+    for value in author_values:
+        if not value:
+            continue
+        for author in value.split(';'):
+            author = author.strip()
+            if author:
+                authors[author] = True
+    return list(authors)
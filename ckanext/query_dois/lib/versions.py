@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-query-dois
+# Created by the Natural History Museum in London, UK
+
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from ckan.plugins import toolkit
+
+from ckanext.query_dois.lib.cache import configured_cache
+
+# cache of resource IDs -> ResourceVersions objects
+get_resource_versions_cache = configured_cache('resource_versions', 1000)
+
+
+@dataclass(frozen=True)
+class ResourceVersions:
+    """
+    The versions available on a resource at the time they were retrieved.
+    """
+
+    # the versions, sorted in ascending order
+    versions: List[int]
+
+    def can_round(self, version: int) -> bool:
+        """
+        Check whether the given version can be rounded using these versions. A
+        resource's versions are only ever appended to, therefore if the version is at
+        or below the latest version we hold then rounding it will always give the same
+        answer. Versions above the latest version we hold can't be rounded, as the
+        resource may have gained a new version since these versions were retrieved (and
+        the cache is only invalidated in the process which indexed the resource).
+
+        :param version: the version to round
+        :returns: True if the version can be rounded using these versions, False if not
+        """
+        return bool(self.versions) and version <= self.versions[-1]
+
+    def round(self, version: int) -> Optional[int]:
+        """
+        Rounds the given version down to the nearest version available on the resource.
+
+        :param version: the version to round
+        :returns: the rounded version, or None if there are no versions at or below the
+            given version
+        """
+        index = bisect_right(self.versions, version)
+        return self.versions[index - 1] if index else None
+
+
+def get_resource_versions(resource_id: str) -> ResourceVersions:
+    """
+    Retrieves the versions available on the given resource from the versioned
+    datastore.
+
+    :param resource_id: the resource ID
+    :returns: a ResourceVersions object
+    """
+    versions = toolkit.get_action('vds_version_resource')(
+        {}, {'resource_id': resource_id}
+    )
+    # the versions may come back as just the version ints or as dicts of details about
+    # each version, we only care about the versions themselves
+    versions = sorted(
+        int(version['version'] if isinstance(version, dict) else version)
+        for version in versions
+    )
+    return ResourceVersions(versions)
+
+
+def round_versions(
+    resource_ids: Iterable[str], version: int
+) -> Dict[str, Optional[int]]:
+    """
+    Rounds the given version down to the nearest available version on each of the
+    given resources. The versions of each resource are cached and only retrieved from
+    the versioned datastore if we don't have them already or the version is newer than
+    the latest one we hold.
+
+    :param resource_ids: the resource IDs
+    :param version: the version to round
+    :returns: a dict of resource IDs -> rounded versions
+    """
+    cache = get_resource_versions_cache()
+    rounded = {}
+    for resource_id in sorted(resource_ids):
+        resource_versions = cache.get(resource_id)
+        if resource_versions is None or not resource_versions.can_round(version):
+            resource_versions = get_resource_versions(resource_id)
+            cache.set(resource_id, resource_versions)
+        rounded[resource_id] = resource_versions.round(version)
+    return rounded
+
+
+def invalidate_resource_versions(resource_id: str):
+    """
+    Removes any cached versions for the given resource. This should be called whenever
+    the resource gains a new version.
+
+    :param resource_id: the resource ID
+    """
+    get_resource_versions_cache().pop(resource_id)
@@ -6,10 +6,14 @@
 
 from ckan.plugins import toolkit
 
-from ckanext.query_dois.lib.doi import mint_multisearch_doi
-from ckanext.query_dois.lib.emails import send_saved_search_email
-from ckanext.query_dois.lib.query import Query
-from ckanext.query_dois.lib.stats import SAVE_ACTION, record_stat
+from ckanext.query_dois.lib.doi import mint_multisearch_doi, mint_multisearch_dois
+from ckanext.query_dois.lib.emails import (
+    is_async_email,
+    queue_saved_search_email,
+    send_saved_search_email,
+)
+from ckanext.query_dois.lib.query import Query, find_invalid_resources
+from ckanext.query_dois.lib.stats import SAVE_ACTION, anonymize_email, record_stat
 from ckanext.query_dois.logic import schema as schema_lib
 
 
@@ -32,8 +36,9 @@ def create_doi(context, data_dict):
     :param is_new: whether the doi was newly created or whether an existing DOI for the
         query parameters already existed
     :type is_new: bool
-    :param email_sent: whether the email was sent successfully or not
-    :type email_sent: bool
+    :param email_sent: whether the email was sent successfully or not, or "queued" if
+        the email will be sent by a background job
+    :type email_sent: bool or string
     :rtype: dict
     """
     # validate the data dict first
@@ -55,6 +60,107 @@ def create_doi(context, data_dict):
     # record a stat for this action
     record_stat(doi, SAVE_ACTION, email_address)
     # send the email to the requesting user
-    email_sent = send_saved_search_email(email_address, doi)
+    if is_async_email():
+        queue_saved_search_email(email_address, doi)
+        email_sent = 'queued'
+    else:
+        email_sent = send_saved_search_email(email_address, doi)
 
     return {'is_new': created, 'doi': doi.doi, 'email_sent': email_sent}
+
+
+def create_dois_bulk(context, data_dict):
+    """
+    Creates DOIs for many queries at once and returns them. Each query is specified in
+    the same way as for the create_doi action. The resources of all the queries are
+    validated together, identical queries are only minted once and the new DOIs are
+    registered with DataCite in parallel. If an email address is given, a single email
+    listing all the DOIs is sent to it.
+
+    :param queries: the queries to create DOIs for, each a dict with a resource_ids list
+        and optional query, query_version and version values (see create_doi)
+    :type queries: list of dicts
+    :param email_address: the email address of the DOI requester (optional)
+    :type email_address: string
+    :param results: a result for each query, in the same order as the queries. Each is a
+        dict containing the doi and is_new (see create_doi), or an error if a DOI
+        couldn't be created for the query
+    :type results: list of dicts
+    :param email_sent: whether the email was sent successfully or not, or "queued" if
+        the email will be sent by a background job. None if no email address was given
+    :type email_sent: bool or string
+    :rtype: dict
+    """
+    toolkit.check_access('create_dois_bulk', context, data_dict)
+
+    # validate the data dict first
+    schema = context.get('schema', schema_lib.create_dois_bulk())
+    data_dict, errors = toolkit.navl_validate(data_dict, schema, context)
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    specs = data_dict.get('queries', [])
+    max_queries = toolkit.asint(
+        toolkit.config.get('ckanext.query_dois.bulk_max_queries', 1000)
+    )
+    if not specs or len(specs) > max_queries:
+        raise toolkit.ValidationError(
+            {'queries': [f'Between 1 and {max_queries} queries must be provided']}
+        )
+
+    # check all the resources in one go
+    invalid_resource_ids = set(
+        find_invalid_resources(set().union(*(spec['resource_ids'] for spec in specs)))
+    )
+    # only look up the latest query version once, if it's needed
+    latest_query_version = None
+
+    results = [None] * len(specs)
+    # indexes of the queries which can be minted -> Query objects
+    queries = {}
+    for index, spec in enumerate(specs):
+        invalid = invalid_resource_ids.intersection(spec['resource_ids'])
+        if invalid:
+            results[index] = {
+                'error': f'Some of the resources requested are private or not active, '
+                f'DOIs can only be created using public, active resources. Invalid '
+                f'resources: {", ".join(sorted(invalid))}'
+            }
+            continue
+        query_version = spec.get('query_version')
+        if not query_version:
+            if latest_query_version is None:
+                latest_query_version = toolkit.get_action('vds_schema_latest')({}, {})
+            query_version = latest_query_version
+        queries[index] = Query.create(
+            spec['resource_ids'],
+            spec.get('version'),
+            spec.get('query'),
+            query_version,
+            check_resources=False,
+        )
+
+    minted = dict(zip(queries, mint_multisearch_dois(list(queries.values()))))
+
+    # only anonymize the email address once
+    identifier, domain = anonymize_email(data_dict.get('email_address'))
+    query_dois = {}
+    for index, result in minted.items():
+        if result.error:
+            results[index] = {'error': result.error}
+            continue
+        results[index] = {'is_new': result.created, 'doi': result.query_doi.doi}
+        record_stat(result.query_doi, SAVE_ACTION, domain=domain, identifier=identifier)
+        query_dois[result.query_doi.doi] = result.query_doi
+
+    # send one email to the requesting user listing all the dois
+    email_address = data_dict.get('email_address')
+    email_sent = None
+    if email_address and query_dois:
+        if is_async_email():
+            queue_saved_search_email(email_address, *query_dois.values())
+            email_sent = 'queued'
+        else:
+            email_sent = send_saved_search_email(email_address, *query_dois.values())
+
+    return {'results': results, 'email_sent': email_sent}
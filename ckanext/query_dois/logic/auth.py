@@ -10,3 +10,12 @@ from ckan.plugins import toolkit
 @toolkit.auth_allow_anonymous_access
 def create_doi(context, data_dict):
     return {'success': True}
+
+
+def create_dois_bulk(context, data_dict):
+    """
+    Only logged in users can create DOIs in bulk.
+
+    Anonymous users are refused by CKAN as this function doesn't allow anonymous access.
+    """
+    return {'success': True}
@@ -13,6 +13,7 @@ boolean_validator = toolkit.get_validator('boolean_validator')
 ignore_missing = toolkit.get_validator('ignore_missing')
 int_validator = toolkit.get_validator('int_validator')
 email_validator = toolkit.get_validator('email_validator')
+not_empty = toolkit.get_validator('not_empty')
 
 
 def list_of_strings(delimiter=','):
@@ -46,3 +47,19 @@ def create_doi():
         'query_version': [ignore_missing, str],
         'version': [ignore_missing, int_validator],
     }
+
+
+def create_dois_bulk():
+    """
+    :returns: the schema for the create_dois_bulk action, each of the queries is
+        validated in the same way as the create_doi action's parameters
+    """
+    return {
+        'email_address': [ignore_missing, email_validator],
+        'queries': {
+            'resource_ids': [not_empty, list_of_strings()],
+            'query': [ignore_missing, json_validator],
+            'query_version': [ignore_missing, str],
+            'version': [ignore_missing, int_validator],
+        },
+    }
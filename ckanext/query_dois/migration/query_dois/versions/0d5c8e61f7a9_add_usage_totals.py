@@ -0,0 +1,49 @@
+"""
+Add usage totals table.
+
+Revision ID: 0d5c8e61f7a9
+Revises: 7f93d0a2b6c8
+Create Date: 2026-10-17 12:41:16.093377
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '0d5c8e61f7a9'
+down_revision = '7f93d0a2b6c8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Creates the query_doi_usage table and fills it from the existing stats.
+    """
+    op.create_table(
+        'query_doi_usage',
+        sa.Column('doi', sa.UnicodeText, primary_key=True),
+        sa.Column('download_count', sa.BigInteger, nullable=False, server_default='0'),
+        sa.Column('save_count', sa.BigInteger, nullable=False, server_default='0'),
+        sa.Column('last_download_at', sa.DateTime, nullable=True),
+    )
+    # fill the totals from the existing stats
+    op.execute(
+        """
+        INSERT INTO query_doi_usage (doi, download_count, save_count, last_download_at)
+        SELECT doi,
+               count(id) FILTER (WHERE action = 'download'),
+               count(id) FILTER (WHERE action = 'save'),
+               max(timestamp) FILTER (WHERE action = 'download')
+        FROM query_doi_stat
+        WHERE action IN ('download', 'save')
+        GROUP BY doi
+        """
+    )
+
+
+def downgrade():
+    """
+    Drops the query_doi_usage table.
+    """
+    op.drop_table('query_doi_usage')
@@ -0,0 +1,36 @@
+"""
+Add identifier alias table and stat identifier index.
+
+Revision ID: 3b9e7d2a4c16
+Revises: 0d5c8e61f7a9
+Create Date: 2026-10-17 13:52:40.512873
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3b9e7d2a4c16'
+down_revision = '0d5c8e61f7a9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Creates the query_doi_identifier_alias table and indexes the stat identifiers.
+    """
+    op.create_table(
+        'query_doi_identifier_alias',
+        sa.Column('identifier', sa.UnicodeText, primary_key=True),
+        sa.Column('legacy_identifier', sa.UnicodeText, nullable=True),
+    )
+    op.create_index('query_doi_stat_identifier_idx', 'query_doi_stat', ['identifier'])
+
+
+def downgrade():
+    """
+    Drops the stat identifier index and the query_doi_identifier_alias table.
+    """
+    op.drop_index('query_doi_stat_identifier_idx', table_name='query_doi_stat')
+    op.drop_table('query_doi_identifier_alias')
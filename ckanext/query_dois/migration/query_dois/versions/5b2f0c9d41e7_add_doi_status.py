@@ -0,0 +1,36 @@
+"""
+Add DOI status.
+
+Revision ID: 5b2f0c9d41e7
+Revises: a74242a670e0
+Create Date: 2026-10-17 10:12:41.118264
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5b2f0c9d41e7'
+down_revision = 'a74242a670e0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Adds the status column to the query_doi table.
+    """
+    # all existing DOIs were minted synchronously and are therefore registered
+    op.add_column(
+        'query_doi',
+        sa.Column(
+            'status', sa.UnicodeText, nullable=False, server_default='registered'
+        ),
+    )
+
+
+def downgrade():
+    """
+    Removes the status column from the query_doi table.
+    """
+    op.drop_column('query_doi', 'status')
@@ -0,0 +1,32 @@
+"""
+Add authors column.
+
+Revision ID: 6e1f8a3c2d70
+Revises: 9c4e2b7d5a13
+Create Date: 2026-10-17 16:21:53.724118
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import JSONB
+
+# revision identifiers, used by Alembic.
+revision = '6e1f8a3c2d70'
+down_revision = '9c4e2b7d5a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Adds the authors column to the query_doi table.
+    """
+    # the existing DOIs' authors are filled using the backfill-authors command
+    op.add_column('query_doi', sa.Column('authors', JSONB, nullable=True))
+
+
+def downgrade():
+    """
+    Drops the authors column from the query_doi table.
+    """
+    op.drop_column('query_doi', 'authors')
@@ -0,0 +1,33 @@
+"""
+Add composite doi, action and id index on the stats table.
+
+Revision ID: 7f93d0a2b6c8
+Revises: e4a7b3f1c052
+Create Date: 2026-10-17 12:10:52.806142
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '7f93d0a2b6c8'
+down_revision = 'e4a7b3f1c052'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Adds a composite doi, action and id index to the query_doi_stat table.
+    """
+    op.create_index(
+        'query_doi_stat_doi_action_id_idx',
+        'query_doi_stat',
+        ['doi', 'action', 'id'],
+    )
+
+
+def downgrade():
+    """
+    Drops the query_doi_stat composite index.
+    """
+    op.drop_index('query_doi_stat_doi_action_id_idx', table_name='query_doi_stat')
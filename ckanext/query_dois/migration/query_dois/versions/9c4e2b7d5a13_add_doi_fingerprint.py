@@ -0,0 +1,81 @@
+"""
+Add resources and versions fingerprint column.
+
+Revision ID: 9c4e2b7d5a13
+Revises: 3b9e7d2a4c16
+Create Date: 2026-10-17 15:08:27.316540
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9c4e2b7d5a13'
+down_revision = '3b9e7d2a4c16'
+branch_labels = None
+depends_on = None
+
+
+# fills the fingerprints of the existing DOIs, this must produce the same hashes as
+# ckanext.query_dois.lib.query.make_fingerprint (the C collation sorts the resource IDs
+# by their bytes, as python does). The lateral join keeps DOIs with no resources, which
+# get the hash of an empty string
+fill_fingerprints = """
+    UPDATE query_doi
+    SET fingerprint = fingerprints.fingerprint
+    FROM (
+        SELECT query_doi.id,
+               md5(coalesce(string_agg(entries.key || ':' || entries.value::text, ','
+                                       ORDER BY entries.key COLLATE "C"), ''))
+                   AS fingerprint
+        FROM query_doi
+        LEFT JOIN LATERAL jsonb_each(query_doi.resources_and_versions) AS entries
+            ON true
+        GROUP BY query_doi.id
+    ) AS fingerprints
+    WHERE query_doi.id = fingerprints.id
+    """
+
+
+def upgrade():
+    """
+    Adds the fingerprint column to the query_doi table, fills it for the existing DOIs
+    and adds a unique index on the query hash, query version and fingerprint.
+    """
+    op.add_column('query_doi', sa.Column('fingerprint', sa.UnicodeText, nullable=True))
+    op.execute(fill_fingerprints)
+    # DOIs minted before this change could duplicate an earlier DOI for the same query,
+    # only the earliest keeps its fingerprint so that it's the one that gets reused
+    op.execute(
+        """
+        UPDATE query_doi
+        SET fingerprint = NULL
+        WHERE id IN (
+            SELECT id
+            FROM (
+                SELECT id,
+                       row_number() OVER (
+                           PARTITION BY query_hash, query_version, fingerprint
+                           ORDER BY id
+                       ) AS position
+                FROM query_doi
+                WHERE fingerprint IS NOT NULL
+            ) AS duplicates
+            WHERE position > 1
+        )
+        """
+    )
+    op.create_index(
+        'query_doi_query_fingerprint_idx',
+        'query_doi',
+        ['query_hash', 'query_version', 'fingerprint'],
+        unique=True,
+    )
+
+
+def downgrade():
+    """
+    Drops the fingerprint index and column.
+    """
+    op.drop_index('query_doi_query_fingerprint_idx', table_name='query_doi')
+    op.drop_column('query_doi', 'fingerprint')
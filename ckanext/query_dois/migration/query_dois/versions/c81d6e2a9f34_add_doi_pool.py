@@ -0,0 +1,35 @@
+"""
+Add DOI pool.
+
+Revision ID: c81d6e2a9f34
+Revises: 5b2f0c9d41e7
+Create Date: 2026-10-17 11:03:27.540913
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c81d6e2a9f34'
+down_revision = '5b2f0c9d41e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Creates the query_doi_pool table.
+    """
+    op.create_table(
+        'query_doi_pool',
+        sa.Column('id', sa.BigInteger, primary_key=True),
+        sa.Column('doi', sa.UnicodeText, nullable=False, unique=True),
+        sa.Column('timestamp', sa.DateTime, nullable=False),
+    )
+
+
+def downgrade():
+    """
+    Drops the query_doi_pool table.
+    """
+    op.drop_table('query_doi_pool')
@@ -0,0 +1,34 @@
+"""
+Add GIN index on resources and versions.
+
+Revision ID: e4a7b3f1c052
+Revises: c81d6e2a9f34
+Create Date: 2026-10-17 11:48:09.271635
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e4a7b3f1c052'
+down_revision = 'c81d6e2a9f34'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Adds a GIN index on the query_doi resources_and_versions column.
+    """
+    op.create_index(
+        'query_doi_resources_and_versions_idx',
+        'query_doi',
+        ['resources_and_versions'],
+        postgresql_using='gin',
+    )
+
+
+def downgrade():
+    """
+    Drops the query_doi resources_and_versions index.
+    """
+    op.drop_index('query_doi_resources_and_versions_idx', table_name='query_doi')
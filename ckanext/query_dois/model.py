@@ -6,9 +6,14 @@
 
 
 from ckan.model import DomainObject, meta
-from sqlalchemy import BigInteger, Column, DateTime, Table, UnicodeText
-from sqlalchemy.dialects.postgresql import JSONB
-
+from sqlalchemy import BigInteger, Column, DateTime, Index, Table, UnicodeText
+from sqlalchemy.dialects.postgresql import JSONB, array
+
+# DOI statuses
+# the DOI has been reserved in the database but not registered with DataCite yet
+PENDING_STATUS = 'pending'
+# the DOI has been registered with DataCite
+REGISTERED_STATUS = 'registered'
 query_doi_table = Table(
     'query_doi',
     meta.metadata,
@@ -33,6 +38,33 @@ query_doi_table = Table(
     Column('query_version', UnicodeText, nullable=True),
     # record the resource counts
     Column('resource_counts', JSONB, nullable=True),
+    # hash of the resources_and_versions map (see lib.query.make_fingerprint), this is
+    # used in conjunction with the query hash and version to find existing DOIs
+    Column('fingerprint', UnicodeText, nullable=True),
+    # the authors of the packages the resources are in, at the time of minting
+    Column('authors', JSONB, nullable=True),
+    # whether the DOI has been registered with DataCite yet (see the statuses above)
+    Column(
+        'status',
+        UnicodeText,
+        nullable=False,
+        default=REGISTERED_STATUS,
+        server_default=REGISTERED_STATUS,
+    ),
+    # GIN index on the resource IDs and versions to make resource based lookups fast
+    Index(
+        'query_doi_resources_and_versions_idx',
+        'resources_and_versions',
+        postgresql_using='gin',
+    ),
+    # unique index to make finding an existing DOI for a query a single index lookup
+    Index(
+        'query_doi_query_fingerprint_idx',
+        'query_hash',
+        'query_version',
+        'fingerprint',
+        unique=True,
+    ),
 )
 
 
@@ -50,6 +82,50 @@ query_doi_stat_table = Table(
     Column('identifier', UnicodeText),
     # timestamp of the stat
     Column('timestamp', DateTime, nullable=False),
+    # composite index to make the per DOI, per action stats aggregations fast
+    Index('query_doi_stat_doi_action_id_idx', 'doi', 'action', 'id'),
+    # index to make per user lookups fast
+    Index('query_doi_stat_identifier_idx', 'identifier'),
+)
+
+
+# links the identifiers created from email addresses by the hmac anonymizer to the
+# identifiers the legacy bcrypt anonymizer created from the same email addresses, so
+# that stats can still be grouped by user after switching anonymizers
+query_doi_identifier_alias_table = Table(
+    'query_doi_identifier_alias',
+    meta.metadata,
+    # the hmac identifier
+    Column('identifier', UnicodeText, primary_key=True),
+    # the bcrypt identifier, if there are stats recorded with it
+    Column('legacy_identifier', UnicodeText, nullable=True),
+)
+
+
+# per DOI usage totals, kept up to date as stats are recorded
+query_doi_usage_table = Table(
+    'query_doi_usage',
+    meta.metadata,
+    # the doi these totals relate to
+    Column('doi', UnicodeText, primary_key=True),
+    # the number of download stats recorded against the doi
+    Column('download_count', BigInteger, nullable=False, server_default='0'),
+    # the number of save stats recorded against the doi
+    Column('save_count', BigInteger, nullable=False, server_default='0'),
+    # the timestamp of the most recent download stat recorded against the doi
+    Column('last_download_at', DateTime, nullable=True),
+)
+
+
+# pool of DOIs which have been checked for uniqueness and can be claimed when minting
+query_doi_pool_table = Table(
+    'query_doi_pool',
+    meta.metadata,
+    Column('id', BigInteger, primary_key=True),
+    # the full doi (prefix/suffix)
+    Column('doi', UnicodeText, nullable=False, unique=True),
+    # the timestamp when the doi was added to the pool
+    Column('timestamp', DateTime, nullable=False),
 )
 
 
@@ -64,6 +140,16 @@ class QueryDOI(DomainObject):
     def get_rounded_versions(self):
         return list(self.resources_and_versions.values())
 
+    @property
+    def is_registered(self) -> bool:
+        """
+        Whether this DOI has been registered with DataCite yet. DOIs which haven't been
+        registered yet won't resolve via doi.org.
+
+        :returns: True if the DOI has been registered, False if not
+        """
+        return self.status != PENDING_STATUS
+
     @staticmethod
     def on_resource(resource_id):
         """
@@ -74,6 +160,16 @@ class QueryDOI(DomainObject):
         """
         return QueryDOI.resources_and_versions.has_key(resource_id)
 
+    @staticmethod
+    def on_any_resource(resource_ids):
+        """
+        A convenience method to filter by any of the given resource ids.
+
+        :param resource_ids: the resource ids
+        :returns: an sqlalchemy boolean expression
+        """
+        return QueryDOI.resources_and_versions.has_any(array(list(resource_ids)))
+
 
 class QueryDOIStat(DomainObject):
     """
@@ -96,5 +192,26 @@ class QueryDOIStat(DomainObject):
         }
 
 
+class QueryDOIUsage(DomainObject):
+    """
+    Object for holding query DOI usage totals.
+    """
+
+    def to_dict(self):
+        """
+        Returns the object as a dict for the stats API response.
+
+        :returns: a dict
+        """
+        return {
+            'downloads': self.download_count,
+            'saves': self.save_count,
+            'last_download_timestamp': (
+                str(self.last_download_at) if self.last_download_at else None
+            ),
+        }
+
+
 meta.mapper(QueryDOI, query_doi_table)
 meta.mapper(QueryDOIStat, query_doi_stat_table)
+meta.mapper(QueryDOIUsage, query_doi_usage_table)
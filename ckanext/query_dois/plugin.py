@@ -5,15 +5,20 @@
 # Created by the Natural History Museum in London, UK
 
 import logging
+from typing import Optional
 
 from ckan import plugins
 from ckan.plugins import toolkit
 
 from . import cli, helpers, routes
+from .lib.cache import LRUCache, get_cache_size
 from .lib.doi import find_existing_doi, mint_multisearch_doi
+from .lib.landing_pages import invalidate_landing_pages
 from .lib.query import Query
-from .lib.stats import DOWNLOAD_ACTION, record_stat
+from .lib.stats import DOWNLOAD_ACTION, get_anonymizer, record_stat
+from .lib.versions import invalidate_resource_versions
 from .logic import action, auth
+from .model import QueryDOI
 
 log = logging.getLogger(__name__)
 
@@ -21,10 +26,13 @@ log = logging.getLogger(__name__)
 class QueryDOIsPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IBlueprint, inherit=True)
     plugins.implements(plugins.IConfigurer, inherit=True)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IClick)
+    plugins.implements(plugins.IResourceController, inherit=True)
+    plugins.implements(plugins.IPackageController, inherit=True)
     # if the versioned datastore downloader is available, we have a hook for it
     try:
         from ckanext.versioned_datastore.interfaces import IVersionedDatastoreDownloads
@@ -33,6 +41,17 @@ class QueryDOIsPlugin(plugins.SingletonPlugin):
         versioned_datastore_available = True
     except ImportError:
         versioned_datastore_available = False
+    # if the versioned datastore is available, we want to know when resources get new
+    # versions
+    try:
+        from ckanext.versioned_datastore.interfaces import IVersionedDatastore
+
+        plugins.implements(IVersionedDatastore, inherit=True)
+    except ImportError:
+        pass
+
+    # memo of download request IDs -> Query objects, resized in configure
+    download_cache = LRUCache(128)
 
     # IBlueprint
     def get_blueprint(self):
@@ -46,12 +65,14 @@ class QueryDOIsPlugin(plugins.SingletonPlugin):
     def get_auth_functions(self):
         return {
             'create_doi': auth.create_doi,
+            'create_dois_bulk': auth.create_dois_bulk,
         }
 
     # IActions
     def get_actions(self):
         return {
             'create_doi': action.create_doi,
+            'create_dois_bulk': action.create_dois_bulk,
         }
 
     # IConfigurer
@@ -61,9 +82,109 @@ class QueryDOIsPlugin(plugins.SingletonPlugin):
         # add the resource groups
         plugins.toolkit.add_resource('theme/assets', 'ckanext-query-dois')
 
+    # IConfigurable
+    def configure(self, config):
+        """
+        Sizes the download memo and checks the anonymizer config.
+
+        :param config: the CKAN config
+        """
+        self.download_cache = LRUCache(get_cache_size('download', 128))
+        # check the anonymizer config now, rather than when the first stat is recorded
+        get_anonymizer()
+
+    def _get_download_query(self, request) -> Query:
+        """
+        Retrieves the Query for the given download request, creating it if it hasn't
+        been created yet.
+
+        The download_modify_notifier_template_context, download_modify_manifest and
+        download_after_run hooks are all called in the same process while the download
+        is run, so the Query is memoised between them (and removed in
+        download_after_run). The QueryDOI isn't memoised as it is bound to the session
+        it was loaded in.
+
+        :param request: the vds download request
+        :returns: a Query object
+        """
+        query = self.download_cache.get(request.id)
+        if query is None:
+            query = Query.create_from_download_request(request)
+            self.download_cache.set(request.id, query)
+        return query
+
+    def _find_download_doi(self, request) -> Optional[QueryDOI]:
+        """
+        Retrieves the QueryDOI for the given download request, if there is one.
+
+        :param request: the vds download request
+        :returns: a QueryDOI object or None
+        """
+        return find_existing_doi(self._get_download_query(request))
+
+    # IResourceController
+    def after_resource_update(self, context, resource):
+        """
+        Forgets the updated resource's versions and the cached landing pages.
+        """
+        invalidate_resource_versions(resource['id'])
+        invalidate_landing_pages()
+
+    def after_resource_delete(self, context, resources):
+        """
+        Forgets the deleted resources' versions and the cached landing pages.
+        """
+        for resource in resources:
+            invalidate_resource_versions(resource['id'])
+        invalidate_landing_pages()
+
+    # IPackageController
+    def after_dataset_update(self, context, pkg_dict):
+        """
+        Forgets the cached landing pages, they may show the package's details.
+        """
+        invalidate_landing_pages()
+
+    def after_dataset_delete(self, context, pkg_dict):
+        """
+        Forgets the cached landing pages, they may show the package's details.
+        """
+        invalidate_landing_pages()
+
+    # IResourceController and IPackageController (CKAN < 2.10)
+    def after_update(self, context, data_dict):
+        """
+        Forgets the updated resource's versions and the cached landing pages.
+        """
+        # this is called with a resource dict by IResourceController and a package dict
+        # by IPackageController, there's no harm in treating both as a resource update
+        self.after_resource_update(context, data_dict)
+
+    def after_delete(self, context, data):
+        """
+        Forgets the deleted resources' versions and the cached landing pages.
+        """
+        # this is called with a list of resource dicts by IResourceController and a
+        # package dict by IPackageController
+        if isinstance(data, dict):
+            self.after_dataset_delete(context, data)
+        else:
+            self.after_resource_delete(context, data)
+
+    # IVersionedDatastore
+    def datastore_after_indexing(self, request, splitgill_stats, stats_id):
+        """
+        Forgets the indexed resource's versions.
+        """
+        # the resource will have a new version now so forget about its old ones
+        invalidate_resource_versions(request.resource['id'])
+
     # IVersionedDatastoreDownloads
     def download_after_init(self, request):
         try:
+            # this hook is called when the download is requested, which is usually in
+            # a different process to the one that runs it and calls the other hooks, so
+            # the Query isn't memoised here
             query = Query.create_from_download_request(request)
             # mint the DOI on datacite if necessary
             mint_multisearch_doi(query)
@@ -78,13 +199,13 @@ class QueryDOIsPlugin(plugins.SingletonPlugin):
 
     def download_modify_notifier_template_context(self, request, context):
         try:
-            query = Query.create_from_download_request(request)
             # if a DOI can be created it should already have been created in
             # download_after_init
-            doi = find_existing_doi(query)
+            doi = self._find_download_doi(request)
             if doi:
                 # update the context with the doi
                 context['doi'] = doi.doi
+                context['doi_status'] = doi.status
         except:
             # if anything goes wrong we don't want to stop the download; just log the
             # error and move on
@@ -95,13 +216,13 @@ class QueryDOIsPlugin(plugins.SingletonPlugin):
 
     def download_modify_manifest(self, manifest, request):
         try:
-            query = Query.create_from_download_request(request)
             # if a DOI can be created it should already have been created in
             # download_after_init
-            doi = find_existing_doi(query)
+            doi = self._find_download_doi(request)
             if doi:
                 # add the doi to the manifest
                 manifest['query-doi'] = doi.doi
+                manifest['query-doi-status'] = doi.status
         except:
             # if anything goes wrong we don't want to stop the download from completing;
             # just log the error and move on
@@ -112,16 +233,18 @@ class QueryDOIsPlugin(plugins.SingletonPlugin):
 
     def download_after_run(self, request):
         try:
-            query = Query.create_from_download_request(request)
             # if a DOI can be created it should already have been created in
             # download_modify_manifest
-            doi = find_existing_doi(query)
+            doi = self._find_download_doi(request)
             if doi and request.state == 'complete':
                 # record a download stat against the DOI
                 record_stat(doi, DOWNLOAD_ACTION, identifier=request.id)
         except:
             # just log the error and move on
             log.error('Failed to retrieve DOI and/or create stats', exc_info=True)
+        finally:
+            # this is the last hook called for the download so we're done with its query
+            self.download_cache.pop(request.id)
 
     # ITemplateHelpers
     def get_helpers(self):
@@ -134,5 +257,6 @@ class QueryDOIsPlugin(plugins.SingletonPlugin):
             'create_multisearch_citation_text': helpers.create_multisearch_citation_text,
             'pretty_print_query': helpers.pretty_print_query,
             'get_doi_count': helpers.get_doi_count,
+            'get_doi_summary': helpers.get_doi_summary,
             'versioned_datastore_available': self.versioned_datastore_available,
         }
@@ -8,15 +8,21 @@ import copy
 import itertools
 import json
 import operator
-from collections import OrderedDict
+from datetime import date
 from urllib.parse import urlencode
 
 from ckan import model
 from ckan.plugins import toolkit
+from flask import Response, stream_with_context
 
-from ..lib.stats import DOWNLOAD_ACTION, SAVE_ACTION
-from ..lib.utils import get_resource_and_package
-from ..model import QueryDOI, QueryDOIStat
+from ..lib.cache import configured_cache
+from ..lib.landing_pages import get_landing_page_cache
+from ..lib.query import find_authors
+from ..lib.utils import can_show_package, get_resource_and_package
+from ..model import QueryDOI, QueryDOIStat, QueryDOIUsage
+
+# cache of (DOI, inaccessible resource IDs) tuples -> current slugs
+get_current_slug_cache = configured_cache('current_slug', 1000, 3600)
 
 column_param_mapping = (
     ('doi', QueryDOIStat.doi),
@@ -26,6 +32,175 @@ column_param_mapping = (
 )
 
 
+def get_int_param(name, default):
+    """
+    Retrieves an integer request parameter, aborting with a 400 if it isn't an integer.
+
+    :param name: the name of the parameter
+    :param default: the value to return if the parameter isn't present
+    :returns: the integer value
+    """
+    value = toolkit.request.params.get(name, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise toolkit.abort(400, toolkit._('{} must be an integer').format(name))
+
+
+def get_limit_param(default, max_limit):
+    """
+    Retrieves the limit request parameter, aborting with a 400 if it's above the given
+    maximum.
+
+    :param default: the value to use if the parameter isn't present
+    :param max_limit: the maximum limit allowed
+    :returns: the limit
+    """
+    limit = max(get_int_param('limit', default), 0)
+    if limit > max_limit:
+        raise toolkit.abort(
+            400, toolkit._('limit must be at most {}').format(max_limit)
+        )
+    return limit
+
+
+def get_datetime_param(name):
+    """
+    Retrieves an ISO format datetime request parameter.
+
+    :param name: the name of the parameter
+    :returns: a datetime, or None if the parameter isn't present
+    :raises ValueError: if the parameter isn't a valid datetime
+    """
+    value = toolkit.request.params.get(name, None)
+    if not value:
+        return None
+    try:
+        return toolkit.h.date_str_to_datetime(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be an ISO format datetime')
+
+
+def paginate(query, id_column, to_dict):
+    """
+    Applies the pagination parameters from the request to the given query, which must be
+    ordered by the given id column in descending order, and returns the page of results.
+
+    If a cursor parameter is present, keyset pagination is used: only rows with an id
+    below the cursor are returned (an empty cursor gets the first page) and the results
+    are returned in a dict along with the cursor for the next page. Otherwise, the
+    offset parameter is used and just the list of results is returned. Either way, the
+    limit parameter can't be above ckanext.query_dois.max_page_size.
+
+    :param query: the query to paginate
+    :param id_column: the id column the query is ordered by
+    :param to_dict: a function which converts a row from the query into a dict
+    :returns: a list of result dicts or, if a cursor was given, a dict containing the
+        results under "results" and the next cursor under "next" (None if there are no
+        more results)
+    """
+    max_limit = toolkit.asint(
+        toolkit.config.get('ckanext.query_dois.max_page_size', 1000)
+    )
+    limit = get_limit_param(min(100, max_limit), max_limit)
+
+    if 'cursor' not in toolkit.request.params:
+        query = query.offset(max(get_int_param('offset', 0), 0)).limit(limit)
+        return [to_dict(row) for row in query]
+
+    if toolkit.request.params['cursor']:
+        query = query.filter(id_column < get_int_param('cursor', None))
+    results = [to_dict(row) for row in query.limit(limit)]
+    next_cursor = results[-1]['id'] if results and len(results) == limit else None
+    return {'results': results, 'next': next_cursor}
+
+
+def is_ndjson_request():
+    """
+    Checks whether the request has asked for a newline delimited JSON response.
+
+    :returns: True if the format parameter is "ndjson", False if not
+    """
+    return toolkit.request.params.get('format', None) == 'ndjson'
+
+
+def row_as_dict(values):
+    """
+    Converts the column values of a row into a dict in the same format as
+    DomainObject.as_dict, without needing an ORM object.
+
+    :param values: a mapping of column names -> values
+    :returns: a dict
+    """
+    return {
+        name: value.isoformat() if isinstance(value, date) else value
+        for name, value in values.items()
+    }
+
+
+def doi_row_as_dict(row):
+    """
+    Converts a row of the query_doi table's columns followed by the query_doi_usage
+    table's download_count, save_count and last_download_at columns into the same dict
+    format as the /doi endpoint's results.
+
+    :param row: the row
+    :returns: a dict
+    """
+    values = row._asdict()
+    downloads = values.pop('download_count')
+    saves = values.pop('save_count')
+    last_download_at = values.pop('last_download_at')
+    return dict(
+        row_as_dict(values),
+        usage={
+            'downloads': downloads or 0,
+            'saves': saves or 0,
+            'last_download_timestamp': (
+                str(last_download_at) if last_download_at else None
+            ),
+        },
+    )
+
+
+def stream_ndjson(query, id_column, to_dict):
+    """
+    Streams the results of the given query, which must be ordered by the given id column
+    in descending order, as newline delimited JSON. The rows are fetched in chunks using
+    a server side cursor and written to the client as they arrive, so memory use doesn't
+    depend on the number of rows. The query should select columns rather than ORM
+    objects to avoid the cost of creating them.
+
+    The offset and cursor parameters are applied in the same way as by paginate. As the
+    results are never all held in memory, the limit parameter can be much larger than
+    paginate allows: it defaults to, and can't be above,
+    ckanext.query_dois.max_stream_size.
+
+    :param query: the query to stream the results of
+    :param id_column: the id column the query is ordered by
+    :param to_dict: a function which converts a row from the query into a dict
+    :returns: a streaming response
+    """
+    if toolkit.request.params.get('cursor', None):
+        query = query.filter(id_column < get_int_param('cursor', None))
+    else:
+        query = query.offset(max(get_int_param('offset', 0), 0))
+    max_limit = toolkit.asint(
+        toolkit.config.get('ckanext.query_dois.max_stream_size', 100000)
+    )
+    query = query.limit(get_limit_param(max_limit, max_limit))
+
+    chunk_size = toolkit.asint(
+        toolkit.config.get('ckanext.query_dois.stream_chunk_size', 1000)
+    )
+
+    def generate():
+        for row in query.yield_per(chunk_size):
+            yield json.dumps(to_dict(row)) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 def get_query_doi(doi):
     """
     Retrieves a QueryDOI object from the database for the given DOI, if there is one,
@@ -37,31 +212,24 @@ def get_query_doi(doi):
     return model.Session.query(QueryDOI).filter(QueryDOI.doi == doi).first()
 
 
-def get_authors(packages):
+def get_doi_authors(query_doi, resource_ids):
     """
-    Retrieves all the authors from the given packages, de-duplicates them (if necessary)
-    and then returns them as a list.
-
-    Note that this function takes a list of packages as it is multi-package and
-    therefore multi-resource ready.
+    Retrieves the authors of the given query DOI. These are stored on the DOI when it is
+    minted. DOIs minted before then which haven't been updated by the backfill-authors
+    command have no stored authors, so they are found from the packages the given
+    resources are currently in, in the same way as the backfill. Only the resources the
+    current user can access should be given, so that the authors of packages which are
+    now private or deleted aren't shown. If there aren't any authors, the author is
+    given as unknown.
 
-    :param packages: the packages
-    :returns: a list of author(s)
+    :param query_doi: the QueryDOI object
+    :param resource_ids: the IDs of the DOI's resources which the user can access
+    :returns: a list of authors
     """
-    # use an ordered dict in the absence of a sorted set
-    authors = OrderedDict()
-    for package in packages:
-        author = package['author']
-        # some author values will contain many authors with a separator, perhaps , or ;
-        for separator in (';', ','):
-            if separator in author:
-                authors.update({a: True for a in author.split(separator)})
-                break
-        else:
-            # if the author value didn't contain a separator then we can just use the value as is
-            authors[author] = True
-
-    return list(authors.keys())
+    authors = query_doi.authors
+    if authors is None:
+        authors = find_authors(sorted(resource_ids)) if resource_ids else []
+    return authors or [toolkit._('Unknown')]
 
 
 def encode_params(params, version=None, extras=None, for_api=False):
@@ -166,40 +334,51 @@ def get_stats(query_doi):
     last download timestamp. Note that we are specifically looking for downloads here, no other
     actions are considered.
 
+    The stats are read from the DOI's usage totals which are updated whenever a stat is
+    recorded.
+
     :param query_doi: the QueryDOI object
     :returns: a 3-tuple containing the total downloads, total saves and the last download timestamp
     """
-    # count how many download stats we have on this doi
-    download_total = (
-        model.Session.query(QueryDOIStat)
-        .filter(QueryDOIStat.doi == query_doi.doi)
-        .filter(QueryDOIStat.action == DOWNLOAD_ACTION)
-        .count()
-    )
-    # count how many save stats we have on this doi
-    save_total = (
-        model.Session.query(QueryDOIStat)
-        .filter(QueryDOIStat.doi == query_doi.doi)
-        .filter(QueryDOIStat.action == SAVE_ACTION)
-        .count()
-    )
-    # find the last stats object we have for this doi
-    last = (
-        model.Session.query(QueryDOIStat)
-        .filter(QueryDOIStat.doi == query_doi.doi)
-        .filter(QueryDOIStat.action == DOWNLOAD_ACTION)
-        .order_by(QueryDOIStat.id.desc())
-        .first()
+    usage = model.Session.query(QueryDOIUsage).get(query_doi.doi)
+    if usage is None:
+        return 0, 0, None
+    return usage.download_count, usage.save_count, usage.last_download_at
+
+
+def usage_as_dict(usage):
+    """
+    Returns the given usage totals as a dict, defaulting the totals if there are none.
+
+    :param usage: a QueryDOIUsage object or None
+    :returns: a dict
+    """
+    if usage is None:
+        return {'downloads': 0, 'saves': 0, 'last_download_timestamp': None}
+    return usage.to_dict()
+
+
+def get_pending_warning(query_doi):
+    """
+    Returns a warning to show on the landing page if the DOI hasn't been registered with
+    DataCite yet, or None if it has.
+
+    :param query_doi: the QueryDOI object
+    :returns: a warning string or None
+    """
+    if query_doi.is_registered:
+        return None
+    return toolkit._(
+        'This DOI is still being registered and may not resolve via doi.org yet.'
     )
-    return download_total, save_total, last.timestamp if last is not None else None
 
 
-def render_datastore_search_doi_page(query_doi):
+def get_datastore_search_doi_context(query_doi):
     """
-    Renders a DOI landing page for a datastore_search based query DOI.
+    Creates the template context for a datastore_search based query DOI's landing page.
 
     :param query_doi: the query DOI
-    :returns: the rendered page
+    :returns: the template context dict
     """
     # currently we only deal with single resource query DOIs
     resource_id = query_doi.get_resource_ids()[0]
@@ -229,6 +408,9 @@ def render_datastore_search_doi_page(query_doi):
                 'or are no longer available.'
             )
         ]
+    pending_warning = get_pending_warning(query_doi)
+    if pending_warning:
+        warnings.append(pending_warning)
 
     context = {
         'query_doi': query_doi,
@@ -239,9 +421,9 @@ def render_datastore_search_doi_page(query_doi):
         'usage_stats': usage_stats,
         'is_inaccessible': is_inaccessible,
         'warnings': warnings,
+        'authors': get_doi_authors(query_doi, [] if is_inaccessible else [resource_id]),
         # these are defaults for if the resource is inaccessible
         'package_doi': None,
-        'authors': toolkit._('Unknown'),
         'reruns': {},
     }
 
@@ -254,45 +436,72 @@ def render_datastore_search_doi_page(query_doi):
                 'package_doi': (
                     package['doi'] if package.get('doi_status', False) else None
                 ),
-                'authors': get_authors([package]),
                 'reruns': generate_rerun_urls(
                     resource, package, query_doi.query, rounded_version
                 ),
             }
         )
 
-    return toolkit.render('query_dois/single_landing_page.html', context)
+    return context
 
 
 def get_package_and_resource_info(resource_ids):
     """
     Retrieve basic info about the packages and resources from the list of resource ids.
 
+    All the resources and their packages are retrieved with one query, rather than a
+    resource_show and package_show call for each. Resources are inaccessible if they
+    don't exist or aren't active, or if the current user isn't allowed to see their
+    package. Public, active packages can be seen by everyone, so package_show access is
+    only checked for the other packages (once per package).
+
     :param resource_ids: a list of resource ids
-    :returns: two dicts, one of package info and one of resource info
+    :returns: two dicts, one of package info and one of resource info, and a list of the
+        inaccessible resource ids
     """
-    raction = toolkit.get_action('resource_show')
-    paction = toolkit.get_action('package_show')
+    rows = (
+        model.Session.query(model.Resource)
+        .join(model.Package, model.Package.id == model.Resource.package_id)
+        .filter(model.Resource.id.in_(list(resource_ids)))
+        .filter(model.Resource.state == 'active')
+        .with_entities(
+            model.Resource.id,
+            model.Resource.name,
+            model.Package.id.label('package_id'),
+            model.Package.name.label('package_name'),
+            model.Package.title,
+            model.Package.state,
+            model.Package.private,
+        )
+    )
+    found = {row.id: row for row in rows}
 
+    # package ids -> whether the current user can see the package
+    package_access = {}
     packages = {}
     resources = {}
     inaccessible_resources = []
     for resource_id in resource_ids:
-        try:
-            resource = raction({}, dict(id=resource_id))
-        except (toolkit.ObjectNotFound, toolkit.NotAuthorized):
+        row = found.get(resource_id)
+        if row is None:
+            inaccessible_resources.append(resource_id)
+            continue
+        package_id = row.package_id
+        if package_id not in package_access:
+            package_access[package_id] = (
+                row.state == 'active' and not row.private
+            ) or can_show_package(package_id)
+        if not package_access[package_id]:
             inaccessible_resources.append(resource_id)
             continue
-        package_id = resource['package_id']
         resources[resource_id] = {
-            'name': resource['name'],
+            'name': row.name,
             'package_id': package_id,
         }
         if package_id not in packages:
-            package = paction({}, dict(id=package_id))
             packages[package_id] = {
-                'title': package['title'],
-                'name': package['name'],
+                'title': row.title,
+                'name': row.package_name,
                 'resource_ids': [],
             }
         packages[package_id]['resource_ids'].append(resource_id)
@@ -323,12 +532,33 @@ def create_current_slug(query_doi: QueryDOI, ignore_resources=None) -> str:
     return current_slug['slug']
 
 
-def render_multisearch_doi_page(query_doi: QueryDOI):
+def get_current_slug(query_doi: QueryDOI, inaccessible_resources) -> str:
+    """
+    Retrieves a slug for the given query DOI at the current version, ignoring the given
+    inaccessible resources. Creating a slug is a write to the versioned datastore so the
+    slugs are cached against the DOI and the set of inaccessible resources, meaning a
+    new slug is only created when the resources available to the query change.
+
+    :param query_doi: the QueryDOI
+    :param inaccessible_resources: a list of resource IDs to ignore
+    :returns: a slug
+    """
+    cache = get_current_slug_cache()
+    key = (query_doi.doi, tuple(sorted(inaccessible_resources)))
+    slug = cache.get(key)
+    if slug is None:
+        slug = create_current_slug(query_doi, ignore_resources=inaccessible_resources)
+        cache.set(key, slug)
+    return slug
+
+
+def get_multisearch_doi_context(query_doi: QueryDOI):
     """
-    Renders a DOI landing page for a datastore_multisearch based query DOI.
+    Creates the template context for a datastore_multisearch based query DOI's landing
+    page.
 
     :param query_doi: the query DOI
-    :returns: the rendered page
+    :returns: the template context dict
     """
     packages, resources, inaccessible_resources = get_package_and_resource_info(
         query_doi.get_resource_ids()
@@ -385,9 +615,7 @@ def render_multisearch_doi_page(query_doi: QueryDOI):
             )
         ]
     else:
-        current_slug = create_current_slug(
-            query_doi, ignore_resources=inaccessible_resources
-        )
+        current_slug = get_current_slug(query_doi, inaccessible_resources)
         if inaccessible_count > 0:
             warnings.append(
                 toolkit._(
@@ -396,6 +624,9 @@ def render_multisearch_doi_page(query_doi: QueryDOI):
                 )
                 + str(inaccessible_count)
             )
+    pending_warning = get_pending_warning(query_doi)
+    if pending_warning:
+        warnings.append(pending_warning)
 
     context = {
         'query_doi': query_doi,
@@ -406,8 +637,46 @@ def render_multisearch_doi_page(query_doi: QueryDOI):
         'packages': packages,
         'details': current_details,
         'saved_details': saved_details,
+        'authors': get_doi_authors(query_doi, list(resources)),
         'has_changed': inaccessible_count > 0,
         'is_inaccessible': len(resources) == 0,
         'warnings': warnings,
     }
-    return toolkit.render('query_dois/multisearch_landing_page.html', context)
+    return context
+
+
+def get_landing_page(doi):
+    """
+    Retrieves the template name and template context needed to render the landing page
+    for the given DOI. A DOI's saved query never changes so these are cached per DOI,
+    user (as the user affects which resources are accessible) and language. The cached
+    pages are removed when the DOI's stats are updated or when any resource or package
+    changes, and otherwise expire after ckanext.query_dois.landing_page_cache_ttl
+    seconds.
+
+    :param doi: the doi (full doi, prefix/suffix)
+    :returns: a 2-tuple of the template name and the context dict, or None if the DOI
+        doesn't exist
+    """
+    cache = get_landing_page_cache()
+    key = (doi, toolkit.c.user or None, toolkit.h.lang())
+    page = cache.get(key)
+    if page is None:
+        query_doi = get_query_doi(doi)
+        if query_doi is None:
+            return None
+        # detach the QueryDOI from the session so that the cached copy isn't expired or
+        # refreshed by anything that happens in later requests
+        model.Session.expunge(query_doi)
+        if query_doi.query_version is not None and query_doi.query_version != 'v0':
+            page = (
+                'query_dois/multisearch_landing_page.html',
+                get_multisearch_doi_context(query_doi),
+            )
+        else:
+            page = (
+                'query_dois/single_landing_page.html',
+                get_datastore_search_doi_context(query_doi),
+            )
+        cache.set(key, page)
+    return page
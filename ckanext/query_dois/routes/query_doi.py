@@ -9,7 +9,15 @@ from ckan import model
 from ckan.plugins import toolkit
 from flask import Blueprint, jsonify
 
-from ..model import QueryDOI, QueryDOIStat
+from ..lib import stats
+from ..model import (
+    QueryDOI,
+    QueryDOIStat,
+    QueryDOIUsage,
+    query_doi_stat_table,
+    query_doi_table,
+    query_doi_usage_table,
+)
 from . import _helpers
 
 blueprint = Blueprint(name='query_doi', import_name=__name__, url_prefix='/doi')
@@ -25,27 +33,33 @@ def landing_page(data_centre, identifier):
     :returns: the rendered landing page
     """
     doi = '{}/{}'.format(data_centre, identifier)
-    query_doi = _helpers.get_query_doi(doi)
-    if query_doi is None:
+    page = _helpers.get_landing_page(doi)
+    if page is None:
         raise toolkit.abort(404, toolkit._('DOI not recognised'))
 
-    if query_doi.query_version is not None and query_doi.query_version != 'v0':
-        return _helpers.render_multisearch_doi_page(query_doi)
-    else:
-        return _helpers.render_datastore_search_doi_page(query_doi)
+    template, context = page
+    # render using a copy of the context as it's cached and shared between requests
+    return toolkit.render(template, dict(context))
 
 
 @blueprint.route('')
 def doi_stats():
     """
     Returns statistics in JSON format depending on the request parameters. The return
-    will be a list with a dict representing the QueryDOI as each element.
+    will be a list with a dict representing the QueryDOI as each element, each with the
+    DOI's usage totals under the "usage" key.
 
-    This endpoint currently only supports filtering on the resource_id.
+    This endpoint currently only supports filtering on the resource_id. Results can be
+    paged through using offset and limit parameters or, more efficiently for deep pages,
+    a cursor parameter (see _helpers.paginate).
 
-    :returns: a JSON stringified list of dicts
+    :returns: a JSON stringified list of dicts, or a dict containing the list and the
+        next cursor if a cursor was given. If the format parameter is "ndjson" the dicts
+        are streamed as newline delimited JSON instead (see _helpers.stream_ndjson)
     """
-    query = model.Session.query(QueryDOI)
+    query = model.Session.query(QueryDOI, QueryDOIUsage).outerjoin(
+        QueryDOIUsage, QueryDOIUsage.doi == QueryDOI.doi
+    )
 
     # by default order by id desc to get the latest first
     query = query.order_by(QueryDOI.id.desc())
@@ -54,12 +68,23 @@ def doi_stats():
     if resource_id:
         query = query.filter(QueryDOI.on_resource(resource_id))
 
-    # apply the offset and limit, with sensible defaults
-    query = query.offset(toolkit.request.params.get('offset', 0))
-    query = query.limit(toolkit.request.params.get('limit', 100))
-
-    # return the data as a JSON dumped list of dicts
-    return jsonify([stat.as_dict() for stat in query])
+    if _helpers.is_ndjson_request():
+        query = query.with_entities(
+            *query_doi_table.c,
+            query_doi_usage_table.c.download_count,
+            query_doi_usage_table.c.save_count,
+            query_doi_usage_table.c.last_download_at,
+        )
+        return _helpers.stream_ndjson(query, QueryDOI.id, _helpers.doi_row_as_dict)
+
+    # return the page of data as JSON
+    return jsonify(
+        _helpers.paginate(
+            query,
+            QueryDOI.id,
+            lambda row: dict(row[0].as_dict(), usage=_helpers.usage_as_dict(row[1])),
+        )
+    )
 
 
 @blueprint.route('/stats')
@@ -67,8 +92,12 @@ def action_stats():
     """
     Returns action statistics in JSON format depending on the request parameters. The
     return will be a list with a dict representing the QueryDOIStat as each element.
+    Results can be paged through using offset and limit parameters or, more efficiently
+    for deep pages, a cursor parameter (see _helpers.paginate).
 
-    :returns: a JSON stringified list of dicts
+    :returns: a JSON stringified list of dicts, or a dict containing the list and the
+        next cursor if a cursor was given. If the format parameter is "ndjson" the dicts
+        are streamed as newline delimited JSON instead (see _helpers.stream_ndjson)
     """
     query = model.Session.query(QueryDOIStat)
 
@@ -87,9 +116,55 @@ def action_stats():
             QueryDOI.on_resource(resource_id)
         )
 
-    # apply the offset and limit, with sensible defaults
-    query = query.offset(toolkit.request.params.get('offset', 0))
-    query = query.limit(toolkit.request.params.get('limit', 100))
+    if _helpers.is_ndjson_request():
+        query = query.with_entities(*query_doi_stat_table.c)
+        return _helpers.stream_ndjson(
+            query, QueryDOIStat.id, lambda row: _helpers.row_as_dict(row._asdict())
+        )
+
+    # return the page of data as JSON
+    return jsonify(_helpers.paginate(query, QueryDOIStat.id, QueryDOIStat.as_dict))
+
+
+@blueprint.route('/stats/aggregate')
+def aggregate_stats():
+    """
+    Returns action statistics aggregated in the database, in JSON format.
+
+    The request can include these parameters:
+
+        - group_by: a comma separated list of fields to group the stats by, from doi,
+          action, domain and resource_id
+        - bucket: a time period (day, week or month) to group the stats by
+        - from/to: ISO format datetimes to count the stats recorded at or after and
+          before, respectively
+        - the same filters as the /doi/stats endpoint
+
+    :returns: a JSON stringified list of dicts, one per group, each containing the
+        group's field values, the start of its time period under "period" (if a bucket
+        was given) and the number of stats under "count"
+    """
+    params = toolkit.request.params
+    group_by = [name for name in params.get('group_by', '').split(',') if name]
+
+    filters = {}
+    for param_name, _column in _helpers.column_param_mapping:
+        param_value = params.get(param_name, None)
+        if param_value:
+            filters[param_name] = param_value
+
+    try:
+        start = _helpers.get_datetime_param('from')
+        end = _helpers.get_datetime_param('to')
+        results = stats.aggregate_stats(
+            group_by,
+            bucket=params.get('bucket', None) or None,
+            filters=filters,
+            resource_id=params.get('resource_id', None),
+            start=start,
+            end=end,
+        )
+    except ValueError as e:
+        raise toolkit.abort(400, str(e))
 
-    # return the data as a JSON dumped list of dicts
-    return jsonify([stat.as_dict() for stat in query])
+    return jsonify(results)
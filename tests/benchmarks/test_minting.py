@@ -0,0 +1,178 @@
+"""
+Minting throughput benchmarks.
+
+These drive the minting path through a fake DataCite MDS API at various concurrency
+levels and report the throughput and latency percentiles. They are skipped unless the
+QUERY_DOIS_BENCHMARKS environment variable is set, for example:
+
+    QUERY_DOIS_BENCHMARKS=1 pytest -s tests/benchmarks
+
+The latency and error rate of the fake DataCite API can be set using the
+QUERY_DOIS_BENCHMARK_LATENCY (seconds) and QUERY_DOIS_BENCHMARK_ERROR_RATE (0-1)
+environment variables.
+"""
+
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, List
+from unittest.mock import MagicMock, patch
+from uuid import uuid4
+
+import pytest
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.query_dois.lib.doi import mint_multisearch_doi
+from ckanext.query_dois.lib.query import Query
+from tests.helpers.fake_mds import FakeMDSAdapter, make_fake_client
+
+CONCURRENCY_LEVELS = (1, 4, 16)
+REQUESTS_PER_LEVEL = 64
+PREFIX = '10.1234'
+
+latency = float(os.environ.get('QUERY_DOIS_BENCHMARK_LATENCY', 0.05))
+error_rate = float(os.environ.get('QUERY_DOIS_BENCHMARK_ERROR_RATE', 0))
+
+pytestmark = [
+    pytest.mark.skipif(
+        not os.environ.get('QUERY_DOIS_BENCHMARKS'),
+        reason='benchmarks are only run when QUERY_DOIS_BENCHMARKS is set',
+    ),
+    pytest.mark.usefixtures('clean_db', 'setup_db', 'with_plugins'),
+    pytest.mark.ckan_config('ckan.plugins', 'query_dois'),
+    pytest.mark.ckan_config('ckanext.query_dois.prefix', PREFIX),
+    pytest.mark.ckan_config('ckanext.query_dois.publisher', 'Benchmark'),
+    pytest.mark.ckan_config('ckanext.query_dois.doi_title', '{count} records'),
+]
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    concurrency: int
+    elapsed: float
+    latencies: List[float]
+    errors: int
+
+    @property
+    def throughput(self) -> float:
+        return len(self.latencies) / self.elapsed
+
+    def percentile(self, percent: int) -> float:
+        return statistics.quantiles(self.latencies, n=100)[percent - 1]
+
+    def report(self) -> str:
+        return (
+            f'{self.name}: concurrency={self.concurrency} '
+            f'requests={len(self.latencies)} '
+            f'errors={self.errors} '
+            f'throughput={self.throughput:.1f}/s '
+            f'p50={self.percentile(50) * 1000:.1f}ms '
+            f'p99={self.percentile(99) * 1000:.1f}ms'
+        )
+
+
+def make_query(resource_id: str) -> Query:
+    """
+    Creates a unique Query with its versioned datastore derived properties already
+    populated, so that the benchmarks only measure the minting path.
+    """
+    version = int(time.time() * 1000)
+    query = Query(
+        [resource_id],
+        version,
+        {'q': uuid4().hex},
+        'v1.0.0',
+        known_counts={resource_id: 4},
+    )
+    query.__dict__.update(
+        query_hash=uuid4().hex,
+        resources_and_versions={resource_id: version},
+        authors=['Benchmark author'],
+    )
+    return query
+
+
+def run_benchmark(
+    app, name: str, func: Callable, args: List[tuple], concurrency: int
+) -> BenchmarkResult:
+    """
+    Calls the function with each of the argument tuples using the given number of
+    threads and times each call.
+
+    Calls which raise an error are counted as errors but are still timed.
+    """
+
+    def timed_call(call_args):
+        with app.flask_app.test_request_context():
+            start = time.perf_counter()
+            try:
+                func(*call_args)
+                failed = False
+            except Exception:
+                failed = True
+            finally:
+                model.Session.remove()
+            return time.perf_counter() - start, failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_call, args))
+    elapsed = time.perf_counter() - start
+    latencies = [call_latency for call_latency, _failed in results]
+    errors = sum(failed for _call_latency, failed in results)
+    result = BenchmarkResult(name, concurrency, elapsed, latencies, errors)
+    print(result.report())
+    return result
+
+
+@pytest.fixture
+def fake_mds():
+    adapter = FakeMDSAdapter(latency=latency, error_rate=error_rate, seed=1)
+    client = make_fake_client(adapter, PREFIX, backoff=0, breaker_threshold=1000)
+    with patch('ckanext.query_dois.lib.doi.get_client', MagicMock(return_value=client)):
+        yield adapter
+
+
+@pytest.mark.parametrize('concurrency', CONCURRENCY_LEVELS)
+def test_mint_multisearch_doi(app, fake_mds, concurrency):
+    args = [(make_query(uuid4().hex),) for _ in range(REQUESTS_PER_LEVEL)]
+    run_benchmark(app, 'mint_multisearch_doi', mint_multisearch_doi, args, concurrency)
+    if error_rate == 0:
+        assert len(fake_mds.dois) == REQUESTS_PER_LEVEL
+
+
+@pytest.mark.parametrize('concurrency', CONCURRENCY_LEVELS)
+def test_mint_identical_queries(app, fake_mds, concurrency):
+    query = make_query(uuid4().hex)
+    args = [(query,) for _ in range(REQUESTS_PER_LEVEL)]
+    run_benchmark(
+        app, 'mint_identical_queries', mint_multisearch_doi, args, concurrency
+    )
+    if error_rate == 0:
+        # only the first call should have minted a DOI
+        assert len(fake_mds.dois) == 1
+
+
+@pytest.mark.parametrize('concurrency', CONCURRENCY_LEVELS)
+def test_create_doi_action(app, fake_mds, concurrency):
+    action = toolkit.get_action('create_doi')
+
+    def create_doi(resource_id):
+        data_dict = {'resource_ids': [resource_id], 'email_address': 'a@b.com'}
+        return action({'ignore_auth': True}, data_dict)
+
+    args = [(uuid4().hex,) for _ in range(REQUESTS_PER_LEVEL)]
+    with patch(
+        'ckanext.query_dois.logic.action.Query.create',
+        MagicMock(side_effect=lambda resource_ids, *a: make_query(resource_ids[0])),
+    ), patch(
+        'ckanext.query_dois.logic.action.send_saved_search_email',
+        MagicMock(return_value=True),
+    ):
+        run_benchmark(app, 'create_doi', create_doi, args, concurrency)
+    if error_rate == 0:
+        assert len(fake_mds.dois) == REQUESTS_PER_LEVEL
@@ -0,0 +1,24 @@
+import pytest
+from ckan import model
+
+from ckanext.query_dois.model import (
+    query_doi_identifier_alias_table,
+    query_doi_pool_table,
+    query_doi_stat_table,
+    query_doi_table,
+    query_doi_usage_table,
+)
+
+
+@pytest.fixture
+def setup_db():
+    tables = (
+        query_doi_table,
+        query_doi_stat_table,
+        query_doi_pool_table,
+        query_doi_usage_table,
+        query_doi_identifier_alias_table,
+    )
+    for table in tables:
+        if not table.exists(model.meta.engine):
+            table.create(model.meta.engine)
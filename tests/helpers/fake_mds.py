@@ -0,0 +1,123 @@
+import random
+import re
+import threading
+import time
+from typing import Optional
+from urllib.parse import unquote, urlparse
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.models import Response
+
+from ckanext.query_dois.lib.datacite import PooledDataCiteMDSClient
+
+FAKE_MDS_URL = 'https://mds.fake.datacite.org/'
+
+identifier_regex = re.compile(r'<identifier identifierType="DOI">(.+?)</identifier>')
+
+
+class FakeMDSAdapter(BaseAdapter):
+    """
+    A requests transport adapter which acts as a stand-in for the DataCite MDS API. It
+    supports the metadata GET/POST and DOI GET/POST endpoints used by the DataCite
+    client, storing everything in memory. Each request can be delayed by a configurable
+    latency and can fail with a 500 response at a configurable rate.
+    """
+
+    def __init__(
+        self, latency: float = 0, error_rate: float = 0, seed: Optional[int] = None
+    ):
+        """
+        :param latency: the number of seconds each request takes
+        :param error_rate: the probability (0-1) of any request failing with a 500
+        :param seed: the random seed used to decide which requests fail
+        """
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        # doi -> metadata xml
+        self.metadata = {}
+        # doi -> landing page url
+        self.dois = {}
+        self.request_count = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.request_count += 1
+            if self._random.random() < self.error_rate:
+                return self._respond(request, 500, 'Internal Server Error')
+
+            path = unquote(urlparse(request.url).path).lstrip('/')
+            body = request.body or b''
+            if isinstance(body, bytes):
+                body = body.decode('utf-8')
+
+            endpoint, _, doi = path.partition('/')
+            if endpoint == 'metadata' and request.method == 'GET':
+                if doi in self.metadata:
+                    return self._respond(request, 200, self.metadata[doi])
+                return self._respond(request, 404, 'DOI not found')
+
+            if endpoint == 'metadata' and request.method == 'POST':
+                match = identifier_regex.search(body)
+                if match is None:
+                    return self._respond(request, 400, 'Bad Request')
+                self.metadata[match.group(1)] = body
+                return self._respond(request, 201, f'OK ({match.group(1)})')
+
+            if endpoint == 'doi' and request.method == 'GET':
+                if doi in self.dois:
+                    return self._respond(request, 200, self.dois[doi])
+                return self._respond(request, 404, 'DOI not found')
+
+            if endpoint == 'doi' and request.method == 'POST':
+                params = dict(
+                    line.split('=', 1) for line in body.split('\r\n') if '=' in line
+                )
+                if params.get('doi') not in self.metadata:
+                    return self._respond(
+                        request, 412, 'You have to register metadata first!'
+                    )
+                self.dois[params['doi']] = params['url']
+                return self._respond(request, 201, 'OK')
+
+            return self._respond(request, 404, 'Not Found')
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _respond(request, status_code: int, text: str) -> Response:
+        response = Response()
+        response.status_code = status_code
+        response._content = text.encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+
+def make_fake_client(adapter: FakeMDSAdapter, prefix: str, **kwargs):
+    """
+    Creates a DataCite client which sends all its requests to the given fake adapter.
+
+    :param adapter: the FakeMDSAdapter
+    :param prefix: the DOI prefix
+    :param kwargs: any other PooledDataCiteMDSClient parameters
+    :returns: a PooledDataCiteMDSClient
+    """
+    session = requests.Session()
+    session.mount(FAKE_MDS_URL, adapter)
+    return PooledDataCiteMDSClient(
+        username='fake',
+        password='fake',
+        prefix=prefix,
+        url=FAKE_MDS_URL,
+        session=session,
+        **kwargs,
+    )
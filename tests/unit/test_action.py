@@ -0,0 +1,151 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.query_dois.lib.doi import MintResult
+from ckanext.query_dois.logic.action import create_dois_bulk
+
+action_module = 'ckanext.query_dois.logic.action'
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'query_dois')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestCreateDOIsBulkAuth:
+    def test_anonymous_users_are_refused(self):
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_auth('create_dois_bulk', {'user': '', 'model': model})
+
+    def test_logged_in_users_are_allowed(self):
+        user = factories.User()
+        assert helpers.call_auth(
+            'create_dois_bulk', {'user': user['name'], 'model': model}
+        )
+
+    def test_action_checks_access(self):
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_action(
+                'create_dois_bulk',
+                context={'user': '', 'ignore_auth': False},
+                queries=[{'resource_ids': ['r1']}],
+            )
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'query_dois')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestCreateDOIsBulkSchema:
+    def test_queries_are_required(self):
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('create_dois_bulk', queries=[])
+
+    def test_resource_ids_are_required(self):
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('create_dois_bulk', queries=[{'query': {}}])
+
+    def test_email_address_must_be_valid(self):
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action(
+                'create_dois_bulk',
+                email_address='not an email address',
+                queries=[{'resource_ids': ['r1']}],
+            )
+
+    @pytest.mark.ckan_config('ckanext.query_dois.bulk_max_queries', 2)
+    def test_number_of_queries_is_capped(self):
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action(
+                'create_dois_bulk', queries=[{'resource_ids': ['r1']}] * 3
+            )
+
+
+@patch(f'{action_module}.toolkit.check_access', MagicMock())
+@patch(f'{action_module}.anonymize_email', return_value=('someone', 'example.com'))
+@patch(f'{action_module}.record_stat')
+@patch(f'{action_module}.mint_multisearch_dois')
+@patch(f'{action_module}.Query.create')
+@patch(f'{action_module}.find_invalid_resources', return_value=[])
+class TestCreateDOIsBulk:
+    def test_results_are_in_order(
+        self, invalid_mock, create_mock, mint_mock, record_mock, anonymize_mock
+    ):
+        invalid_mock.return_value = ['r2']
+        query_dois = [MagicMock(doi='10.1234/qd.one'), MagicMock(doi='10.1234/qd.two')]
+        mint_mock.return_value = [
+            MintResult(True, query_dois[0]),
+            MintResult(False, query_dois[1]),
+            MintResult(error='Failed to register DOI: timed out'),
+        ]
+        specs = [
+            {'resource_ids': ['r1'], 'query_version': 'v1.0.0'},
+            {'resource_ids': ['r2'], 'query_version': 'v1.0.0'},
+            {'resource_ids': ['r1'], 'query_version': 'v1.0.0', 'version': 1},
+            {'resource_ids': ['r3'], 'query_version': 'v1.0.0'},
+        ]
+
+        result = create_dois_bulk({}, {'queries': specs})
+
+        assert result['results'][0] == {'is_new': True, 'doi': '10.1234/qd.one'}
+        assert 'r2' in result['results'][1]['error']
+        assert result['results'][2] == {'is_new': False, 'doi': '10.1234/qd.two'}
+        assert result['results'][3] == {'error': 'Failed to register DOI: timed out'}
+        assert result['email_sent'] is None
+        # the resources are only checked once, for all the queries
+        invalid_mock.assert_called_once_with({'r1', 'r2', 'r3'})
+        assert create_mock.call_count == 3
+        # stats are only recorded for the DOIs
+        assert record_mock.call_count == 2
+
+    @patch(f'{action_module}.send_saved_search_email', return_value=True)
+    def test_one_email_lists_each_doi_once(
+        self,
+        send_mock,
+        invalid_mock,
+        create_mock,
+        mint_mock,
+        record_mock,
+        anonymize_mock,
+    ):
+        query_doi = MagicMock(doi='10.1234/qd.one')
+        mint_mock.return_value = [
+            MintResult(True, query_doi),
+            MintResult(False, query_doi),
+        ]
+        spec = {'resource_ids': ['r1'], 'query_version': 'v1.0.0'}
+
+        result = create_dois_bulk(
+            {}, {'queries': [spec, spec], 'email_address': 'someone@example.com'}
+        )
+
+        assert [r['is_new'] for r in result['results']] == [True, False]
+        assert result['email_sent'] is True
+        send_mock.assert_called_once_with('someone@example.com', query_doi)
+        anonymize_mock.assert_called_once_with('someone@example.com')
+
+    @pytest.mark.ckan_config('ckanext.query_dois.async_emails', 'true')
+    @patch(f'{action_module}.queue_saved_search_email')
+    def test_email_can_be_queued(
+        self,
+        queue_mock,
+        invalid_mock,
+        create_mock,
+        mint_mock,
+        record_mock,
+        anonymize_mock,
+    ):
+        query_dois = [MagicMock(doi='10.1234/qd.one'), MagicMock(doi='10.1234/qd.two')]
+        mint_mock.return_value = [
+            MintResult(True, query_doi) for query_doi in query_dois
+        ]
+        specs = [
+            {'resource_ids': ['r1'], 'query_version': 'v1.0.0'},
+            {'resource_ids': ['r2'], 'query_version': 'v1.0.0'},
+        ]
+
+        result = create_dois_bulk(
+            {}, {'queries': specs, 'email_address': 'someone@example.com'}
+        )
+
+        assert result['email_sent'] == 'queued'
+        queue_mock.assert_called_once_with('someone@example.com', *query_dois)
@@ -0,0 +1,56 @@
+from unittest.mock import patch
+
+from ckanext.query_dois.lib.cache import LRUCache
+
+
+class TestLRUCache:
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert cache.get('b', 5) == 5
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # access a so that b becomes the least recently used entry
+        cache.get('a')
+        cache.set('c', 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert len(cache) == 2
+
+    def test_pop(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        assert cache.pop('a') == 1
+        assert cache.pop('a') is None
+        assert len(cache) == 0
+
+    def test_zero_size_caches_nothing(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        assert 'a' not in cache
+
+    def test_entries_expire(self):
+        cache = LRUCache(2, ttl=10)
+        with patch('ckanext.query_dois.lib.cache.time.monotonic', return_value=0):
+            cache.set('a', 1)
+        with patch('ckanext.query_dois.lib.cache.time.monotonic', return_value=5):
+            assert cache.get('a') == 1
+        with patch('ckanext.query_dois.lib.cache.time.monotonic', return_value=10):
+            assert cache.get('a') is None
+            assert 'a' not in cache
+
+    def test_pop_where(self):
+        cache = LRUCache(4)
+        cache.set(('a', 1), 1)
+        cache.set(('a', 2), 2)
+        cache.set(('b', 1), 3)
+        assert cache.pop_where(lambda key: key[0] == 'a') == 2
+        assert ('a', 1) not in cache
+        assert ('a', 2) not in cache
+        assert cache.get(('b', 1)) == 3
@@ -0,0 +1,24 @@
+from unittest.mock import MagicMock, patch
+
+from click.testing import CliRunner
+
+from ckanext.query_dois.cli import query_dois
+
+
+@patch('ckanext.query_dois.cli.queue_registration')
+@patch('ckanext.query_dois.cli.model.Session')
+def test_register_pending(session_mock, queue_mock):
+    pending = [MagicMock(), MagicMock()]
+    session_mock.query.return_value.filter.return_value = pending
+    result = CliRunner().invoke(query_dois, ['register-pending'])
+    assert result.exit_code == 0, result.output
+    assert [c.args[0] for c in queue_mock.call_args_list] == pending
+    assert 'Queued registration of 2 pending DOIs' in result.output
+
+
+@patch('ckanext.query_dois.cli.get_stat_spool')
+def test_flush_stats(get_spool_mock):
+    get_spool_mock.return_value.flush.return_value = 3
+    result = CliRunner().invoke(query_dois, ['flush-stats'])
+    assert result.exit_code == 0, result.output
+    assert 'Wrote 3 spooled stats' in result.output
@@ -0,0 +1,86 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from datacite.errors import DataCiteServerError
+from requests.exceptions import ConnectionError
+
+from ckanext.query_dois.lib.datacite import (
+    CircuitBreaker,
+    DataCiteUnavailableError,
+    PooledDataCiteMDSClient,
+)
+
+
+def make_client(responses, **kwargs):
+    session = MagicMock()
+    session.request.side_effect = responses
+    client = PooledDataCiteMDSClient(
+        username='user',
+        password='password',
+        prefix='10.1234',
+        session=session,
+        backoff=0,
+        **kwargs,
+    )
+    return client, session
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(2, 60)
+        breaker.record_failure()
+        assert not breaker.is_open
+        breaker.record_failure()
+        assert breaker.is_open
+
+    def test_success_resets(self):
+        breaker = CircuitBreaker(2, 60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        assert not breaker.is_open
+
+    def test_closes_after_reset_timeout(self):
+        breaker = CircuitBreaker(1, 60)
+        with patch('ckanext.query_dois.lib.datacite.time.monotonic', return_value=0):
+            breaker.record_failure()
+        with patch('ckanext.query_dois.lib.datacite.time.monotonic', return_value=60):
+            assert not breaker.is_open
+
+
+class TestPooledDataCiteMDSClient:
+    def test_uses_session(self):
+        client, session = make_client([MagicMock(status_code=200, text='xml')])
+        assert client.metadata_get('10.1234/qd.abc') == 'xml'
+        method, url = session.request.call_args[0]
+        assert method == 'GET'
+        assert url.endswith('metadata/10.1234/qd.abc')
+
+    def test_retries_server_errors(self):
+        client, session = make_client(
+            [
+                MagicMock(status_code=503, text='down'),
+                ConnectionError(),
+                MagicMock(status_code=200, text='xml'),
+            ]
+        )
+        assert client.metadata_get('10.1234/qd.abc') == 'xml'
+        assert session.request.call_count == 3
+
+    def test_gives_up_after_retries(self):
+        client, session = make_client(
+            [MagicMock(status_code=503, text='down')] * 3, retries=2
+        )
+        with pytest.raises(DataCiteServerError):
+            client.metadata_get('10.1234/qd.abc')
+        assert session.request.call_count == 3
+
+    def test_breaker_fails_fast(self):
+        client, session = make_client(
+            [MagicMock(status_code=503, text='down')], retries=0, breaker_threshold=1
+        )
+        with pytest.raises(DataCiteServerError):
+            client.metadata_get('10.1234/qd.abc')
+        with pytest.raises(DataCiteUnavailableError):
+            client.metadata_get('10.1234/qd.abc')
+        assert session.request.call_count == 1
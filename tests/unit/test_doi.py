@@ -0,0 +1,644 @@
+from contextlib import nullcontext
+from datetime import datetime
+from unittest.mock import ANY, MagicMock, PropertyMock, patch
+from uuid import uuid4
+
+import pytest
+from ckan import model
+from datacite.errors import DataCiteNotFoundError, HttpError
+from sqlalchemy import select
+
+from ckanext.query_dois.lib import doi as doi_lib
+from ckanext.query_dois.lib.doi import (
+    MintLockTimeoutError,
+    backfill_authors,
+    claim_pooled_doi,
+    fill_doi_pool,
+    generate_doi,
+    mint_multisearch_doi,
+    mint_multisearch_dois,
+    queue_pool_refill,
+    register_doi,
+    reserve_doi,
+)
+from ckanext.query_dois.model import (
+    PENDING_STATUS,
+    REGISTERED_STATUS,
+    query_doi_pool_table,
+)
+
+doi_module = 'ckanext.query_dois.lib.doi'
+
+
+@pytest.fixture
+def session_mock():
+    with patch(f'{doi_module}.model.Session') as session:
+        yield session
+
+
+@pytest.mark.ckan_config('ckanext.query_dois.prefix', '10.1234')
+@patch(f'{doi_module}.is_pooled', MagicMock(return_value=False))
+class TestGenerateDOI:
+    def test_checks_datacite_by_default(self, session_mock):
+        session_mock.query.return_value.filter.return_value.count.return_value = 0
+        client = MagicMock()
+        client.metadata_get.side_effect = DataCiteNotFoundError
+        with patch(f'{doi_module}.get_client', return_value=client):
+            doi = generate_doi()
+        assert doi.startswith('10.1234/qd.')
+        client.metadata_get.assert_called_once_with(doi)
+
+    @pytest.mark.ckan_config('ckanext.query_dois.skip_datacite_check', 'true')
+    def test_datacite_check_can_be_skipped(self, session_mock):
+        session_mock.query.return_value.filter.return_value.count.return_value = 0
+        with patch(f'{doi_module}.get_client') as get_client_mock:
+            doi = generate_doi()
+        assert doi.startswith('10.1234/qd.')
+        assert not get_client_mock.called
+
+
+@patch(f'{doi_module}.invalidate_landing_page')
+@patch(f'{doi_module}.Query.from_query_doi')
+@patch(f'{doi_module}.get_client')
+@patch(f'{doi_module}.create_doi_on_datacite')
+class TestRegisterDOI:
+    def test_pending_doi_is_registered(
+        self,
+        create_mock,
+        get_client_mock,
+        from_query_doi_mock,
+        invalidate_mock,
+        session_mock,
+    ):
+        query_doi = MagicMock(
+            doi='10.1234/qd.abcdefgh', status=PENDING_STATUS, is_registered=False
+        )
+        session_mock.query.return_value.filter.return_value.first.return_value = (
+            query_doi
+        )
+        register_doi('10.1234/qd.abcdefgh')
+        create_mock.assert_called_once_with(
+            get_client_mock.return_value,
+            '10.1234/qd.abcdefgh',
+            query_doi.timestamp,
+            from_query_doi_mock.return_value,
+        )
+        assert query_doi.status == REGISTERED_STATUS
+        query_doi.save.assert_called_once()
+        invalidate_mock.assert_called_once_with('10.1234/qd.abcdefgh')
+
+    def test_registered_doi_is_skipped(
+        self,
+        create_mock,
+        get_client_mock,
+        from_query_doi_mock,
+        invalidate_mock,
+        session_mock,
+    ):
+        query_doi = MagicMock(status=REGISTERED_STATUS, is_registered=True)
+        session_mock.query.return_value.filter.return_value.first.return_value = (
+            query_doi
+        )
+        register_doi('10.1234/qd.abcdefgh')
+        assert not create_mock.called
+        assert not query_doi.save.called
+
+    @pytest.mark.ckan_config('ckanext.query_dois.registration_attempts', 2)
+    @pytest.mark.ckan_config('ckanext.query_dois.registration_backoff', 0)
+    def test_failed_registration_is_left_pending(
+        self,
+        create_mock,
+        get_client_mock,
+        from_query_doi_mock,
+        invalidate_mock,
+        session_mock,
+    ):
+        query_doi = MagicMock(status=PENDING_STATUS, is_registered=False)
+        session_mock.query.return_value.filter.return_value.first.return_value = (
+            query_doi
+        )
+        create_mock.side_effect = HttpError
+        with pytest.raises(HttpError):
+            register_doi('10.1234/qd.abcdefgh')
+        assert create_mock.call_count == 2
+        assert query_doi.status == PENDING_STATUS
+        assert not query_doi.save.called
+
+
+@pytest.mark.ckan_config('ckanext.query_dois.async_minting', 'true')
+@patch(f'{doi_module}.mint_lock', MagicMock(return_value=nullcontext()))
+@patch(f'{doi_module}.find_existing_doi', MagicMock(return_value=None))
+@patch(f'{doi_module}.create_doi_on_datacite')
+@patch(f'{doi_module}.queue_registration')
+@patch(f'{doi_module}.insert_or_get')
+@patch(f'{doi_module}.reserve_doi')
+class TestAsyncMinting:
+    def test_doi_is_pending_and_registration_queued(
+        self, reserve_mock, insert_mock, queue_mock, create_mock
+    ):
+        query = MagicMock()
+        query_doi = MagicMock()
+        insert_mock.return_value = (True, query_doi)
+        created, minted = mint_multisearch_doi(query)
+        assert created
+        assert minted is query_doi
+        insert_mock.assert_called_once_with(
+            reserve_mock.return_value, query, ANY, PENDING_STATUS
+        )
+        queue_mock.assert_called_once_with(query_doi)
+        # the user shouldn't have to wait for DataCite
+        assert not create_mock.called
+
+    def test_registration_not_queued_if_another_request_won(
+        self, reserve_mock, insert_mock, queue_mock, create_mock
+    ):
+        existing = MagicMock()
+        insert_mock.return_value = (False, existing)
+        created, minted = mint_multisearch_doi(MagicMock())
+        assert not created
+        assert minted is existing
+        assert not queue_mock.called
+
+
+@patch(f'{doi_module}.mint_lock', MagicMock(return_value=nullcontext()))
+@patch(f'{doi_module}.find_existing_doi', MagicMock(return_value=None))
+@patch(f'{doi_module}.get_client', MagicMock())
+@patch(f'{doi_module}.mark_registered')
+@patch(f'{doi_module}.create_doi_on_datacite')
+@patch(f'{doi_module}.insert_or_get')
+@patch(f'{doi_module}.reserve_doi')
+class TestSyncMinting:
+    def test_doi_is_pending_until_registered(
+        self, reserve_mock, insert_mock, create_mock, mark_mock
+    ):
+        query = MagicMock()
+        query_doi = MagicMock()
+        insert_mock.return_value = (True, query_doi)
+        created, minted = mint_multisearch_doi(query)
+        assert created
+        assert minted is query_doi
+        insert_mock.assert_called_once_with(
+            reserve_mock.return_value, query, ANY, PENDING_STATUS
+        )
+        create_mock.assert_called_once_with(ANY, reserve_mock.return_value, ANY, query)
+        mark_mock.assert_called_once_with(query_doi)
+
+    def test_failed_registration_is_left_pending(
+        self, reserve_mock, insert_mock, create_mock, mark_mock
+    ):
+        insert_mock.return_value = (True, MagicMock())
+        create_mock.side_effect = HttpError()
+        with pytest.raises(HttpError):
+            mint_multisearch_doi(MagicMock())
+        assert insert_mock.called
+        assert not mark_mock.called
+
+    def test_not_registered_if_another_request_won(
+        self, reserve_mock, insert_mock, create_mock, mark_mock
+    ):
+        existing = MagicMock()
+        insert_mock.return_value = (False, existing)
+        created, minted = mint_multisearch_doi(MagicMock())
+        assert not created
+        assert minted is existing
+        assert not create_mock.called
+        assert not mark_mock.called
+
+
+@patch(f'{doi_module}.mint_lock', MagicMock(return_value=nullcontext()))
+@patch(f'{doi_module}.get_client', MagicMock())
+@patch(f'{doi_module}.create_registration', return_value=('metadata', 'url'))
+@patch(f'{doi_module}.mark_registered')
+@patch(f'{doi_module}.post_to_datacite')
+@patch(f'{doi_module}.insert_or_get')
+@patch(f'{doi_module}.find_existing_doi')
+class TestPendingDOIs:
+    def test_pending_doi_is_registered_again(
+        self, find_mock, insert_mock, post_mock, mark_mock, registration_mock
+    ):
+        pending = MagicMock(doi='10.1234/qd.pending', is_registered=False)
+        find_mock.return_value = pending
+        created, minted = mint_multisearch_doi(MagicMock())
+        assert not created
+        assert minted is pending
+        post_mock.assert_called_once_with(ANY, pending.doi, 'metadata', 'url')
+        mark_mock.assert_called_once_with(pending)
+        assert not insert_mock.called
+
+    def test_pending_doi_is_not_returned_if_registration_fails_again(
+        self, find_mock, insert_mock, post_mock, mark_mock, registration_mock
+    ):
+        find_mock.return_value = MagicMock(is_registered=False)
+        post_mock.side_effect = HttpError('timed out')
+        with pytest.raises(HttpError):
+            mint_multisearch_doi(MagicMock())
+        assert not mark_mock.called
+
+    def test_registered_doi_is_returned(
+        self, find_mock, insert_mock, post_mock, mark_mock, registration_mock
+    ):
+        registered = MagicMock(is_registered=True)
+        find_mock.return_value = registered
+        assert mint_multisearch_doi(MagicMock()) == (False, registered)
+        assert not post_mock.called
+
+    @pytest.mark.ckan_config('ckanext.query_dois.async_minting', 'true')
+    def test_async_pending_doi_is_returned(
+        self, find_mock, insert_mock, post_mock, mark_mock, registration_mock
+    ):
+        pending = MagicMock(is_registered=False)
+        find_mock.return_value = pending
+        assert mint_multisearch_doi(MagicMock()) == (False, pending)
+        assert not post_mock.called
+
+
+@pytest.fixture
+def connection_mock():
+    with patch(f'{doi_module}.model.meta.engine') as engine:
+        yield engine.connect.return_value
+
+
+@pytest.mark.ckan_config('ckanext.query_dois.mint_lock_timeout', '0.05')
+class TestMintLock:
+    def test_lock_is_taken_and_released(self, connection_mock):
+        connection_mock.execute.return_value.scalar.side_effect = [False, True]
+        with doi_lib.mint_lock(MagicMock(), poll_interval=0.01):
+            # the lock was polled for until it was free
+            assert connection_mock.execute.call_count == 2
+            # the connection is returned to the pool between attempts
+            assert connection_mock.close.call_count == 1
+        assert connection_mock.execute.call_count == 3
+        assert 'pg_advisory_unlock' in str(connection_mock.execute.call_args.args[0])
+        assert connection_mock.close.call_count == 2
+
+    def test_wait_is_bounded(self, connection_mock):
+        connection_mock.execute.return_value.scalar.return_value = False
+        with pytest.raises(MintLockTimeoutError):
+            with doi_lib.mint_lock(MagicMock(), poll_interval=0.01):
+                pass
+        # the lock was never taken so it isn't released
+        assert all(
+            'pg_advisory_unlock' not in str(call.args[0])
+            for call in connection_mock.execute.call_args_list
+        )
+        # each connection was returned to the pool
+        assert connection_mock.close.call_count == connection_mock.execute.call_count
+
+    @patch(f'{doi_module}.reserve_doi')
+    @patch(f'{doi_module}.find_existing_doi')
+    def test_doi_minted_during_timeout_is_returned(
+        self, find_mock, reserve_mock, connection_mock
+    ):
+        connection_mock.execute.return_value.scalar.return_value = False
+        existing = MagicMock()
+        find_mock.side_effect = [None, existing]
+        created, minted = mint_multisearch_doi(MagicMock())
+        assert not created
+        assert minted is existing
+        assert not reserve_mock.called
+
+    @patch(f'{doi_module}.find_existing_doi', MagicMock(return_value=None))
+    def test_timeout_is_raised_without_a_doi(self, connection_mock):
+        connection_mock.execute.return_value.scalar.return_value = False
+        with pytest.raises(MintLockTimeoutError):
+            mint_multisearch_doi(MagicMock())
+
+    @patch(f'{doi_module}.find_existing_doi')
+    def test_timeout_is_raised_if_the_doi_is_pending(self, find_mock, connection_mock):
+        connection_mock.execute.return_value.scalar.return_value = False
+        find_mock.side_effect = [None, MagicMock(is_registered=False)]
+        with pytest.raises(MintLockTimeoutError):
+            mint_multisearch_doi(MagicMock())
+
+
+@patch(f'{doi_module}.invalidate_landing_page')
+@patch(f'{doi_module}.find_authors', side_effect=lambda ids: [f'author of {ids[0]}'])
+class TestBackfillAuthors:
+    def test_authors_are_stored_in_batches(
+        self, find_mock, invalidate_mock, session_mock
+    ):
+        batches = [
+            [
+                MagicMock(doi='doi1', get_resource_ids=lambda: ['r2', 'r1']),
+                MagicMock(doi='doi2', get_resource_ids=lambda: ['r3']),
+            ],
+            [MagicMock(doi='doi3', get_resource_ids=lambda: ['r4'])],
+            [],
+        ]
+        query_mock = session_mock.query.return_value.filter.return_value
+        query_mock.order_by.return_value.limit.return_value.all.side_effect = batches
+
+        assert backfill_authors(batch_size=2) == 3
+
+        doi_1, doi_2, doi_3 = batches[0] + batches[1]
+        # the resources are sorted, as they are when minting
+        assert doi_1.authors == ['author of r1']
+        assert doi_2.authors == ['author of r3']
+        assert doi_3.authors == ['author of r4']
+        assert session_mock.commit.call_count == 2
+        assert [c.args[0] for c in invalidate_mock.call_args_list] == [
+            'doi1',
+            'doi2',
+            'doi3',
+        ]
+
+
+def add_to_pool(*dois):
+    model.Session.execute(
+        query_doi_pool_table.insert(),
+        [dict(doi=doi, timestamp=datetime.now()) for doi in dois],
+    )
+    model.Session.commit()
+
+
+@pytest.mark.ckan_config('ckanext.query_dois.prefix', '10.1234')
+@pytest.mark.usefixtures('clean_db', 'setup_db')
+class TestClaimPooledDOI:
+    def test_dois_are_claimed_in_order(self):
+        add_to_pool('10.1234/qd.first', '10.1234/qd.second')
+        assert claim_pooled_doi() == '10.1234/qd.first'
+        assert claim_pooled_doi() == '10.1234/qd.second'
+        assert claim_pooled_doi() is None
+
+    def test_empty_pool(self):
+        assert claim_pooled_doi() is None
+
+    def test_other_prefixes_are_ignored(self):
+        add_to_pool('10.5678/qd.other', '10.1234/qd.mine')
+        assert claim_pooled_doi() == '10.1234/qd.mine'
+        assert claim_pooled_doi() is None
+
+    def test_locked_dois_are_skipped(self):
+        add_to_pool('10.1234/qd.first', '10.1234/qd.second')
+        table = query_doi_pool_table
+        # simulate a concurrent claim which has locked the first DOI
+        with model.meta.engine.begin() as connection:
+            connection.execute(
+                select([table.c.id])
+                .where(table.c.doi == '10.1234/qd.first')
+                .with_for_update()
+            )
+            assert claim_pooled_doi() == '10.1234/qd.second'
+        assert claim_pooled_doi() == '10.1234/qd.first'
+
+
+@pytest.mark.ckan_config('ckanext.query_dois.pool_size', 10)
+@patch(f'{doi_module}.queue_pool_refill', MagicMock())
+class TestReserveDOI:
+    @patch(f'{doi_module}.generate_doi')
+    @patch(f'{doi_module}.claim_pooled_doi', return_value='10.1234/qd.pooled')
+    def test_pooled_doi_is_used(self, claim_mock, generate_mock):
+        assert reserve_doi() == '10.1234/qd.pooled'
+        assert not generate_mock.called
+
+    @patch(f'{doi_module}.generate_doi', return_value='10.1234/qd.new')
+    @patch(f'{doi_module}.claim_pooled_doi', return_value=None)
+    def test_falls_back_to_generating_when_pool_is_empty(
+        self, claim_mock, generate_mock
+    ):
+        client = MagicMock()
+        assert reserve_doi(client) == '10.1234/qd.new'
+        generate_mock.assert_called_once_with(client)
+
+    @pytest.mark.ckan_config('ckanext.query_dois.pool_size', 0)
+    @patch(f'{doi_module}.generate_doi', return_value='10.1234/qd.new')
+    @patch(f'{doi_module}.claim_pooled_doi')
+    def test_pool_is_skipped_when_disabled(self, claim_mock, generate_mock):
+        assert reserve_doi() == '10.1234/qd.new'
+        assert not claim_mock.called
+
+
+@pytest.fixture
+def reset_refill():
+    doi_lib._last_refill_queued = None
+    yield
+    doi_lib._last_refill_queued = None
+
+
+@pytest.mark.usefixtures('reset_refill')
+@pytest.mark.ckan_config('ckanext.query_dois.pool_size', 10)
+@patch(f'{doi_module}.enqueue')
+@patch(f'{doi_module}.get_pool_count')
+class TestQueuePoolRefill:
+    def test_refill_is_queued_when_low(self, count_mock, enqueue_mock):
+        count_mock.return_value = 4
+        queue_pool_refill()
+        enqueue_mock.assert_called_once_with(
+            fill_doi_pool, [10], title='Refill DOI pool'
+        )
+
+    def test_refill_is_not_queued_when_full_enough(self, count_mock, enqueue_mock):
+        count_mock.return_value = 5
+        queue_pool_refill()
+        assert not enqueue_mock.called
+
+    def test_refill_is_only_queued_once_a_minute(self, count_mock, enqueue_mock):
+        count_mock.return_value = 0
+        queue_pool_refill()
+        queue_pool_refill()
+        assert enqueue_mock.call_count == 1
+
+    @pytest.mark.ckan_config('ckanext.query_dois.pool_size', 0)
+    def test_refill_is_not_queued_without_a_pool(self, count_mock, enqueue_mock):
+        count_mock.return_value = 0
+        queue_pool_refill()
+        assert not enqueue_mock.called
+
+
+@patch(f'{doi_module}.get_client', MagicMock())
+@patch(f'{doi_module}.get_pool_count')
+@patch(f'{doi_module}.generate_doi')
+class TestFillDOIPool:
+    def test_dois_are_inserted_in_batches(
+        self, generate_mock, count_mock, session_mock
+    ):
+        count_mock.return_value = 1
+        generate_mock.side_effect = [f'10.1234/qd.{i}' for i in range(5)]
+        session_mock.execute.side_effect = [
+            MagicMock(rowcount=3),
+            MagicMock(rowcount=2),
+        ]
+        assert fill_doi_pool(6, batch_size=3) == 5
+        assert session_mock.execute.call_count == 2
+        assert session_mock.commit.call_count == 2
+        assert generate_mock.call_count == 5
+
+    def test_full_pool(self, generate_mock, count_mock, session_mock):
+        count_mock.return_value = 6
+        assert fill_doi_pool(6) == 0
+        assert not generate_mock.called
+
+
+def make_query(query_hash):
+    return MagicMock(query_hash=query_hash, query_version='v1.0.0', fingerprint='f')
+
+
+def insert_or_get(doi, query, timestamp, status):
+    return True, MagicMock(doi=doi, status=status)
+
+
+@patch(f'{doi_module}.mark_registered')
+@patch(f'{doi_module}.post_to_datacite')
+@patch(f'{doi_module}.queue_registration')
+@patch(f'{doi_module}.insert_or_get', side_effect=insert_or_get)
+@patch(f'{doi_module}.find_existing_doi', return_value=None)
+@patch(f'{doi_module}.get_client', MagicMock())
+@patch(f'{doi_module}.get_doi_url', MagicMock())
+@patch(f'{doi_module}.create_datacite_metadata', MagicMock())
+@patch(f'{doi_module}.reserve_doi', side_effect=lambda: f'10.1234/qd.{uuid4().hex}')
+class TestMintMultisearchDOIs:
+    def test_repeated_queries_are_minted_once(
+        self, reserve_mock, find_mock, insert_mock, queue_mock, post_mock, mark_mock
+    ):
+        results = mint_multisearch_dois(
+            [make_query('a'), make_query('a'), make_query('b')]
+        )
+        assert insert_mock.call_count == 2
+        assert [result.created for result in results] == [True, False, True]
+        assert results[0].query_doi is results[1].query_doi
+        assert results[0].query_doi is not results[2].query_doi
+
+    def test_existing_dois_are_returned(
+        self, reserve_mock, find_mock, insert_mock, queue_mock, post_mock, mark_mock
+    ):
+        existing = MagicMock()
+        find_mock.return_value = existing
+        results = mint_multisearch_dois([make_query('a')])
+        assert not results[0].created
+        assert results[0].query_doi is existing
+        assert not reserve_mock.called
+
+    def test_rows_are_pending_until_registered(
+        self, reserve_mock, find_mock, insert_mock, queue_mock, post_mock, mark_mock
+    ):
+        results = mint_multisearch_dois([make_query('a'), make_query('b')])
+        assert all(
+            call.args[3] == PENDING_STATUS for call in insert_mock.call_args_list
+        )
+        assert post_mock.call_count == 2
+        assert {call.args[0] for call in mark_mock.call_args_list} == {
+            result.query_doi for result in results
+        }
+        assert not queue_mock.called
+
+    @pytest.mark.ckan_config('ckanext.query_dois.async_minting', 'true')
+    def test_async_registrations_are_queued(
+        self, reserve_mock, find_mock, insert_mock, queue_mock, post_mock, mark_mock
+    ):
+        results = mint_multisearch_dois([make_query('a'), make_query('b')])
+        assert [call.args[0] for call in queue_mock.call_args_list] == [
+            result.query_doi for result in results
+        ]
+        assert not post_mock.called
+        assert not mark_mock.called
+
+    def test_dois_minted_elsewhere_are_not_registered(
+        self, reserve_mock, find_mock, insert_mock, queue_mock, post_mock, mark_mock
+    ):
+        existing = MagicMock()
+        insert_mock.side_effect = None
+        insert_mock.return_value = (False, existing)
+        results = mint_multisearch_dois([make_query('a')])
+        assert not results[0].created
+        assert results[0].query_doi is existing
+        assert not post_mock.called
+
+    def test_failed_registrations_are_left_pending(
+        self, reserve_mock, find_mock, insert_mock, queue_mock, post_mock, mark_mock
+    ):
+        failing = []
+
+        def post(client, doi, metadata, url):
+            if not failing:
+                failing.append(doi)
+                raise HttpError('timed out')
+
+        post_mock.side_effect = post
+        results = mint_multisearch_dois([make_query('a'), make_query('b')])
+        errors = [result for result in results if result.error]
+        assert len(errors) == 1
+        registered = [call.args[0].doi for call in mark_mock.call_args_list]
+        assert len(registered) == 1
+        assert failing[0] not in registered
+
+    def test_errors_are_captured_for_each_query(
+        self,
+        reserve_mock,
+        find_mock,
+        insert_mock,
+        queue_mock,
+        post_mock,
+        mark_mock,
+        session_mock,
+    ):
+        find_mock.side_effect = [Exception('database error'), None]
+        results = mint_multisearch_dois([make_query('a'), make_query('b')])
+        assert results[0].error == 'Failed to mint DOI: database error'
+        assert results[1].created
+        assert session_mock.rollback.called
+
+    def test_key_errors_are_captured_for_each_query(
+        self,
+        reserve_mock,
+        find_mock,
+        insert_mock,
+        queue_mock,
+        post_mock,
+        mark_mock,
+        session_mock,
+    ):
+        broken = make_query('a')
+        type(broken).query_hash = PropertyMock(side_effect=Exception('vds error'))
+        results = mint_multisearch_dois([broken, make_query('b'), broken])
+        assert results[0].error == 'Failed to mint DOI: vds error'
+        assert results[1].created
+        assert results[2].error == 'Failed to mint DOI: vds error'
+        assert insert_mock.call_count == 1
+
+    @patch(f'{doi_module}.create_registration', return_value=('metadata', 'url'))
+    def test_pending_dois_are_registered_again(
+        self,
+        registration_mock,
+        reserve_mock,
+        find_mock,
+        insert_mock,
+        queue_mock,
+        post_mock,
+        mark_mock,
+    ):
+        pending = MagicMock(doi='10.1234/qd.pending', is_registered=False)
+        find_mock.return_value = pending
+        results = mint_multisearch_dois([make_query('a')])
+        assert not results[0].created
+        assert results[0].query_doi is pending
+        assert not insert_mock.called
+        post_mock.assert_called_once_with(ANY, pending.doi, 'metadata', 'url')
+        mark_mock.assert_called_once_with(pending)
+
+    @patch(f'{doi_module}.create_registration', return_value=('metadata', 'url'))
+    def test_pending_dois_are_not_returned_if_registration_fails_again(
+        self,
+        registration_mock,
+        reserve_mock,
+        find_mock,
+        insert_mock,
+        queue_mock,
+        post_mock,
+        mark_mock,
+    ):
+        find_mock.return_value = MagicMock(is_registered=False)
+        post_mock.side_effect = HttpError('timed out')
+        results = mint_multisearch_dois([make_query('a')])
+        assert results[0].error == 'Failed to register DOI: timed out'
+        assert not mark_mock.called
+
+    @pytest.mark.ckan_config('ckanext.query_dois.async_minting', 'true')
+    def test_async_pending_dois_are_left_to_the_job(
+        self, reserve_mock, find_mock, insert_mock, queue_mock, post_mock, mark_mock
+    ):
+        pending = MagicMock(is_registered=False)
+        find_mock.return_value = pending
+        results = mint_multisearch_dois([make_query('a')])
+        assert results[0].query_doi is pending
+        assert not post_mock.called
+        assert not queue_mock.called
@@ -0,0 +1,119 @@
+import smtplib
+import socket
+from unittest.mock import MagicMock, patch
+
+import pytest
+from ckan.lib import mailer
+
+from ckanext.query_dois.lib.emails import (
+    deliver_saved_search_email,
+    get_saved_search_body,
+    is_transient_email_error,
+    send_saved_search_email,
+)
+
+
+def mailer_error(error):
+    # mimic the way CKAN's mailer replaces the underlying error
+    try:
+        raise error
+    except Exception:
+        try:
+            raise mailer.MailerException(repr(error))
+        except mailer.MailerException as e:
+            return e
+
+
+def test_get_saved_search_body_lists_all_dois():
+    body = get_saved_search_body(['10.1234/qd.one', '10.1234/qd.two'])
+    assert 'https://doi.org/10.1234/qd.one' in body
+    assert 'https://doi.org/10.1234/qd.two' in body
+
+
+class TestIsTransientEmailError:
+    @pytest.mark.parametrize(
+        'error',
+        [
+            smtplib.SMTPServerDisconnected(),
+            socket.timeout(),
+            ConnectionRefusedError(),
+            smtplib.SMTPDataError(451, b'try again later'),
+            smtplib.SMTPRecipientsRefused({'someone@example.com': (450, b'busy')}),
+        ],
+    )
+    def test_transient_errors(self, error):
+        assert is_transient_email_error(error)
+        assert is_transient_email_error(mailer_error(error))
+
+    @pytest.mark.parametrize(
+        'error',
+        [
+            smtplib.SMTPDataError(554, b'rejected'),
+            smtplib.SMTPAuthenticationError(535, b'bad credentials'),
+            smtplib.SMTPRecipientsRefused({'someone@example.com': (550, b'no user')}),
+            mailer.MailerException('not configured'),
+        ],
+    )
+    def test_permanent_errors(self, error):
+        assert not is_transient_email_error(error)
+        assert not is_transient_email_error(mailer_error(error))
+
+
+@pytest.mark.ckan_config('ckanext.query_dois.email_backoff', 0)
+@patch('ckanext.query_dois.lib.emails.mailer.mail_recipient')
+class TestDeliverSavedSearchEmail:
+    def test_sends_with_ckan_mailer(self, mail_recipient_mock):
+        deliver_saved_search_email('someone@example.com', '10.1234/qd.test')
+        mail_recipient_mock.assert_called_once()
+        kwargs = mail_recipient_mock.call_args.kwargs
+        assert kwargs['recipient_email'] == 'someone@example.com'
+        assert kwargs['subject'] == 'Query DOI created'
+        assert 'https://doi.org/10.1234/qd.test' in kwargs['body']
+
+    def test_transient_errors_are_retried(self, mail_recipient_mock):
+        mail_recipient_mock.side_effect = [
+            mailer_error(smtplib.SMTPServerDisconnected()),
+            None,
+        ]
+        deliver_saved_search_email('someone@example.com', '10.1234/qd.test')
+        assert mail_recipient_mock.call_count == 2
+
+    def test_permanent_errors_are_not_retried(self, mail_recipient_mock):
+        error = smtplib.SMTPRecipientsRefused({'someone@example.com': (550, b'no')})
+        mail_recipient_mock.side_effect = mailer_error(error)
+        with pytest.raises(mailer.MailerException):
+            deliver_saved_search_email('someone@example.com', '10.1234/qd.test')
+        assert mail_recipient_mock.call_count == 1
+
+
+@patch('ckanext.query_dois.lib.emails.mailer.mail_recipient')
+class TestSendSavedSearchEmail:
+    def test_one_doi(self, mail_recipient_mock):
+        query_doi = MagicMock(doi='10.1234/qd.one')
+        assert send_saved_search_email('someone@example.com', query_doi)
+        kwargs = mail_recipient_mock.call_args.kwargs
+        assert kwargs['subject'] == 'Query DOI created'
+        assert 'https://doi.org/10.1234/qd.one' in kwargs['body']
+
+    def test_many_dois(self, mail_recipient_mock):
+        query_dois = [MagicMock(doi='10.1234/qd.one'), MagicMock(doi='10.1234/qd.two')]
+        assert send_saved_search_email('someone@example.com', *query_dois)
+        mail_recipient_mock.assert_called_once()
+        kwargs = mail_recipient_mock.call_args.kwargs
+        assert kwargs['subject'] == 'Query DOIs created'
+        assert kwargs['body'] == get_saved_search_body(
+            ['10.1234/qd.one', '10.1234/qd.two']
+        )
+
+    @pytest.mark.parametrize(
+        'error',
+        [
+            mailer_error(smtplib.SMTPServerDisconnected()),
+            mailer_error(smtplib.SMTPResponseException(550, b'no')),
+            socket.error(),
+        ],
+    )
+    def test_errors_are_not_raised(self, mail_recipient_mock, error):
+        mail_recipient_mock.side_effect = error
+        query_doi = MagicMock(doi='10.1234/qd.one')
+        assert not send_saved_search_email('someone@example.com', query_doi)
@@ -0,0 +1,33 @@
+import pytest
+from datacite.errors import DataCiteNotFoundError, DataCiteServerError
+
+from tests.helpers.fake_mds import FakeMDSAdapter, make_fake_client
+
+metadata = (
+    '<resource><identifier identifierType="DOI">10.1234/qd.abc</identifier></resource>'
+)
+
+
+class TestFakeMDS:
+    def test_metadata_round_trip(self):
+        client = make_fake_client(FakeMDSAdapter(), '10.1234')
+        with pytest.raises(DataCiteNotFoundError):
+            client.metadata_get('10.1234/qd.abc')
+        client.metadata_post(metadata)
+        assert client.metadata_get('10.1234/qd.abc') == metadata
+
+    def test_doi_post(self):
+        adapter = FakeMDSAdapter()
+        client = make_fake_client(adapter, '10.1234')
+        client.metadata_post(metadata)
+        client.doi_post('10.1234/qd.abc', 'https://example.com/doi/10.1234/qd.abc')
+        assert client.doi_get('10.1234/qd.abc') == (
+            'https://example.com/doi/10.1234/qd.abc'
+        )
+
+    def test_errors(self):
+        adapter = FakeMDSAdapter(error_rate=1)
+        client = make_fake_client(adapter, '10.1234', retries=1, backoff=0)
+        with pytest.raises(DataCiteServerError):
+            client.metadata_get('10.1234/qd.abc')
+        assert adapter.request_count == 2
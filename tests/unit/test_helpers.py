@@ -2,13 +2,18 @@ import random
 import string
 import time
 from datetime import datetime
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from uuid import uuid4
 
 import pytest
+from ckan import model
 from ckan.tests import factories
 
-from ckanext.query_dois.helpers import get_doi_count, get_most_recent_dois
+from ckanext.query_dois.helpers import (
+    get_doi_count,
+    get_doi_summary,
+    get_most_recent_dois,
+)
 from ckanext.query_dois.lib.doi import create_database_entry
 from ckanext.query_dois.model import QueryDOI
 
@@ -111,3 +116,74 @@ class TestGetMostRecentDOIs:
         for _ in range(10):
             make_doi(resource_1['id'])
         assert len(get_most_recent_dois(package_1['id'], 5)) == 5
+
+
+@pytest.mark.usefixtures('clean_db', 'setup_db')
+class TestGetDOISummary:
+    def test_no_package(self):
+        summary = get_doi_summary('efiownfwe', 5)
+        assert summary.count == 0
+        assert summary.query_dois == []
+
+    def test_dois_more_than_limit(self):
+        package_1 = factories.Dataset(name='package1')
+        resource_1 = factories.Resource(package_id=package_1['id'])
+        dois = [make_doi(resource_1['id']).doi for _ in range(10)]
+
+        summary = get_doi_summary(package_1['id'], 5)
+
+        assert summary.count == 10
+        assert [query_doi.doi for query_doi in summary.query_dois] == dois[:4:-1]
+
+    def test_minting_invalidates_summary(self):
+        package_1 = factories.Dataset(name='package1')
+        resource_1 = factories.Resource(package_id=package_1['id'])
+        make_doi(resource_1['id'])
+        assert get_doi_summary(package_1['id'], 5).count == 1
+
+        make_doi(resource_1['id'])
+        assert get_doi_summary(package_1['id'], 5).count == 2
+
+    def test_name_is_cached_by_id(self):
+        package_1 = factories.Dataset(name='package1')
+        resource_1 = factories.Resource(package_id=package_1['id'])
+        make_doi(resource_1['id'])
+        assert get_doi_summary('package1', 5).count == 1
+
+        # minting removes the summaries by package ID
+        make_doi(resource_1['id'])
+        assert get_doi_summary('package1', 5).count == 2
+
+    def test_private_package(self):
+        org = factories.Organization()
+        package_1 = factories.Dataset(
+            name='package1', owner_org=org['id'], private=True
+        )
+        resource_1 = factories.Resource(package_id=package_1['id'])
+        make_doi(resource_1['id'])
+
+        with patch(
+            'ckanext.query_dois.lib.summaries.can_show_package', return_value=False
+        ) as can_show_package_mock:
+            summary = get_doi_summary(package_1['id'], 5)
+        assert summary.count == 0
+        can_show_package_mock.assert_called_once_with(package_1['id'])
+
+        with patch(
+            'ckanext.query_dois.lib.summaries.can_show_package', return_value=True
+        ):
+            assert get_doi_summary(package_1['id'], 5).count == 1
+
+    def test_deleted_package(self):
+        package_1 = factories.Dataset(name='package1')
+        resource_1 = factories.Resource(package_id=package_1['id'])
+        make_doi(resource_1['id'])
+        assert get_doi_summary(package_1['id'], 5).count == 1
+
+        model.Package.get(package_1['id']).delete()
+        model.repo.commit()
+
+        with patch(
+            'ckanext.query_dois.lib.summaries.can_show_package', return_value=False
+        ):
+            assert get_doi_summary(package_1['id'], 5).count == 0
@@ -0,0 +1,32 @@
+from unittest.mock import MagicMock, call, patch
+
+import pytest
+
+from ckanext.query_dois.lib.jobs import retry
+
+
+@patch('ckanext.query_dois.lib.jobs.time.sleep')
+class TestRetry:
+    def test_success(self, sleep_mock):
+        func = MagicMock(return_value=4)
+        assert retry(func, (ValueError,), 3, 1, 'test') == 4
+        assert func.call_count == 1
+        assert not sleep_mock.called
+
+    def test_retries_with_backoff(self, sleep_mock):
+        func = MagicMock(side_effect=[ValueError, ValueError, 4])
+        assert retry(func, (ValueError,), 3, 1, 'test') == 4
+        assert func.call_count == 3
+        assert sleep_mock.call_args_list == [call(1), call(2)]
+
+    def test_raises_when_out_of_attempts(self, sleep_mock):
+        func = MagicMock(side_effect=ValueError)
+        with pytest.raises(ValueError):
+            retry(func, (ValueError,), 3, 1, 'test')
+        assert func.call_count == 3
+
+    def test_other_errors_are_not_retried(self, sleep_mock):
+        func = MagicMock(side_effect=TypeError)
+        with pytest.raises(TypeError):
+            retry(func, (ValueError,), 3, 1, 'test')
+        assert func.call_count == 1
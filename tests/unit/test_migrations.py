@@ -0,0 +1,58 @@
+import importlib
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+from ckan import model
+from sqlalchemy import select, text
+
+from ckanext.query_dois.lib.query import make_fingerprint
+from ckanext.query_dois.model import query_doi_pool_table, query_doi_table
+
+versions = 'ckanext.query_dois.migration.query_dois.versions'
+
+
+def test_pool_migration_matches_model():
+    migration = importlib.import_module(f'{versions}.c81d6e2a9f34_add_doi_pool')
+    with patch.object(migration, 'op') as op_mock:
+        migration.upgrade()
+    name, *columns = op_mock.create_table.call_args.args
+    assert name == query_doi_pool_table.name
+    assert [
+        (column.name, type(column.type), column.primary_key, column.unique)
+        for column in columns
+    ] == [
+        (column.name, type(column.type), column.primary_key, column.unique)
+        for column in query_doi_pool_table.columns
+    ]
+
+
+@pytest.mark.usefixtures('clean_db', 'setup_db')
+def test_fingerprint_migration_matches_make_fingerprint():
+    migration = importlib.import_module(f'{versions}.9c4e2b7d5a13_add_doi_fingerprint')
+    all_resources_and_versions = [
+        {},
+        {'r1': 1},
+        {'r2': None, 'r1': 1, 'R3': 1700000000000},
+    ]
+    for index, resources_and_versions in enumerate(all_resources_and_versions):
+        model.Session.execute(
+            query_doi_table.insert().values(
+                doi=f'10.1234/qd.{index}',
+                resources_and_versions=resources_and_versions,
+                timestamp=datetime.now(),
+                query={},
+                query_hash=str(index),
+                count=0,
+            )
+        )
+
+    model.Session.execute(text(migration.fill_fingerprints))
+
+    rows = model.Session.execute(
+        select(
+            [query_doi_table.c.resources_and_versions, query_doi_table.c.fingerprint]
+        )
+    )
+    for resources_and_versions, fingerprint in rows:
+        assert fingerprint == make_fingerprint(resources_and_versions)
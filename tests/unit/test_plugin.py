@@ -80,3 +80,49 @@ class TestIntegrationWithIVersionedDatastoreDownloads:
 
         assert ret_context is context
         assert context['doi'] == doi.doi
+
+    def test_download_query_is_only_created_once_when_running(self):
+        plugin = QueryDOIsPlugin()
+
+        request = MagicMock(state='complete')
+        doi = MagicMock(doi='some/doi')
+
+        create_mock = MagicMock()
+        find_existing_doi_mock = MagicMock(return_value=doi)
+
+        with patch('ckanext.query_dois.plugin.record_stat') as record_stat_mock, patch(
+            'ckanext.query_dois.plugin.find_existing_doi', find_existing_doi_mock
+        ), patch(
+            'ckanext.query_dois.plugin.Query.create_from_download_request',
+            create_mock,
+        ):
+            context = plugin.download_modify_notifier_template_context(request, {})
+            manifest = plugin.download_modify_manifest({}, request)
+            plugin.download_after_run(request)
+
+        assert create_mock.call_count == 1
+        # the QueryDOI isn't memoised, it's looked up in each hook's session
+        assert find_existing_doi_mock.call_count == 3
+        find_existing_doi_mock.assert_called_with(create_mock.return_value)
+        assert context['doi'] == doi.doi
+        assert manifest['query-doi'] == doi.doi
+        record_stat_mock.assert_called_once_with(doi, 'download', identifier=request.id)
+        # the query should be removed once the download has finished
+        assert request.id not in plugin.download_cache
+
+    def test_download_init_does_not_memoise_the_query(self):
+        # download_after_init is called in the web process, the other hooks are called
+        # in the worker, so anything memoised in after_init would never be removed
+        plugin = QueryDOIsPlugin()
+        request = MagicMock()
+
+        with patch(
+            'ckanext.query_dois.plugin.mint_multisearch_doi',
+            MagicMock(return_value=(True, MagicMock())),
+        ) as mint_mock, patch(
+            'ckanext.query_dois.plugin.Query.create_from_download_request'
+        ) as create_mock:
+            plugin.download_after_init(request)
+
+        mint_mock.assert_called_once_with(create_mock.return_value)
+        assert request.id not in plugin.download_cache
@@ -0,0 +1,48 @@
+import hashlib
+from unittest.mock import MagicMock, patch
+
+from ckanext.query_dois.lib.query import find_datastore_resources, make_fingerprint
+
+
+@patch('ckanext.query_dois.lib.query.get_datastore_resource_cache')
+class TestFindDatastoreResources:
+    def test_resources_are_checked(self, get_cache_mock):
+        cache = MagicMock()
+        cache.__contains__.return_value = False
+        get_cache_mock.return_value = cache
+        check_mock = MagicMock(
+            side_effect=lambda context, data_dict: data_dict['resource_id'] == 'r1'
+        )
+        with patch('ckanext.query_dois.lib.query.toolkit.get_action') as get_action:
+            get_action.return_value = check_mock
+            found = find_datastore_resources(['r1', 'r2', 'r3'])
+        assert found == {'r1'}
+        assert check_mock.call_count == 3
+        # only the positive result should be remembered
+        cache.set.assert_called_once_with('r1', True)
+
+    def test_cached_resources_are_not_checked(self, get_cache_mock):
+        cache = MagicMock()
+        cache.__contains__.side_effect = lambda resource_id: resource_id == 'r1'
+        get_cache_mock.return_value = cache
+        check_mock = MagicMock(return_value=True)
+        with patch('ckanext.query_dois.lib.query.toolkit.get_action') as get_action:
+            get_action.return_value = check_mock
+            found = find_datastore_resources(['r1', 'r2'])
+        assert found == {'r1', 'r2'}
+        check_mock.assert_called_once_with({}, {'resource_id': 'r2'})
+
+
+class TestMakeFingerprint:
+    def test_resource_order_is_ignored(self):
+        assert make_fingerprint({'r1': 1, 'r2': 2}) == make_fingerprint(
+            {'r2': 2, 'r1': 1}
+        )
+
+    def test_versions_change_the_fingerprint(self):
+        assert make_fingerprint({'r1': 1}) != make_fingerprint({'r1': 2})
+
+    def test_canonical_form(self):
+        # this must match the SQL used to backfill the fingerprints
+        expected = hashlib.md5(b'r1:1,r2:null').hexdigest()
+        assert make_fingerprint({'r2': None, 'r1': 1}) == expected
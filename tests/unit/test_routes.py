@@ -0,0 +1,288 @@
+import json
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+from ckan import model
+from ckan.tests import factories
+from werkzeug.exceptions import HTTPException
+
+from ckanext.query_dois.lib.stats import DOWNLOAD_ACTION, record_stat
+from ckanext.query_dois.model import (
+    REGISTERED_STATUS,
+    QueryDOI,
+    QueryDOIStat,
+    query_doi_table,
+)
+from ckanext.query_dois.routes._helpers import (
+    get_current_slug,
+    get_current_slug_cache,
+    get_doi_authors,
+    get_multisearch_doi_context,
+    get_package_and_resource_info,
+    paginate,
+)
+
+
+@pytest.mark.usefixtures('clean_db')
+class TestGetPackageAndResourceInfo:
+    def test_accessible_resources(self):
+        package_1 = factories.Dataset(name='package1', title='Package 1')
+        package_2 = factories.Dataset(name='package2', title='Package 2')
+        resource_1 = factories.Resource(package_id=package_1['id'], name='r1')
+        resource_2 = factories.Resource(package_id=package_1['id'], name='r2')
+        resource_3 = factories.Resource(package_id=package_2['id'], name='r3')
+        resource_ids = [resource_1['id'], resource_2['id'], resource_3['id']]
+
+        packages, resources, inaccessible = get_package_and_resource_info(resource_ids)
+
+        assert packages == {
+            package_1['id']: {
+                'title': 'Package 1',
+                'name': 'package1',
+                'resource_ids': [resource_1['id'], resource_2['id']],
+            },
+            package_2['id']: {
+                'title': 'Package 2',
+                'name': 'package2',
+                'resource_ids': [resource_3['id']],
+            },
+        }
+        assert resources == {
+            resource_1['id']: {'name': 'r1', 'package_id': package_1['id']},
+            resource_2['id']: {'name': 'r2', 'package_id': package_1['id']},
+            resource_3['id']: {'name': 'r3', 'package_id': package_2['id']},
+        }
+        assert inaccessible == []
+
+    def test_inaccessible_resources(self):
+        package_1 = factories.Dataset()
+        resource_1 = factories.Resource(package_id=package_1['id'])
+        resource_2 = factories.Resource(package_id=package_1['id'])
+        resource_2_obj = model.Resource.get(resource_2['id'])
+        resource_2_obj.state = 'deleted'
+        model.Session.commit()
+
+        packages, resources, inaccessible = get_package_and_resource_info(
+            [resource_1['id'], resource_2['id'], 'missing']
+        )
+
+        assert list(resources) == [resource_1['id']]
+        assert packages[package_1['id']]['resource_ids'] == [resource_1['id']]
+        assert inaccessible == [resource_2['id'], 'missing']
+
+    def test_private_packages_are_checked_once(self):
+        org = factories.Organization()
+        package_1 = factories.Dataset(owner_org=org['id'], private=True)
+        resource_1 = factories.Resource(package_id=package_1['id'])
+        resource_2 = factories.Resource(package_id=package_1['id'])
+
+        can_show_package_mock = MagicMock(return_value=False)
+        with patch(
+            'ckanext.query_dois.routes._helpers.can_show_package',
+            can_show_package_mock,
+        ):
+            packages, resources, inaccessible = get_package_and_resource_info(
+                [resource_1['id'], resource_2['id']]
+            )
+
+        assert packages == {}
+        assert resources == {}
+        assert inaccessible == [resource_1['id'], resource_2['id']]
+        can_show_package_mock.assert_called_once_with(package_1['id'])
+
+
+class TestGetCurrentSlug:
+    def test_slugs_are_cached_by_inaccessible_resources(self):
+        get_current_slug_cache().clear()
+        query_doi = MagicMock(doi='10.1234/qd.test')
+        create_current_slug_mock = MagicMock(side_effect=['slug-1', 'slug-2'])
+
+        with patch(
+            'ckanext.query_dois.routes._helpers.create_current_slug',
+            create_current_slug_mock,
+        ):
+            assert get_current_slug(query_doi, ['b', 'a']) == 'slug-1'
+            assert get_current_slug(query_doi, ['a', 'b']) == 'slug-1'
+            assert get_current_slug(query_doi, ['a']) == 'slug-2'
+
+        assert create_current_slug_mock.call_count == 2
+
+
+@patch('ckanext.query_dois.routes._helpers.find_authors')
+class TestGetDOIAuthors:
+    def test_stored_authors_are_used(self, find_mock):
+        query_doi = MagicMock(authors=['Smith, John', 'Jones'])
+        assert get_doi_authors(query_doi, ['r1']) == ['Smith, John', 'Jones']
+        assert not find_mock.called
+
+    def test_authors_are_found_if_not_stored(self, find_mock):
+        find_mock.return_value = ['Smith, John']
+        query_doi = MagicMock(authors=None)
+        assert get_doi_authors(query_doi, ['r2', 'r1']) == ['Smith, John']
+        find_mock.assert_called_once_with(['r1', 'r2'])
+
+    def test_inaccessible_resources_are_not_used(self, find_mock):
+        assert get_doi_authors(MagicMock(authors=None), []) == ['Unknown']
+        assert not find_mock.called
+
+    def test_no_authors(self, find_mock):
+        find_mock.return_value = []
+        assert get_doi_authors(MagicMock(authors=None), ['r1']) == ['Unknown']
+        assert get_doi_authors(MagicMock(authors=[]), ['r1']) == ['Unknown']
+
+
+@pytest.mark.usefixtures('clean_db')
+@patch('ckanext.query_dois.routes._helpers.get_current_slug', MagicMock())
+@patch(
+    'ckanext.query_dois.routes._helpers.get_stats', MagicMock(return_value=(0, 0, None))
+)
+class TestMultisearchAuthors:
+    def make_query_doi(self, authors, package_author, **package_fields):
+        package = factories.Dataset(author=package_author, **package_fields)
+        resource = factories.Resource(package_id=package['id'])
+        return QueryDOI(
+            doi='10.1234/qd.test',
+            resources_and_versions={resource['id']: 1},
+            resource_counts={resource['id']: 4},
+            count=4,
+            authors=authors,
+            status=REGISTERED_STATUS,
+        )
+
+    def test_stored_authors(self):
+        query_doi = self.make_query_doi(['Stored'], 'Package author')
+        context = get_multisearch_doi_context(query_doi)
+        assert context['authors'] == ['Stored']
+
+    def test_authors_of_older_dois_are_found(self):
+        query_doi = self.make_query_doi(None, 'Smith, John; Natural History Museum')
+        context = get_multisearch_doi_context(query_doi)
+        assert context['authors'] == ['Smith, John', 'Natural History Museum']
+
+    def test_unknown_authors(self):
+        query_doi = self.make_query_doi(None, '')
+        context = get_multisearch_doi_context(query_doi)
+        assert context['authors'] == ['Unknown']
+
+    @patch(
+        'ckanext.query_dois.routes._helpers.can_show_package',
+        MagicMock(return_value=False),
+    )
+    def test_authors_of_private_packages_are_not_shown(self):
+        organization = factories.Organization()
+        query_doi = self.make_query_doi(
+            None, 'Secret author', private=True, owner_org=organization['id']
+        )
+        context = get_multisearch_doi_context(query_doi)
+        assert context['authors'] == ['Unknown']
+
+
+@pytest.mark.usefixtures('clean_db', 'setup_db')
+class TestPaginate:
+    def make_query(self):
+        query_doi = MagicMock(doi='10.1234/qd.test')
+        for identifier in 'abcde':
+            record_stat(query_doi, DOWNLOAD_ACTION, identifier=identifier)
+        return model.Session.query(QueryDOIStat).order_by(QueryDOIStat.id.desc())
+
+    def test_offset(self, app):
+        query = self.make_query()
+        with app.flask_app.test_request_context('/?offset=1&limit=2'):
+            results = paginate(query, QueryDOIStat.id, QueryDOIStat.as_dict)
+        assert [result['identifier'] for result in results] == ['d', 'c']
+
+    def test_cursor(self, app):
+        query = self.make_query()
+        identifiers = []
+        cursor = ''
+        while cursor is not None:
+            with app.flask_app.test_request_context(f'/?limit=2&cursor={cursor}'):
+                page = paginate(query, QueryDOIStat.id, QueryDOIStat.as_dict)
+            identifiers.extend(result['identifier'] for result in page['results'])
+            cursor = page['next']
+        assert identifiers == ['e', 'd', 'c', 'b', 'a']
+
+    @pytest.mark.ckan_config('ckanext.query_dois.max_page_size', 3)
+    def test_limit_above_max_is_rejected(self, app):
+        query = self.make_query()
+        with app.flask_app.test_request_context('/?limit=3'):
+            results = paginate(query, QueryDOIStat.id, QueryDOIStat.as_dict)
+        assert len(results) == 3
+        with app.flask_app.test_request_context('/?limit=4'):
+            with pytest.raises(HTTPException) as e:
+                paginate(query, QueryDOIStat.id, QueryDOIStat.as_dict)
+        assert e.value.code == 400
+
+    @pytest.mark.ckan_config('ckanext.query_dois.max_page_size', 3)
+    def test_default_limit_is_capped(self, app):
+        query = self.make_query()
+        with app.flask_app.test_request_context('/'):
+            results = paginate(query, QueryDOIStat.id, QueryDOIStat.as_dict)
+        assert len(results) == 3
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'query_dois')
+@pytest.mark.usefixtures('clean_db', 'setup_db', 'with_plugins')
+class TestNDJSON:
+    def test_action_stats(self, app):
+        query_doi = MagicMock(doi='10.1234/qd.test')
+        for identifier in 'abc':
+            record_stat(query_doi, DOWNLOAD_ACTION, identifier=identifier)
+        expected = [
+            stat.as_dict()
+            for stat in model.Session.query(QueryDOIStat).order_by(
+                QueryDOIStat.id.desc()
+            )
+        ]
+
+        response = app.get('/doi/stats?format=ndjson&limit=2')
+
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line) for line in lines] == expected[:2]
+
+    def test_dois(self, app):
+        for suffix in 'abc':
+            model.Session.execute(
+                query_doi_table.insert().values(
+                    doi=f'10.1234/qd.{suffix}',
+                    resources_and_versions={'r1': 1},
+                    timestamp=datetime(2020, 1, 1),
+                    query={},
+                    query_hash=suffix,
+                    count=1,
+                )
+            )
+        model.Session.commit()
+        record_stat(MagicMock(doi='10.1234/qd.c'), DOWNLOAD_ACTION, identifier='a')
+        expected = app.get('/doi?limit=3').json
+
+        response = app.get('/doi?format=ndjson')
+
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+        lines = response.get_data(as_text=True).splitlines()
+        results = [json.loads(line) for line in lines]
+        assert [result['doi'] for result in results] == [
+            '10.1234/qd.c',
+            '10.1234/qd.b',
+            '10.1234/qd.a',
+        ]
+        assert results[0]['usage']['downloads'] == 1
+        assert results == expected
+
+        cursor = results[0]['id']
+        response = app.get(f'/doi?format=ndjson&limit=1&cursor={cursor}')
+        lines = response.get_data(as_text=True).splitlines()
+        assert [json.loads(line) for line in lines] == expected[1:2]
+
+    @pytest.mark.ckan_config('ckanext.query_dois.max_stream_size', 2)
+    def test_limit_is_capped(self, app):
+        query_doi = MagicMock(doi='10.1234/qd.test')
+        for identifier in 'abc':
+            record_stat(query_doi, DOWNLOAD_ACTION, identifier=identifier)
+
+        response = app.get('/doi/stats?format=ndjson')
+        assert len(response.get_data(as_text=True).splitlines()) == 2
+
+        app.get('/doi/stats?format=ndjson&limit=3', status=400)
@@ -0,0 +1,390 @@
+import time
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import bcrypt
+import pytest
+from ckan import model
+from sqlalchemy import select
+
+from ckanext.query_dois.lib.stats import (
+    DOWNLOAD_ACTION,
+    SAVE_ACTION,
+    StatSpool,
+    StatWriter,
+    aggregate_stats,
+    anonymize_email,
+    bcrypt_identifier,
+    hmac_identifier,
+    rebuild_usage,
+    record_stat,
+    write_stats,
+)
+from ckanext.query_dois.model import (
+    QueryDOIStat,
+    QueryDOIUsage,
+    query_doi_identifier_alias_table,
+)
+
+
+@pytest.mark.usefixtures('clean_db', 'setup_db')
+class TestUsage:
+    def test_record_stat_updates_usage(self):
+        query_doi = MagicMock(doi='10.1234/qd.test')
+        download = record_stat(query_doi, DOWNLOAD_ACTION, identifier='a')
+        record_stat(query_doi, SAVE_ACTION, identifier='b')
+
+        usage = model.Session.query(QueryDOIUsage).get(query_doi.doi)
+        assert usage.download_count == 1
+        assert usage.save_count == 1
+        assert usage.last_download_at == download.timestamp
+
+        latest_download = record_stat(query_doi, DOWNLOAD_ACTION, identifier='c')
+        model.Session.refresh(usage)
+        assert usage.download_count == 2
+        assert usage.save_count == 1
+        assert usage.last_download_at == latest_download.timestamp
+
+    def test_rebuild_usage(self):
+        query_doi_1 = MagicMock(doi='10.1234/qd.test1')
+        query_doi_2 = MagicMock(doi='10.1234/qd.test2')
+        record_stat(query_doi_1, DOWNLOAD_ACTION, identifier='a')
+        record_stat(query_doi_1, DOWNLOAD_ACTION, identifier='b')
+        record_stat(query_doi_2, SAVE_ACTION, identifier='c')
+        model.Session.query(QueryDOIUsage).delete()
+        model.Session.commit()
+
+        assert rebuild_usage() == 2
+        usage_1 = model.Session.query(QueryDOIUsage).get(query_doi_1.doi)
+        usage_2 = model.Session.query(QueryDOIUsage).get(query_doi_2.doi)
+        assert (usage_1.download_count, usage_1.save_count) == (2, 0)
+        assert (usage_2.download_count, usage_2.save_count) == (0, 1)
+        assert usage_2.last_download_at is None
+
+
+def make_stat(doi, action=DOWNLOAD_ACTION):
+    return dict(
+        doi=doi,
+        action=action,
+        domain='example.com',
+        identifier='a',
+        timestamp=datetime.now(),
+    )
+
+
+@pytest.mark.usefixtures('clean_db', 'setup_db')
+def test_write_stats():
+    stats = [
+        make_stat('10.1234/qd.test1'),
+        make_stat('10.1234/qd.test1'),
+        make_stat('10.1234/qd.test1', SAVE_ACTION),
+        make_stat('10.1234/qd.test2', SAVE_ACTION),
+    ]
+    write_stats(stats)
+
+    assert model.Session.query(QueryDOIStat).count() == 4
+    usage_1 = model.Session.query(QueryDOIUsage).get('10.1234/qd.test1')
+    assert usage_1.download_count == 2
+    assert usage_1.save_count == 1
+    assert usage_1.last_download_at == stats[1]['timestamp']
+    usage_2 = model.Session.query(QueryDOIUsage).get('10.1234/qd.test2')
+    assert usage_2.download_count == 0
+    assert usage_2.save_count == 1
+    assert usage_2.last_download_at is None
+
+
+@patch('ckanext.query_dois.lib.stats.invalidate_landing_page')
+@patch('ckanext.query_dois.lib.stats.write_stats')
+class TestStatWriter:
+    def test_flushes_when_full(self, write_stats_mock, invalidate_mock):
+        writer = StatWriter(2, 60, 100)
+        writer.add(make_stat('10.1234/qd.test'))
+        assert not write_stats_mock.called
+        writer.add(make_stat('10.1234/qd.test'))
+        assert write_stats_mock.call_count == 1
+        assert len(write_stats_mock.call_args[0][0]) == 2
+        assert len(writer) == 0
+        invalidate_mock.assert_called_once_with('10.1234/qd.test')
+
+    def test_flushes_after_interval(self, write_stats_mock, invalidate_mock):
+        writer = StatWriter(100, 0.01, 1000)
+        writer.add(make_stat('10.1234/qd.test'))
+        for _ in range(100):
+            if write_stats_mock.called:
+                break
+            time.sleep(0.01)
+        assert write_stats_mock.call_count == 1
+        assert len(writer) == 0
+
+    def test_failed_writes_are_retried(self, write_stats_mock, invalidate_mock):
+        writer = StatWriter(100, 60, 1000)
+        writer.add(make_stat('10.1234/qd.test'))
+        write_stats_mock.side_effect = Exception()
+        assert writer.flush() == 0
+        assert len(writer) == 1
+        write_stats_mock.side_effect = None
+        assert writer.flush() == 1
+        assert len(writer) == 0
+        writer.flush()
+        assert write_stats_mock.call_count == 2
+
+    def test_failed_writes_are_retried_after_interval(
+        self, write_stats_mock, invalidate_mock
+    ):
+        writer = StatWriter(100, 0.01, 1000)
+        write_stats_mock.side_effect = [Exception(), None]
+        writer.add(make_stat('10.1234/qd.test'))
+        for _ in range(100):
+            if write_stats_mock.call_count == 2:
+                break
+            time.sleep(0.01)
+        assert write_stats_mock.call_count == 2
+        assert len(writer) == 0
+
+    def test_buffer_is_capped_while_writes_fail(
+        self, write_stats_mock, invalidate_mock
+    ):
+        writer = StatWriter(2, 60, 3)
+        write_stats_mock.side_effect = Exception()
+        for index in range(5):
+            writer.add(make_stat(f'10.1234/qd.{index}'))
+        assert len(writer) == 3
+        write_stats_mock.side_effect = None
+        writer.flush()
+        # the oldest stats are dropped
+        assert [stat['doi'] for stat in write_stats_mock.call_args[0][0]] == [
+            '10.1234/qd.2',
+            '10.1234/qd.3',
+            '10.1234/qd.4',
+        ]
+
+
+@patch('ckanext.query_dois.lib.stats.invalidate_landing_page')
+@patch('ckanext.query_dois.lib.stats.write_stats')
+class TestStatSpool:
+    def test_flushes_when_full(self, write_stats_mock, invalidate_mock, tmp_path):
+        spool = StatSpool(str(tmp_path), 2, 60, 100)
+        first = make_stat('10.1234/qd.test')
+        spool.add(first)
+        assert not write_stats_mock.called
+        assert len(spool) == 1
+        spool.add(make_stat('10.1234/qd.test'))
+        assert write_stats_mock.call_count == 1
+        stats = write_stats_mock.call_args[0][0]
+        assert len(stats) == 2
+        # the stats survive the round trip through the spool file
+        assert stats[0] == first
+        assert len(spool) == 0
+        invalidate_mock.assert_called_once_with('10.1234/qd.test')
+
+    def test_flushes_after_interval(self, write_stats_mock, invalidate_mock, tmp_path):
+        spool = StatSpool(str(tmp_path), 100, 60, 1000)
+        old = make_stat('10.1234/qd.test')
+        old['timestamp'] = datetime.now() - timedelta(seconds=61)
+        spool.add(old)
+        assert write_stats_mock.call_count == 1
+        assert len(spool) == 0
+
+    def test_spool_is_shared(self, write_stats_mock, invalidate_mock, tmp_path):
+        StatSpool(str(tmp_path), 2, 60, 100).add(make_stat('10.1234/qd.1'))
+        StatSpool(str(tmp_path), 2, 60, 100).add(make_stat('10.1234/qd.2'))
+        assert [stat['doi'] for stat in write_stats_mock.call_args[0][0]] == [
+            '10.1234/qd.1',
+            '10.1234/qd.2',
+        ]
+
+    def test_failed_writes_are_retried(
+        self, write_stats_mock, invalidate_mock, tmp_path
+    ):
+        spool = StatSpool(str(tmp_path), 100, 60, 1000)
+        spool.add(make_stat('10.1234/qd.test'))
+        write_stats_mock.side_effect = Exception()
+        assert spool.flush() == 0
+        assert len(spool) == 1
+        write_stats_mock.side_effect = None
+        assert spool.flush() == 1
+        assert len(spool) == 0
+        assert spool.flush() == 0
+        assert write_stats_mock.call_count == 2
+
+    def test_spool_is_capped_while_writes_fail(
+        self, write_stats_mock, invalidate_mock, tmp_path
+    ):
+        spool = StatSpool(str(tmp_path), 2, 60, 3)
+        write_stats_mock.side_effect = Exception()
+        for index in range(5):
+            spool.add(make_stat(f'10.1234/qd.{index}'))
+        assert len(spool) == 3
+        write_stats_mock.side_effect = None
+        spool.flush()
+        # the oldest stats are dropped
+        assert [stat['doi'] for stat in write_stats_mock.call_args[0][0]] == [
+            '10.1234/qd.2',
+            '10.1234/qd.3',
+            '10.1234/qd.4',
+        ]
+
+    def test_partial_lines_are_skipped(
+        self, write_stats_mock, invalidate_mock, tmp_path
+    ):
+        spool = StatSpool(str(tmp_path), 100, 60, 1000)
+        with open(spool.path, 'w') as spool_file:
+            spool_file.write('{"doi": "10.1234/qd.bro')
+            spool_file.write('\n')
+        spool.add(make_stat('10.1234/qd.test'))
+        assert spool.flush() == 1
+        assert write_stats_mock.call_args[0][0][0]['doi'] == '10.1234/qd.test'
+
+
+@patch('ckanext.query_dois.lib.stats.get_stat_spool')
+@patch('ckanext.query_dois.lib.stats.get_stat_writer')
+class TestRecordStatBuffering:
+    @patch('ckanext.query_dois.lib.stats.has_request_context', return_value=True)
+    def test_stats_are_buffered_in_requests(
+        self, context_mock, get_writer_mock, get_spool_mock
+    ):
+        with patch('ckanext.query_dois.lib.stats.model.Session') as session_mock:
+            record_stat(MagicMock(doi='10.1234/qd.test'), DOWNLOAD_ACTION)
+        get_writer_mock.return_value.add.assert_called_once()
+        assert not get_spool_mock.return_value.add.called
+        assert not session_mock.commit.called
+
+    @patch('ckanext.query_dois.lib.stats.has_request_context', return_value=False)
+    def test_stats_are_spooled_outside_requests(
+        self, context_mock, get_writer_mock, get_spool_mock
+    ):
+        with patch('ckanext.query_dois.lib.stats.model.Session') as session_mock:
+            record_stat(MagicMock(doi='10.1234/qd.test'), DOWNLOAD_ACTION)
+        get_spool_mock.return_value.add.assert_called_once()
+        assert get_spool_mock.return_value.add.call_args[0][0]['doi'] == (
+            '10.1234/qd.test'
+        )
+        assert not get_writer_mock.return_value.add.called
+        assert not session_mock.commit.called
+
+    @patch('ckanext.query_dois.lib.stats.has_request_context', return_value=False)
+    @patch('ckanext.query_dois.lib.stats.invalidate_landing_page', MagicMock())
+    @patch('ckanext.query_dois.lib.stats.update_usage', MagicMock())
+    def test_stats_are_written_outside_requests_without_a_spool(
+        self, context_mock, get_writer_mock, get_spool_mock
+    ):
+        get_spool_mock.return_value = None
+        with patch('ckanext.query_dois.lib.stats.model.Session') as session_mock:
+            record_stat(MagicMock(doi='10.1234/qd.test'), DOWNLOAD_ACTION)
+        assert not get_writer_mock.return_value.add.called
+        session_mock.commit.assert_called_once()
+
+
+@pytest.mark.usefixtures('clean_db', 'setup_db')
+class TestAggregateStats:
+    def test_group_by_action(self):
+        query_doi = MagicMock(doi='10.1234/qd.test')
+        record_stat(query_doi, DOWNLOAD_ACTION, identifier='a')
+        record_stat(query_doi, DOWNLOAD_ACTION, identifier='b')
+        record_stat(query_doi, SAVE_ACTION, identifier='c')
+
+        assert aggregate_stats(['action']) == [
+            {'action': DOWNLOAD_ACTION, 'count': 2},
+            {'action': SAVE_ACTION, 'count': 1},
+        ]
+
+    def test_bucket_and_filters(self):
+        query_doi = MagicMock(doi='10.1234/qd.test')
+        download = record_stat(query_doi, DOWNLOAD_ACTION, identifier='a')
+        record_stat(query_doi, DOWNLOAD_ACTION, identifier='b')
+        record_stat(query_doi, SAVE_ACTION, identifier='c')
+
+        results = aggregate_stats(
+            ['doi'], bucket='day', filters={'action': DOWNLOAD_ACTION}
+        )
+
+        day = download.timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+        assert results == [
+            {'doi': query_doi.doi, 'period': day.isoformat(), 'count': 2}
+        ]
+
+    def test_invalid_group_by(self):
+        with pytest.raises(ValueError):
+            aggregate_stats(['identifier'])
+
+
+class TestAnonymizeEmail:
+    def test_bcrypt(self):
+        identifier, domain = anonymize_email('Someone@Example.com')
+        assert domain == 'example.com'
+        assert identifier == bcrypt_identifier('someone@example.com', 'example.com')
+        # the hex bytea format of the hash, which starts with $2b$12$
+        assert identifier.startswith('\\x24326224313224')
+
+    @pytest.mark.ckan_config('ckanext.query_dois.anonymizer', 'hmac')
+    @pytest.mark.ckan_config('ckanext.query_dois.anonymizer_secret', 'secret')
+    @pytest.mark.ckan_config('ckanext.query_dois.anonymizer_legacy_aliases', False)
+    def test_hmac(self):
+        identifier, domain = anonymize_email('Someone@Example.com')
+        assert domain == 'example.com'
+        assert identifier == hmac_identifier('someone@example.com', 'example.com')
+        assert identifier != anonymize_email('someone.else@example.com')[0]
+
+    @pytest.mark.ckan_config('ckanext.query_dois.anonymizer', 'hmac')
+    def test_hmac_needs_secret(self):
+        with pytest.raises(ValueError):
+            anonymize_email('someone@example.com')
+
+
+@pytest.mark.ckan_config('ckanext.query_dois.anonymizer', 'hmac')
+@pytest.mark.ckan_config('ckanext.query_dois.anonymizer_secret', 'secret')
+@pytest.mark.usefixtures('clean_db', 'setup_db')
+class TestLegacyIdentifiers:
+    def test_legacy_identifier_is_used(self):
+        email_address = 'someone@example.com'
+        legacy_identifier = bcrypt_identifier(email_address, 'example.com')
+        query_doi = MagicMock(doi='10.1234/qd.test')
+        record_stat(query_doi, DOWNLOAD_ACTION, identifier=legacy_identifier)
+
+        with patch(
+            'ckanext.query_dois.lib.stats.bcrypt_identifier',
+            MagicMock(side_effect=bcrypt_identifier),
+        ) as bcrypt_mock:
+            assert anonymize_email(email_address)[0] == legacy_identifier
+            assert anonymize_email(email_address)[0] == legacy_identifier
+        # the bcrypt identifier is only created the first time
+        assert bcrypt_mock.call_count == 1
+
+    def test_legacy_identifier_matches_stored_hash(self):
+        email_address = 'someone@example.com'
+        # stats used to be recorded with the raw bcrypt hash bytes as their identifier
+        legacy_hash = bcrypt.hashpw(
+            email_address.encode('utf-8'), b'$2b$12$' + b'MDAwMDAwMGV4YW1wbGUuY2'
+        )
+        QueryDOIStat(
+            doi='10.1234/qd.test',
+            action=DOWNLOAD_ACTION,
+            domain='example.com',
+            identifier=legacy_hash,
+            timestamp=datetime.now(),
+        ).save()
+        stored = model.Session.query(QueryDOIStat.identifier).scalar()
+
+        assert bcrypt_identifier(email_address, 'example.com') == stored
+        assert anonymize_email(email_address)[0] == stored
+
+    def test_alias_is_committed(self):
+        email_address = 'someone@example.com'
+        identifier = anonymize_email(email_address)[0]
+        # nothing else in the session should need to be committed for the alias to stay
+        model.Session.rollback()
+        aliases = query_doi_identifier_alias_table
+        row = model.Session.execute(
+            select([aliases.c.legacy_identifier]).where(
+                aliases.c.identifier == identifier
+            )
+        ).first()
+        assert row is not None
+
+    def test_new_users_get_hmac_identifiers(self):
+        email_address = 'someone@example.com'
+        identifier = hmac_identifier(email_address, 'example.com')
+        assert anonymize_email(email_address)[0] == identifier
+        with patch('ckanext.query_dois.lib.stats.bcrypt_identifier') as bcrypt_mock:
+            assert anonymize_email(email_address)[0] == identifier
+        assert not bcrypt_mock.called
@@ -2,7 +2,7 @@ import pytest
 from ckan.tests import factories
 from ckan.tests.helpers import call_action
 
-from ckanext.query_dois.lib.utils import get_resource_and_package
+from ckanext.query_dois.lib.utils import get_resource_and_package, split_authors
 
 
 @pytest.mark.usefixtures('clean_db')
@@ -15,3 +15,20 @@ def test_get_resource_and_package():
     shown_package = call_action('package_show', id=package['id'])
 
     assert get_resource_and_package(resource['id']) == (shown_resource, shown_package)
+
+
+class TestSplitAuthors:
+    def test_semicolons(self):
+        assert split_authors(['Smith, J.; Jones, A.']) == ['Smith, J.', 'Jones, A.']
+
+    def test_commas_are_not_separators(self):
+        assert split_authors(['Smith, John', 'Natural History Museum, London']) == [
+            'Smith, John',
+            'Natural History Museum, London',
+        ]
+
+    def test_duplicates_and_empty_values_are_removed(self):
+        assert split_authors(['Smith', None, '', 'Jones;Smith; ']) == [
+            'Smith',
+            'Jones',
+        ]
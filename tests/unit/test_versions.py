@@ -0,0 +1,58 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.query_dois.lib.cache import LRUCache
+from ckanext.query_dois.lib.versions import ResourceVersions, round_versions
+
+
+class TestResourceVersions:
+    def test_round(self):
+        versions = ResourceVersions([10, 20, 30])
+        assert versions.round(5) is None
+        assert versions.round(10) == 10
+        assert versions.round(25) == 20
+        assert versions.round(100) == 30
+
+    def test_round_no_versions(self):
+        assert ResourceVersions([]).round(10) is None
+
+    def test_can_round(self):
+        versions = ResourceVersions([10, 20, 30])
+        # old versions can always be rounded
+        assert versions.can_round(5)
+        assert versions.can_round(30)
+        # but newer ones can't as the resource may have gained a new version
+        assert not versions.can_round(31)
+        assert not ResourceVersions([]).can_round(10)
+
+
+@patch('ckanext.query_dois.lib.versions.toolkit.get_action')
+class TestRoundVersions:
+    @pytest.fixture(autouse=True)
+    def cache(self):
+        cache = LRUCache(10)
+        with patch(
+            'ckanext.query_dois.lib.versions.get_resource_versions_cache',
+            MagicMock(return_value=cache),
+        ):
+            yield cache
+
+    def test_cache_is_used(self, get_action):
+        action = get_action.return_value
+        action.return_value = [30, 10, {'version': 20}]
+        assert round_versions(['r1', 'r2'], 25) == {'r1': 20, 'r2': 20}
+        assert round_versions(['r1', 'r2'], 15) == {'r1': 10, 'r2': 10}
+        assert action.call_count == 2
+
+    def test_newer_versions_are_refetched(self, get_action):
+        action = get_action.return_value
+        action.side_effect = [[10, 20], [10, 20, 30]]
+        assert round_versions(['r1'], 25) == {'r1': 20}
+        # the resource gained version 30 in another process, so the cached versions
+        # can't be used to round version 35
+        assert round_versions(['r1'], 35) == {'r1': 30}
+        assert action.call_count == 2
+        # the refetched versions are cached
+        assert round_versions(['r1'], 30) == {'r1': 30}
+        assert action.call_count == 2